@@ -0,0 +1,263 @@
+import os, re, shlex, shutil, sqlite3, logging, threading, pwd, grp
+from collections import Counter
+from piccolo import shell, databases, users, sites, nginx
+from piccolo.databases import Database
+
+"""
+Stand-ins for everything piccolo changes outside its own files and DB, so it
+can run against a throwaway root as any user:
+
+    Accounts           /etc/passwd and /etc/group, via the pwd and grp modules
+    RecordingExecutor  shell.do: records each command, and acts out the ones
+                       whose effects piccolo reads back (useradd, userdel,
+                       groupdel, gpasswd); the rest only get recorded
+    FakeServer         a MySQL or PostgreSQL admin connection, keeping the
+                       databases and roles it's told to create in SQLite
+
+File ownership can't be faked without root, so chown is skipped.
+"""
+
+logger = logging.getLogger('piccolo.shell') # so commands are logged just as shell.do logs them
+
+FIRST_ID = 100000
+
+class Accounts(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.users = {}
+        self.groups = {} # name -> [gid, set of member names]
+        self._next_id = FIRST_ID
+        self.add_group('root', 0)
+        self.add_group('admin', 4)
+        self.users['root'] = pwd.struct_passwd(('root', 'x', 0, 0, 'root', '/root', '/bin/bash'))
+
+    def add_group(self, name, gid=None):
+        with self._lock:
+            if gid is None:
+                gid = self._allocate()
+            self.groups[name] = [gid, set()]
+            return gid
+
+    def _allocate(self):
+        self._next_id += 1
+        return self._next_id
+
+    def add_user(self, name, home, login_shell):
+        gid = self.add_group(name)
+        with self._lock:
+            self.users[name] = pwd.struct_passwd((name, 'x', self._allocate(), gid, '', home, login_shell))
+
+    def getpwnam(self, name):
+        try:
+            return self.users[name]
+        except KeyError:
+            raise KeyError("getpwnam(): name not found: {0}".format(name))
+
+    def getpwuid(self, uid):
+        for entry in self.users.values():
+            if entry.pw_uid == uid:
+                return entry
+        raise KeyError("getpwuid(): uid not found: {0}".format(uid))
+
+    def getpwall(self):
+        return list(self.users.values())
+
+    def _group(self, name, gid, members):
+        return grp.struct_group((name, 'x', gid, sorted(members)))
+
+    def getgrnam(self, name):
+        try:
+            gid, members = self.groups[name]
+        except KeyError:
+            raise KeyError("getgrnam(): name not found: {0}".format(name))
+        return self._group(name, gid, members)
+
+    def getgrgid(self, gid):
+        for name, (group_id, members) in self.groups.items():
+            if group_id == gid:
+                return self._group(name, gid, members)
+        raise KeyError("getgrgid(): gid not found: {0}".format(gid))
+
+class RecordingExecutor(object):
+    '''Takes shell.do's place. Commands that would fail on a real host (deleting
+    a missing user, say) fail the same way.'''
+    def __init__(self, accounts):
+        self.accounts = accounts
+        self.counts = Counter()
+        self._actions = {
+            'useradd': self._useradd,
+            'userdel': self._userdel,
+            'groupdel': self._groupdel,
+            'gpasswd': self._gpasswd,
+        }
+
+    def __call__(self, command, **options):
+        logger.info("Executing shell command: %s", command)
+        if shell.is_pretend():
+            return
+        ignore_errors = options.get('ignore_errors', False)
+        args = command.split() if options.get('shell') else shlex.split(command)
+        self.counts[os.path.basename(args[0])] += 1
+        action = self._actions.get(os.path.basename(args[0]))
+        if action is None:
+            return
+        error = action(args[1:])
+        if error:
+            if not ignore_errors:
+                logger.error("Error executing {0}: {1}".format(command, error))
+            if not ((shell.is_forced() and not options.get('strict')) or ignore_errors):
+                raise shell.ShellActionFailed(command)
+
+    def _useradd(self, args):
+        base, login_shell, name = None, '/bin/sh', args[-1]
+        for flag, value in zip(args, args[1:]):
+            if flag == '-b':
+                base = value
+            elif flag == '-s':
+                login_shell = value
+        if name in self.accounts.users:
+            return "user '{0}' already exists".format(name)
+        home = os.path.join(base, name)
+        if '-m' in args and not os.path.isdir(home):
+            os.makedirs(home)
+        self.accounts.add_user(name, home, login_shell)
+
+    def _userdel(self, args):
+        name = args[-1]
+        account = self.accounts.users.pop(name, None)
+        if account is None:
+            return "user '{0}' does not exist".format(name)
+        self.accounts.groups.pop(name, None) # USERGROUPS_ENAB
+        for gid, members in self.accounts.groups.values():
+            members.discard(name)
+        if '-r' in args:
+            shutil.rmtree(account.pw_dir, ignore_errors=True)
+
+    def _groupdel(self, args):
+        if self.accounts.groups.pop(args[-1], None) is None:
+            return "group '{0}' does not exist".format(args[-1])
+
+    def _gpasswd(self, args):
+        flag, name, group = args[0], args[1], args[2]
+        if group not in self.accounts.groups or name not in self.accounts.users:
+            return "no user {0} or group {1}".format(name, group)
+        members = self.accounts.groups[group][1]
+        if flag == '-a':
+            members.add(name)
+        elif flag == '-d':
+            if name not in members:
+                return "user '{0}' is not a member of '{1}'".format(name, group)
+            members.discard(name)
+
+class FakeServer(object):
+    '''What piccolo asks a database server's admin connection, answered from
+    SQLite. Knows the statements piccolo sends; others succeed and do nothing.'''
+    class Error(Exception):
+        pass
+
+    _CREATE = re.compile(r"^CREATE (DATABASE|ROLE|USER) [`']?(\w+)", re.I)
+    _DROP = re.compile(r"^DROP (DATABASE|ROLE|USER) [`']?(\w+)", re.I)
+    _KINDS = {'database': 'database', 'role': 'role', 'user': 'role'}
+    _TABLES = (
+        ('database', ('INFORMATION_SCHEMA.SCHEMATA', 'pg_database', 'SHOW DATABASES')),
+        ('role', ('pg_roles', 'mysql.user')),
+    )
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(':memory:', check_same_thread=False)
+        self._db.execute("CREATE TABLE objects (kind TEXT, name TEXT, PRIMARY KEY (kind, name))")
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+    def execute(self, statement, params=()):
+        statement = statement.strip().rstrip(';')
+        self.counts[statement.split()[0].upper()] += 1
+        with self._lock:
+            match = self._CREATE.match(statement)
+            if match:
+                try:
+                    self._db.execute("INSERT INTO objects VALUES (?, ?)", (self._KINDS[match.group(1).lower()], match.group(2)))
+                except sqlite3.IntegrityError:
+                    raise FakeServer.Error("{0} {1} already exists".format(match.group(1).lower(), match.group(2)))
+                return []
+            match = self._DROP.match(statement)
+            if match:
+                if not self._db.execute("DELETE FROM objects WHERE kind = ? AND name = ?", (self._KINDS[match.group(1).lower()], match.group(2))).rowcount:
+                    raise FakeServer.Error("{0} {1} does not exist".format(match.group(1).lower(), match.group(2)))
+                return []
+            for kind, tables in self._TABLES:
+                if any(table in statement for table in tables):
+                    return self._select(kind, statement, params)
+            return []
+
+    def _select(self, kind, statement, params):
+        if ' IN %s' in statement:
+            names = list(params[0])
+            return self._db.execute("SELECT name FROM objects WHERE kind = ? AND name IN ({0})".format(
+                ', '.join('?' * len(names))), [kind] + names).fetchall()
+        if '= %s' in statement:
+            return self._db.execute("SELECT name FROM objects WHERE kind = ? AND name = ?", (kind, params[0])).fetchall()
+        return self._db.execute("SELECT name FROM objects WHERE kind = ?", (kind,)).fetchall()
+
+class FakeCursor(object):
+    def __init__(self, server):
+        self.server = server
+        self._rows = []
+
+    def execute(self, statement, params=()):
+        self._rows = self.server.execute(statement, params)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        pass
+
+class FakeAdminConnections(object):
+    '''Takes databases.admin_connections' place'''
+    def __init__(self):
+        self.servers = {Database.MYSQL: FakeServer('mysql'), Database.POSTGRESQL: FakeServer('postgresql')}
+
+    def get(self, dbms):
+        return self.servers[dbms]
+
+    def cursor(self, dbms):
+        return self.servers[dbms], self.servers[dbms].cursor()
+
+    def close_thread(self):
+        pass
+
+    def close_all(self):
+        pass
+
+def _skip_chown(path, uid, gid):
+    pass
+
+def install():
+    '''Puts the stand-ins in place. Returns (accounts, executor, connections).'''
+    accounts = Accounts()
+    for name in ('getpwnam', 'getpwuid', 'getpwall'):
+        setattr(pwd, name, getattr(accounts, name))
+    for name in ('getgrnam', 'getgrgid'):
+        setattr(grp, name, getattr(accounts, name))
+    os.chown = os.lchown = _skip_chown
+
+    executor = RecordingExecutor(accounts)
+    shell.do = executor
+    for module in (users, sites, nginx): # from piccolo.shell import do
+        module.do = executor
+
+    connections = FakeAdminConnections()
+    databases.admin_connections = connections
+    return accounts, executor, connections
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+import argparse, datetime, json, os, platform, shutil, subprocess, sys, tempfile, time
+
+"""
+Benchmarks piccolo's provisioning paths without touching the host: each size
+runs in its own process, with config pointed (through PICCOLO_CONFIG) at a
+temporary root and the host stood in for by benchmarks.fakes.
+
+    python -m benchmarks.run                       # 10, 1000 and 10000 sites
+    python -m benchmarks.run --sizes 10,1000 -o after.json --compare before.json
+
+At each size, piccolo's DB is first filled with that many sites (one domain
+and one member each) straight through SQL. Then each operation below runs
+--repeat times on sites and users of its own, as separate commands would: with
+a fresh DB session and lookup cache each time. Results give milliseconds per
+call and the shell commands and admin SQL statements each call made.
+"""
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SERVICES = ('httpd.sh', 'php.sh') # what Site._start runs from a site's bin/
+DEFAULT_SIZES = (10, 1000, 10000)
+OPERATIONS = ('Site.create', 'Site.addUser', 'Domain.create', 'status', 'Site.delete')
+SLOWER = 1.2 # --compare flags operations at least this much slower
+
+CONFIG = """[piccolo]
+data = {root}/data
+logs = {root}/logs
+users_root = {root}/users
+sites_root = {root}/sites
+nginx_conf_root = {root}/nginx
+sudoers_dir = {root}/sudoers.d
+templates = {root}/templates
+backups = {root}/backups
+default_domain = bench.example.edu
+[mysql]
+username = piccolo
+password = unused
+[postgresql]
+username = piccolo
+password = unused
+[email]
+username = piccolo@bench.example.edu
+password =
+smtp_server = localhost
+smtp_port = 25
+friendly_name = Piccolo benchmark
+starttls = false
+"""
+
+def _make_root():
+    root = tempfile.mkdtemp(prefix='piccolo-bench-')
+    for name in ('data', 'logs', 'users', 'sites', 'nginx', 'sudoers.d', 'backups'):
+        os.mkdir(os.path.join(root, name))
+    # The repo's templates, plus stubs for the per-site scripts a deployment
+    # provides itself (sudo is faked, so they're never run)
+    shutil.copytree(os.path.join(REPO_ROOT, 'templates'), os.path.join(root, 'templates'))
+    bin_dir = os.path.join(root, 'templates', 'site', 'bin')
+    if not os.path.isdir(bin_dir):
+        os.mkdir(bin_dir)
+    for service in SERVICES:
+        stub = os.path.join(bin_dir, service)
+        if not os.path.exists(stub):
+            with open(stub, 'w') as stub_file:
+                stub_file.write("#!/bin/sh\nexit 0\n")
+            os.chmod(stub, 0755)
+    path = os.path.join(root, 'piccolo.cfg')
+    with open(path, 'w') as config_file:
+        config_file.write(CONFIG.format(root=root))
+    os.chmod(path, 0600)
+    return root, path
+
+def _stats(samples):
+    ordered = sorted(samples)
+    count = len(ordered)
+    return {
+        'count': count,
+        'mean_ms': round(sum(ordered) / count * 1000, 3),
+        'median_ms': round(ordered[count // 2] * 1000, 3),
+        'p95_ms': round(ordered[min(count - 1, int(count * 0.95))] * 1000, 3),
+        'min_ms': round(ordered[0] * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+def _per_call(before, after, calls):
+    return dict((key, round(float(after[key] - before.get(key, 0)) / calls, 2))
+        for key in after if after[key] != before.get(key, 0))
+
+def measure(size, repeat, status_repeat):
+    '''Runs the benchmark at one size, in this process (whose PICCOLO_CONFIG
+    must already name a scratch root). Returns its results.'''
+    import logging
+    import piccolo.log
+    piccolo.log.ch.setLevel(logging.WARNING)
+    from benchmarks import fakes
+    from piccolo import db, nginx, shell
+    from piccolo.sites import Site, Domain, site_users
+    from piccolo.users import User
+    from piccolo.commands import status as status_command
+    import piccolo.journal, piccolo.mail, piccolo.usage
+
+    accounts, executor, connections = fakes.install()
+    db.Base.metadata.create_all(db.sqlite_db)
+
+    start = time.time()
+    users = ['bguser{0:05d}'.format(i) for i in range(max(1, size // 4))]
+    sites = ['bg{0:05d}'.format(i) for i in range(size)]
+    with db.sqlite_db.begin() as conn:
+        conn.execute(User.__table__.insert(), [
+            {'username': name, 'full_name': name, 'email': name + '@bench.example.edu'} for name in users])
+        conn.execute(Site.__table__.insert(), [
+            {'shortname': name, 'full_name': name, 'db_username': name, 'db_username_mysql': name, 'db_password': 'x'}
+            for name in sites])
+        conn.execute(Domain.__table__.insert(), [
+            {'domain_name': name + '.bench.example.edu', 'site_shortname': name} for name in sites])
+        conn.execute(site_users.insert(), [
+            {'site_shortname': name, 'user_username': users[i % len(users)]} for i, name in enumerate(sites)])
+    names = ['bench{0:04d}'.format(i) for i in range(repeat)]
+    User.create_many([(name + 'u', name, name + '@bench.example.edu') for name in names], suppress_welcome=True)
+    setup = time.time() - start
+
+    def fresh():
+        nginx.reload_if_dirty()
+        db.Session.remove()
+        db.clear_lookup_cache()
+
+    calls = {
+        'Site.create': lambda name: Site.create(name, name),
+        'Site.addUser': lambda name: Site.get(name).addUser(User.get(name + 'u')),
+        'Domain.create': lambda name: Domain.create('www.' + name + '.example.org', Site.get(name)),
+        'status': lambda name: status_command.status(argparse.Namespace(format='json', filter=None, limit=None)),
+        'Site.delete': lambda name: Site.delete(name),
+    }
+    results = {}
+    devnull = open(os.devnull, 'w')
+    for operation in OPERATIONS:
+        targets = names[:status_repeat] if operation == 'status' else names
+        samples = []
+        commands, statements = dict(executor.counts), {}
+        for dbms, server in connections.servers.items():
+            statements.update((server.name + ' ' + verb, count) for verb, count in server.counts.items())
+        for name in targets:
+            fresh()
+            stdout, sys.stdout = sys.stdout, devnull
+            started = time.time()
+            try:
+                calls[operation](name)
+            finally:
+                samples.append(time.time() - started)
+                sys.stdout = stdout
+        fresh()
+        after_statements = {}
+        for dbms, server in connections.servers.items():
+            after_statements.update((server.name + ' ' + verb, count) for verb, count in server.counts.items())
+        result = _stats(samples)
+        result['commands'] = _per_call(commands, executor.counts, len(targets))
+        result['statements'] = _per_call(statements, after_statements, len(targets))
+        results[operation] = result
+    return {'sites': size, 'users': len(users), 'repeat': repeat, 'setup_seconds': round(setup, 3), 'operations': results}
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _print_table(runs):
+    sys.stderr.write("\n{0:<16}".format("mean ms") + ''.join("{0:>12}".format("{0} sites".format(run['sites'])) for run in runs) + "\n")
+    for operation in OPERATIONS:
+        sys.stderr.write("{0:<16}".format(operation) + ''.join(
+            "{0:>12.2f}".format(run['operations'][operation]['mean_ms']) for run in runs) + "\n")
+
+def _compare(runs, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = dict((run['sites'], run) for run in json.load(baseline_file)['runs'])
+    sys.stderr.write("\nCompared with {0} (mean ms, before -> after):\n".format(baseline_path))
+    slower = 0
+    for run in runs:
+        before = baseline.get(run['sites'])
+        if before is None:
+            continue
+        for operation in OPERATIONS:
+            if operation not in before['operations']:
+                continue
+            old, new = before['operations'][operation]['mean_ms'], run['operations'][operation]['mean_ms']
+            ratio = new / old if old else float('inf')
+            flag = "  SLOWER" if ratio >= SLOWER else ""
+            slower += bool(flag)
+            sys.stderr.write("  {0:>6} sites  {1:<16}{2:>10.2f} -> {3:>10.2f}  ({4:.2f}x){5}\n".format(
+                run['sites'], operation, old, new, ratio, flag))
+    return slower
+
+parser = argparse.ArgumentParser(description="Benchmark piccolo against a scratch root, with the host faked")
+parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES), help="Comma-separated numbers of sites to fill the DB with")
+parser.add_argument('-r', '--repeat', type=int, default=20, help="Times to run each operation at each size")
+parser.add_argument('--status-repeat', type=int, default=3, help="Times to run status, which reads every site")
+parser.add_argument('-o', '--output', help="Where to save the results (default benchmark-<time>.json)")
+parser.add_argument('--compare', metavar='BASELINE', help="Earlier results to compare with; exits 1 if anything got slower")
+parser.add_argument('--keep', action='store_true', help="Keep the scratch roots")
+parser.add_argument('--worker', metavar='RESULT_FILE', help=argparse.SUPPRESS) # one size, in this process
+
+def main():
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.worker:
+        with open(args.worker, 'w') as result_file:
+            json.dump(measure(sizes[0], args.repeat, args.status_repeat), result_file)
+        return
+
+    runs = []
+    for size in sizes:
+        root, config_path = _make_root()
+        sys.stderr.write("Benchmarking with {0} sites in {1}\n".format(size, root))
+        result_path = os.path.join(root, 'result.json')
+        env = dict(os.environ, PICCOLO_CONFIG=config_path, PICCOLO_NO_DAEMON='1')
+        try:
+            subprocess.check_call([sys.executable, '-m', 'benchmarks.run', '--worker', result_path,
+                '--sizes', str(size), '--repeat', str(args.repeat), '--status-repeat', str(args.status_repeat)],
+                cwd=REPO_ROOT, env=env)
+            with open(result_path) as result_file:
+                runs.append(json.load(result_file))
+        finally:
+            if not args.keep:
+                shutil.rmtree(root, ignore_errors=True)
+
+    output = args.output or datetime.datetime.now().strftime('benchmark-%Y%m%d-%H%M%S.json')
+    with open(output, 'w') as output_file:
+        json.dump({
+            'created': datetime.datetime.now().isoformat(),
+            'commit': _commit(),
+            'python': platform.python_version(),
+            'host': platform.node(),
+            'runs': runs,
+        }, output_file, indent=2, sort_keys=True)
+    _print_table(runs)
+    sys.stderr.write("Saved results to {0}\n".format(output))
+    if args.compare and _compare(runs, args.compare):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
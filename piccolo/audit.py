@@ -0,0 +1,235 @@
+import logging, os, pwd, grp, time
+from sqlalchemy.orm import selectinload
+from piccolo import db, config, shell, parallel
+from piccolo.sites import Site
+from piccolo.users import User
+from piccolo.databases import Database
+
+"""
+Compares piccolo's inventory with what's actually on the host. Each kind of
+live state (accounts, groups, config dirs, DB roles...) is gathered in one go,
+with the independent gatherers running side by side, and then checked against
+the DB with set operations.
+"""
+
+logger = logging.getLogger(__name__)
+
+SUDOERS_DIR = config.SUDOERS_DIR
+CRONTAB_DIRS = ('/var/spool/cron/crontabs', '/var/spool/cron') # Debian, Red Hat
+
+# Things on the DB servers that piccolo never manages
+SYSTEM_DATABASES = {
+    Database.MYSQL: set(['information_schema', 'mysql', 'performance_schema', 'sys']),
+    Database.POSTGRESQL: set(['postgres']),
+}
+SYSTEM_MYSQL_USERS = set(['root', 'debian-sys-maint', 'mysql.sys', 'mysql.session', 'mysql.infoschema'])
+SYSTEM_POSTGRES_ROLES = set(['postgres'])
+
+class Finding(object):
+    def __init__(self, owner, message):
+        self.owner = owner # "site foo", "user bar", or None for orphans
+        self.message = message
+
+def _names(path):
+    '''Names of the entries in a directory, split into (files, directories)'''
+    files, dirs = set(), set()
+    for entry in shell.entries(path):
+        (dirs if entry.is_dir(follow_symlinks=False) else files).add(entry.name)
+    return files, dirs
+
+def _accounts():
+    return dict((entry.pw_name, entry.pw_dir) for entry in pwd.getpwall())
+
+def _groups():
+    return dict((entry.gr_name, set(entry.gr_mem)) for entry in grp.getgrall())
+
+def _sudoers():
+    return _names(SUDOERS_DIR)[0]
+
+def _crontabs():
+    for path in CRONTAB_DIRS:
+        if os.path.isdir(path):
+            return _names(path)[0]
+    raise IOError("No crontab spool in {0}".format(' or '.join(CRONTAB_DIRS)))
+
+def _nginx():
+    '''(site confs, {site: domain confs}) from NGINX_CONF_ROOT'''
+    files, dirs = _names(config.NGINX_CONF_ROOT)
+    confs = set(name[:-len('.conf')] for name in files if name.endswith('.conf'))
+    domains = {}
+    for name in dirs:
+        if name.endswith('_domains'):
+            domain_files = _names(shell.join(config.NGINX_CONF_ROOT, name))[0]
+            domains[name[:-len('_domains')]] = set(f[:-len('.conf')] for f in domain_files if f.endswith('.conf'))
+    return confs, domains
+
+def _site_homes():
+    return _names(config.SITES_ROOT)[1]
+
+def _user_homes():
+    return _names(config.USERS_ROOT)[1]
+
+def _postgresql():
+    '''(roles, databases) on the PostgreSQL server'''
+    conn, cur = Database._postgres()
+    try:
+        cur.execute("SELECT rolname FROM pg_roles WHERE rolname NOT LIKE 'pg\\_%';")
+        roles = set(row[0] for row in cur.fetchall())
+        cur.execute("SELECT datname FROM pg_database WHERE NOT datistemplate;")
+        return roles, set(row[0] for row in cur.fetchall())
+    finally:
+        cur.close()
+
+def _mysql():
+    '''(users @localhost, databases) on the MySQL server'''
+    conn, cur = Database._mysql()
+    try:
+        cur.execute("SELECT User FROM mysql.user WHERE Host = 'localhost';")
+        users = set(row[0] for row in cur.fetchall())
+        cur.execute("SHOW DATABASES;")
+        return users, set(row[0] for row in cur.fetchall())
+    finally:
+        cur.close()
+
+GATHERERS = (
+    ('accounts', _accounts),
+    ('groups', _groups),
+    ('sudoers', _sudoers),
+    ('crontabs', _crontabs),
+    ('nginx', _nginx),
+    ('site homes', _site_homes),
+    ('user homes', _user_homes),
+    ('postgresql', _postgresql),
+    ('mysql', _mysql),
+)
+
+def gather(workers=4):
+    '''Collects the live state, running independent gatherers side by side.
+    Returns ({name: state}, [names that couldn't be gathered]).'''
+    start = time.time()
+    gatherers = dict(GATHERERS)
+    results = parallel.run_each(lambda name: gatherers[name](), [name for name, gatherer in GATHERERS], workers=workers)
+    live, unavailable = {}, []
+    for r in results:
+        logger.debug("Gathered {0} in {1:.3f}s".format(r.item, r.elapsed))
+        if r.ok:
+            live[r.item] = r.value
+        else:
+            unavailable.append(r.item)
+    logger.debug("Gathered live state in {0:.3f}s".format(time.time() - start))
+    return live, unavailable
+
+def _check_site(s, live):
+    '''What's missing or extra on the host for one site'''
+    problems = []
+    def check(category, present, what):
+        if category in live and not present(live[category]):
+            problems.append("missing " + what)
+    name = s.shortname
+    check('accounts', lambda accounts: name in accounts, "unix account")
+    check('groups', lambda groups: name in groups, "unix group")
+    check('site homes', lambda homes: name in homes, "home folder " + s._get_home())
+    check('sudoers', lambda sudoers: name in sudoers, "sudoers file")
+    check('crontabs', lambda crontabs: name in crontabs, "crontab")
+    check('nginx', lambda nginx: name in nginx[0], "nginx config")
+    check('nginx', lambda nginx: name in nginx[1], "nginx domains folder")
+    check('postgresql', lambda pg: s.db_username in pg[0], "PostgreSQL role " + s.db_username)
+    check('mysql', lambda my: s.db_username_mysql in my[0], "MySQL user " + s.db_username_mysql)
+
+    if 'groups' in live and name in live['groups']:
+        expected = set(u.username for u in s.users)
+        members = live['groups'][name]
+        if expected - members:
+            problems.append("not in group: " + ', '.join(sorted(expected - members)))
+        if members - expected:
+            problems.append("in group but not in piccolo: " + ', '.join(sorted(members - expected)))
+    if 'nginx' in live and name in live['nginx'][1]:
+        expected = set(d.domain_name for d in s.domains)
+        present = live['nginx'][1][name]
+        if expected - present:
+            problems.append("missing domain configs: " + ', '.join(sorted(expected - present)))
+        if present - expected:
+            problems.append("domain configs not in piccolo: " + ', '.join(sorted(present - expected)))
+    for database in s.databases:
+        server = 'mysql' if database.dbms == Database.MYSQL else 'postgresql'
+        if server in live and database.dbname not in live[server][1]:
+            problems.append("missing {0} database {1}".format(database._dbms_string(), database.dbname))
+    return problems
+
+def _check_user(u, live):
+    problems = []
+    if 'accounts' in live and u.username not in live['accounts']:
+        problems.append("missing unix account")
+    if 'user homes' in live and u.username not in live['user homes']:
+        problems.append("missing home folder " + u._get_home())
+    return problems
+
+def _orphans(sites, users, databases, live):
+    '''Things on the host that look like piccolo's but that it doesn't know about'''
+    site_names = set(s.shortname for s in sites)
+    user_names = set(u.username for u in users)
+    findings = []
+    def report(what, names):
+        if names:
+            findings.append(Finding(None, "{0} not in piccolo: {1}".format(what, ', '.join(sorted(names)))))
+
+    homed_sites = set()
+    if 'accounts' in live:
+        sites_root = config.SITES_ROOT.rstrip('/') + '/'
+        users_root = config.USERS_ROOT.rstrip('/') + '/'
+        homed_sites = set(name for name, home in live['accounts'].items() if home.startswith(sites_root))
+        homed_users = set(name for name, home in live['accounts'].items() if home.startswith(users_root))
+        report("Site accounts", homed_sites - site_names)
+        report("User accounts", homed_users - user_names)
+    if 'site homes' in live:
+        report("Site folders", live['site homes'] - site_names)
+    if 'user homes' in live:
+        report("User folders", live['user homes'] - user_names)
+    if 'nginx' in live:
+        report("nginx configs", live['nginx'][0] - site_names)
+        report("nginx domain folders", set(live['nginx'][1]) - site_names)
+    # sudoers.d and the crontab spool hold other people's files too, so only
+    # count the ones named for a site account or folder
+    site_like = homed_sites | live.get('site homes', set())
+    if 'sudoers' in live:
+        report("Sudoers files", (live['sudoers'] & site_like) - site_names)
+    if 'crontabs' in live:
+        report("Crontabs", (live['crontabs'] & site_like) - site_names)
+
+    known = {Database.MYSQL: set(), Database.POSTGRESQL: set()}
+    for database in databases:
+        known[database.dbms].add(database.dbname)
+    if 'postgresql' in live:
+        roles, dbnames = live['postgresql']
+        expected_roles = set(s.db_username for s in sites) | SYSTEM_POSTGRES_ROLES | set([config.POSTGRESQL['username']])
+        report("PostgreSQL roles", roles - expected_roles)
+        report("PostgreSQL databases", dbnames - known[Database.POSTGRESQL] - SYSTEM_DATABASES[Database.POSTGRESQL])
+    if 'mysql' in live:
+        mysql_users, dbnames = live['mysql']
+        expected_users = set(s.db_username_mysql for s in sites) | SYSTEM_MYSQL_USERS | set([config.MYSQL['username']])
+        report("MySQL users", mysql_users - expected_users)
+        report("MySQL databases", dbnames - known[Database.MYSQL] - SYSTEM_DATABASES[Database.MYSQL])
+    return findings
+
+def audit(workers=4):
+    '''Returns a Finding for each difference between piccolo's DB and the host,
+    and the names of the kinds of live state that couldn't be checked'''
+    live, unavailable = gather(workers)
+    session = db.Session()
+    sites = session.query(Site).options(
+        selectinload(Site.users),
+        selectinload(Site.databases),
+        selectinload(Site.domains),
+    ).order_by(Site.shortname).all()
+    users = session.query(User).order_by(User.username).all()
+    databases = [database for s in sites for database in s.databases]
+
+    findings = []
+    for s in sites:
+        for problem in _check_site(s, live):
+            findings.append(Finding("site " + s.shortname, problem))
+    for u in users:
+        for problem in _check_user(u, live):
+            findings.append(Finding("user " + u.username, problem))
+    findings.extend(_orphans(sites, users, databases, live))
+    return findings, unavailable
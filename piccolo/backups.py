@@ -0,0 +1,182 @@
+import datetime, errno, gzip, json, logging, os, stat, time, urllib
+from piccolo import config, shell, parallel
+
+"""
+Incremental snapshots of site homes and databases, in BACKUP_ROOT/<site>/<time>/:
+
+    manifest.json       every entry's type, mode, owner, size and mtime, by
+                        path (percent-escaped, so any name survives JSON)
+    files/<path>.gz     each regular file, gzipped
+    databases/<db>.gz   a dump of each of the site's databases
+
+A file whose size and mtime match the previous snapshot's manifest is
+hardlinked from it instead of being read and compressed again, so an unchanged
+site costs one lstat per entry and no extra space. Changed files are
+compressed on a process pool. Snapshots are built under <time>.partial and only
+renamed into place once complete.
+"""
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+PARTIAL = '.partial'
+COMPRESS_LEVEL = 6
+_UNESCAPED = ''.join(chr(c) for c in range(0x20, 0x7f) if chr(c) != '%') # printable ASCII
+
+def _escape(path):
+    '''A path (bytes, in whatever encoding the site used) as a manifest string.
+    Lossless: unquoting it gives back the same bytes.'''
+    return urllib.quote(path, safe=_UNESCAPED)
+
+def _site_dir(shortname):
+    return shell.join(config.BACKUP_ROOT, shortname)
+
+def snapshots(shortname):
+    '''Names of a site's complete snapshots, oldest first'''
+    try:
+        names = os.listdir(_site_dir(shortname))
+    except OSError:
+        return []
+    return sorted(name for name in names if not name.endswith(PARTIAL))
+
+def _compress(job):
+    '''Gzips one file (in a pool process), reading at no more than `rate` bytes
+    per second. Returns (manifest key, compressed size, error).'''
+    key, src, dest, rate = job
+    throttle = shell.Throttle(rate) if rate else None
+    try:
+        with open(src, 'rb') as source:
+            compressed = gzip.open(dest, 'wb', COMPRESS_LEVEL)
+            try:
+                for chunk in iter(lambda: source.read(shell.COPY_BUFFER_SIZE), ''):
+                    compressed.write(chunk)
+                    if throttle is not None:
+                        throttle.consume(len(chunk))
+            finally:
+                compressed.close()
+        return key, os.path.getsize(dest), None
+    except (IOError, OSError) as e:
+        try:
+            os.unlink(dest)
+        except OSError:
+            pass
+        return key, 0, e
+
+def _ensure_private_dir(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+        os.chmod(path, 0700)
+
+def _dump(database, destination, throttle):
+    with open(destination, 'wb') as out:
+        return database.dump(out, throttle)
+
+def snapshot(site, pool, processes, max_io=None, dump_workers=2):
+    '''Takes an incremental snapshot of a site's home and databases, compressing
+    changed files on `pool` (which has `processes` processes). max_io, in bytes
+    per second, caps the reading done for the snapshot. Returns a dict of
+    statistics.'''
+    logger.info("Backing up {0}".format(site.shortname))
+    stats = {'site': site.shortname, 'files': 0, 'linked': 0, 'compressed': 0,
+        'bytes_read': 0, 'bytes_stored': 0, 'databases': 0, 'errors': 0}
+    if shell.is_pretend():
+        return stats
+    start = time.time()
+    # Paths as bytes throughout, so names in any encoding are walked and stored as they are
+    site_dir = _site_dir(site.shortname.encode('utf-8'))
+    _ensure_private_dir(config.BACKUP_ROOT)
+    _ensure_private_dir(site_dir)
+    for name in os.listdir(site_dir):
+        if name.endswith(PARTIAL): # left by a backup that didn't finish
+            shell.rmtree(shell.join(site_dir, name))
+
+    previous = snapshots(site.shortname.encode('utf-8'))
+    previous_dir = shell.join(site_dir, previous[-1]) if previous else None
+    previous_files = {}
+    if previous_dir:
+        with open(shell.join(previous_dir, MANIFEST)) as manifest_file:
+            previous_files = json.load(manifest_file)['files']
+
+    name = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    while name in previous:
+        name += '-1'
+    work = shell.join(site_dir, name + PARTIAL)
+    os.mkdir(work)
+    os.mkdir(shell.join(work, 'files'))
+    os.mkdir(shell.join(work, 'databases'))
+
+    # Databases first, several at once, sharing the I/O budget
+    throttle = shell.Throttle(max_io) if max_io else None
+    databases = list(site.databases)
+    results = parallel.run_each(
+        lambda database: _dump(database, shell.join(work, 'databases', database.dbname + '.gz'), throttle),
+        databases, workers=dump_workers)
+    dumped = []
+    for r in results:
+        if r.ok:
+            dumped.append({'dbname': r.item.dbname, 'dbms': r.item._dbms_string(), 'bytes': r.value})
+            stats['bytes_stored'] += r.value
+        else:
+            stats['errors'] += 1
+    stats['databases'] = len(dumped)
+
+    # Then the files: hardlink what hasn't changed, compress the rest
+    home = site._get_home().encode('utf-8')
+    prefix = len(home.rstrip('/')) + 1
+    files = {}
+    jobs = []
+    rate = max_io / processes if max_io else None
+    for entry in shell.walk_entries(home):
+        relpath = entry.path[prefix:]
+        key = _escape(relpath)
+        try:
+            st = entry.stat(follow_symlinks=False)
+            if stat.S_ISDIR(st.st_mode):
+                os.mkdir(shell.join(work, 'files', relpath))
+                files[key] = ['d', st.st_mode, st.st_uid, st.st_gid]
+            elif stat.S_ISLNK(st.st_mode):
+                files[key] = ['l', st.st_mode, st.st_uid, st.st_gid, _escape(os.readlink(entry.path))]
+            elif stat.S_ISREG(st.st_mode):
+                record = ['f', st.st_mode, st.st_uid, st.st_gid, st.st_size, st.st_mtime]
+                stored = shell.join(work, 'files', relpath + '.gz')
+                files[key] = record
+                stats['files'] += 1
+                if previous_files.get(key) == record:
+                    try:
+                        os.link(shell.join(previous_dir, 'files', relpath + '.gz'), stored)
+                        stats['linked'] += 1
+                        continue
+                    except OSError:
+                        pass # missing from the last snapshot, or too many links; store it afresh
+                jobs.append((key, entry.path, stored, rate))
+                stats['bytes_read'] += st.st_size
+        except OSError as e:
+            if e.errno != errno.ENOENT: # deleted while we walked
+                logger.warning("Couldn't back up {0}: {1}".format(entry.path, e))
+                stats['errors'] += 1
+            files.pop(key, None)
+
+    for key, size, error in pool.imap_unordered(_compress, jobs, chunksize=8):
+        if error is None:
+            stats['compressed'] += 1
+            stats['bytes_stored'] += size
+        else:
+            files.pop(key)
+            if getattr(error, 'errno', None) != errno.ENOENT:
+                logger.warning("Couldn't back up {0}: {1}".format(key, error))
+                stats['errors'] += 1
+
+    with open(shell.join(work, MANIFEST), 'w') as manifest_file:
+        json.dump({
+            'site': site.shortname,
+            'created': name,
+            'previous': previous[-1] if previous else None,
+            'databases': dumped,
+            'files': files,
+        }, manifest_file)
+    os.rename(work, shell.join(site_dir, name))
+    stats['snapshot'] = shell.join(site_dir, name)
+    stats['elapsed'] = time.time() - start
+    logger.info("Backed up {0} to {1}: {2} files ({3} unchanged, {4} compressed), {5} databases in {6:.2f}s".format(
+        site.shortname, stats['snapshot'], stats['files'], stats['linked'], stats['compressed'], stats['databases'], stats['elapsed']))
+    return stats
@@ -0,0 +1,18 @@
+from piccolo import audit
+import logging, sys, time
+logger = logging.getLogger(__name__)
+
+def run(args):
+    start = time.time()
+    findings, unavailable = audit.audit(workers=args.jobs)
+    for name in unavailable:
+        logger.warning("Couldn't check {0}; see above".format(name))
+    owner = None
+    for finding in findings:
+        if finding.owner != owner:
+            owner = finding.owner
+            logger.info("{0}:".format(owner or "Orphans"))
+        logger.warning("\t{0}".format(finding.message))
+    logger.info("Audit finished in {0:.2f}s: {1} differences found".format(time.time() - start, len(findings)))
+    if findings or unavailable:
+        sys.exit(1)
@@ -0,0 +1,57 @@
+from piccolo import backups, usage, db
+from piccolo.usage import format_size
+from piccolo.sites import Site
+from sqlalchemy.orm import selectinload
+import logging, sys, time, multiprocessing
+logger = logging.getLogger(__name__)
+
+def _back_up(sites, args):
+    max_io = usage.parse_size(args.max_io) if args.max_io else None
+    processes = args.jobs or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    start = time.time()
+    failed = []
+    try:
+        totals = {}
+        for s in sites:
+            try:
+                stats = backups.snapshot(s, pool, processes, max_io=max_io, dump_workers=args.db_jobs)
+            except Exception:
+                logger.exception("Could not back up {0}".format(s.shortname))
+                failed.append(s.shortname)
+                continue
+            if stats['errors']:
+                failed.append(s.shortname)
+            for key in ('files', 'linked', 'compressed', 'bytes_read', 'bytes_stored', 'databases'):
+                totals[key] = totals.get(key, 0) + stats[key]
+    finally:
+        pool.close()
+        pool.join()
+    if len(sites) > 1:
+        logger.info("Backed up {0} sites in {1:.2f}s: {2} files ({3} unchanged), read {4}, stored {5}, {6} databases".format(
+            len(sites) - len(failed), time.time() - start, totals.get('files', 0), totals.get('linked', 0),
+            format_size(totals.get('bytes_read', 0)), format_size(totals.get('bytes_stored', 0)), totals.get('databases', 0)))
+    if failed:
+        logger.error("Incomplete backups: {0}".format(', '.join(failed)))
+        sys.exit(1)
+
+def site_backup(args):
+    s = Site.get(args.shortname)
+    if not s:
+        logger.error("There is no site named {0}".format(args.shortname))
+        sys.exit(1)
+    _back_up([s], args)
+
+def run(args):
+    if not args.all and not args.shortnames:
+        logger.error("Name the sites to back up, or use --all")
+        sys.exit(1)
+    q = db.Session().query(Site).options(selectinload(Site.databases)).order_by(Site.shortname)
+    if not args.all:
+        q = q.filter(Site.shortname.in_(args.shortnames))
+    sites = q.all()
+    missing = set(args.shortnames or []) - set(s.shortname for s in sites)
+    if missing:
+        logger.error("No such sites: {0}".format(', '.join(sorted(missing))))
+        sys.exit(1)
+    _back_up(sites, args)
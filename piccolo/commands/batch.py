@@ -0,0 +1,93 @@
+from piccolo import db, shell
+import logging, shlex, sys, time, threading
+logger = logging.getLogger(__name__)
+
+class _ErrorCounter(logging.Handler):
+    '''Counts ERROR (and worse) records logged by this thread, so we can tell
+    whether a command failed even when its action caught the exception and
+    only logged it'''
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.count = 0
+        self.thread = threading.current_thread().ident
+    
+    def emit(self, record):
+        if record.thread == self.thread:
+            self.count += 1
+
+def _read_commands(path):
+    if path == '-':
+        source = sys.stdin
+    else:
+        source = open(path, 'r')
+    try:
+        for lineno, line in enumerate(source, 1):
+            argv = shlex.split(line, comments=True)
+            if argv and argv[0] == 'piccolo':
+                argv = argv[1:]
+            if argv:
+                yield lineno, line.strip(), argv
+    finally:
+        if source is not sys.stdin:
+            source.close()
+
+def _run_one(argv, outer_pretend, outer_force):
+    from piccolo.commands.parser import parser, set_flags
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit:
+        logger.error("Could not parse command")
+        return
+    if getattr(args.action, 'command', None) == 'batch.run':
+        logger.error("Batches cannot be nested")
+        return
+    args.pretend = args.pretend or outer_pretend
+    args.force = args.force or outer_force
+    set_flags(args)
+    db.clear_lookup_cache()
+    try:
+        args.action(args)
+    except SystemExit as e:
+        if e.code:
+            logger.error("Command exited with status {0}".format(e.code))
+    except:
+        logger.exception("Command raised an unhandled exception")
+
+def run(args):
+    outer_pretend, outer_force = shell.is_pretend(), shell.is_forced()
+    counter = _ErrorCounter()
+    logging.getLogger().addHandler(counter)
+    results = []
+    started = time.time()
+    try:
+        for lineno, line, argv in _read_commands(args.file):
+            logger.info("[line {0}] piccolo {1}".format(lineno, line))
+            errors_before = counter.count
+            command_start = time.time()
+            _run_one(argv, outer_pretend, outer_force)
+            elapsed = time.time() - command_start
+            ok = counter.count == errors_before
+            results.append((lineno, line, ok, elapsed))
+            if not ok:
+                # Start the next command from a clean session
+                db.Session.rollback()
+                logger.error("[line {0}] FAILED after {1:.2f}s".format(lineno, elapsed))
+                if args.stop_on_error:
+                    break
+            else:
+                logger.info("[line {0}] ok ({1:.2f}s)".format(lineno, elapsed))
+    finally:
+        logging.getLogger().removeHandler(counter)
+        shell.set_flags(outer_pretend, outer_force)
+    
+    failed = [r for r in results if not r[2]]
+    logger.info("Batch finished: {0} commands, {1} succeeded, {2} failed in {3:.2f}s".format(
+        len(results),
+        len(results) - len(failed),
+        len(failed),
+        time.time() - started,
+    ))
+    for lineno, line, ok, elapsed in results:
+        print "{0:>5} {1:<6} {2:>8.2f}s  {3}".format(lineno, "ok" if ok else "FAILED", elapsed, line)
+    if failed:
+        sys.exit(1)
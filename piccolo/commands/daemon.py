@@ -0,0 +1,10 @@
+import logging, os, sys
+from piccolo import daemon
+
+logger = logging.getLogger(__name__)
+
+def serve(args):
+    if os.geteuid() != 0 and not args.pretend:
+        logger.error("piccolod has to run as root")
+        sys.exit(1)
+    daemon.Daemon(args.workers).serve()
@@ -0,0 +1,32 @@
+from piccolo import mail, db
+from piccolo.mail import Message
+from sqlalchemy import func
+import logging
+logger = logging.getLogger(__name__)
+
+def flush(args):
+    sent, deferred, failed = mail.flush(limit=args.limit)
+    logger.info("Sent {0} emails ({1} to retry later, {2} failed)".format(sent, deferred, failed))
+
+def status(args):
+    db.ensure_tables(Message)
+    session = db.Session()
+    counts = dict(session.query(Message.status, func.count(Message.id)).group_by(Message.status))
+    logger.info("Outbox: {0} queued, {1} sending, {2} sent, {3} failed".format(
+        counts.get(Message.QUEUED, 0),
+        counts.get(Message.SENDING, 0),
+        counts.get(Message.SENT, 0),
+        counts.get(Message.FAILED, 0),
+    ))
+    pending = session.query(Message).filter(Message.status.in_((Message.QUEUED, Message.SENDING, Message.FAILED))).order_by(Message.id).limit(args.limit)
+    for message in pending:
+        line = "  #{0} [{1}] {2} -> {3} (attempts: {4})".format(message.id, message.status, message.subject, message.recipient, message.attempts)
+        if message.status == Message.QUEUED and message.attempts:
+            line += ", next attempt {0:%Y-%m-%d %H:%M:%S} UTC".format(message.next_attempt)
+        if message.last_error:
+            line += ": " + message.last_error
+        logger.info(line)
+
+def retry(args):
+    count = mail.retry_failed()
+    logger.info("Queued {0} failed emails to be sent again".format(count))
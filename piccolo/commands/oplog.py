@@ -0,0 +1,30 @@
+from piccolo import oplog
+import logging, sys, json
+logger = logging.getLogger(__name__)
+
+def _describe(entry):
+    event = entry.get('event')
+    if event in ('step', 'end'):
+        detail = "{0} {1:.2f}s".format(entry['outcome'], entry['duration'])
+        what = entry['step'] if event == 'step' else entry['command']
+    elif event == 'start':
+        detail, what = "started", entry['command']
+    else:
+        detail, what = entry['level'].lower(), entry['msg']
+    return "{0}  {1}  {2:<24} {3:<6} {4:<12} {5}".format(
+        entry['ts'][:19].replace('T', ' '), entry['op'], entry.get('target') or '-', event, detail, what)
+
+def show(args):
+    try:
+        since = oplog.parse_since(args.since)
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
+    target = 'site:' + args.site if args.site else 'user:' + args.user if args.user else None
+    for entry in oplog.query(since, target=target, op=args.op):
+        if args.steps and entry.get('event') == 'log':
+            continue
+        if args.json:
+            sys.stdout.write(json.dumps(entry, sort_keys=True) + '\n')
+        else:
+            print _describe(entry)
@@ -1,15 +1,48 @@
-import argparse, logging
-from piccolo import config
-from piccolo.commands import sites, users, status
+import sys
+if '--startup-profile' in sys.argv:
+    from piccolo import startup
+    startup.install()
+
+import argparse, logging, importlib, contextlib, os
+import piccolo.log
+from piccolo import config, shell, oplog
+from piccolo.shell import ShellActionFailed
 
 logger = logging.getLogger(__name__)
 
+# Commands that don't change anything provisioned, and so can run alongside anything
+READ_ONLY_COMMANDS = (
+    'status.status',
+    'status.list_users',
+    'status.list_sites',
+    'sites.status',
+    'audit.run',
+    'usage.run',
+    'oplog.show',
+)
+
+def command(name):
+    '''Refers to an action in piccolo.commands (e.g. "sites.create") without
+    importing its module, and so the model and DB drivers, until it runs'''
+    module_name, function_name = name.split('.')
+    def load():
+        return importlib.import_module('piccolo.commands.' + module_name)
+    def action(args):
+        return getattr(load(), function_name)(args)
+    action.command = name
+    action.load = load
+    return action
+
 parser = argparse.ArgumentParser(
     description='Command line interface to the Piccolo provisioning tool',
     epilog='For additional help on targets, try piccolo targetname -h',
 )
 parser.add_argument('-p', '--pretend', action='store_true', help="Pretend to run the command, but don't make any changes")
 parser.add_argument('-f', '--force', action='store_true', help="Ignore failed shell actions and force completion of command")
+parser.add_argument('--startup-profile', action='store_true', help="Print how long each module took to import, then run the command")
+parser.add_argument('--profile', action='store_true', help="Time shell commands, queries, email and waits, and print where the time went")
+parser.add_argument('--trace', metavar='FILE', help="With --profile, also write a Chrome trace (chrome://tracing, ui.perfetto.dev) to FILE")
+parser.add_argument('--local', action='store_true', help="Run the command in this process even if piccolod is running")
 
 subparsers = parser.add_subparsers(help="things you can change with Piccolo")
 
@@ -22,22 +55,35 @@ site_sub = site.add_subparsers(help="site command")
 
 site_create = site_sub.add_parser("create")
 site_create.add_argument('full_name', help="Full name of the site, quoted (club or organization)")
-site_create.set_defaults(action=sites.create)
+site_create.set_defaults(action=command("sites.create"))
 
 site_delete = site_sub.add_parser("delete")
-site_delete.set_defaults(action=sites.delete)
+site_delete.set_defaults(action=command("sites.delete"))
 
 site_status = site_sub.add_parser("status")
-site_status.set_defaults(action=sites.status)
+site_status.set_defaults(action=command("sites.status"))
+
+site_resume = site_sub.add_parser("resume", help="Finish creating a site (and its domains) whose provisioning failed partway; users need no resuming, since a failed user create removes itself")
+site_resume.set_defaults(action=command("sites.resume"))
+
+site_rollback = site_sub.add_parser("rollback", help="Undo the steps a site's failed provisioning started, last first")
+site_rollback.set_defaults(action=command("sites.rollback"))
 
 site_adduser = site_sub.add_parser("adduser")
 site_adduser.add_argument('username', help="username")
 site_adduser.add_argument('-n', '--no-email', action='store_true', help="Suppress the automatic welcome email")
-site_adduser.set_defaults(action=sites.adduser)
+site_adduser.set_defaults(action=command("sites.adduser"))
 
 site_removeuser = site_sub.add_parser("removeuser")
 site_removeuser.add_argument('username', help="username")
-site_removeuser.set_defaults(action=sites.removeuser)
+site_removeuser.set_defaults(action=command("sites.removeuser"))
+
+site_fix_perms = site_sub.add_parser("fix-perms", help="Restore the modes and ownership of everything in the site's home")
+site_fix_perms.set_defaults(action=command("sites.fix_perms"))
+
+site_usage = site_sub.add_parser("usage", help="Show (and optionally limit) the site's disk usage")
+site_usage.add_argument("--threshold", help="Warn when the site uses more than this (e.g. 500M, 2G; none to clear)")
+site_usage.set_defaults(action=command("usage.site_usage"))
 
 # Domain Management
 
@@ -46,10 +92,10 @@ site_domain.add_argument("domain_name")
 
 domain_sub = site_domain.add_subparsers(help="domain command")
 domain_add = domain_sub.add_parser("add")
-domain_add.set_defaults(action=sites.domain_add)
+domain_add.set_defaults(action=command("sites.domain_add"))
 
 domain_remove = domain_sub.add_parser("remove")
-domain_remove.set_defaults(action=sites.domain_remove)
+domain_remove.set_defaults(action=command("sites.domain_remove"))
 
 # DB Management
 
@@ -59,17 +105,74 @@ site_db.add_argument("database_name")
 db_sub = site_db.add_subparsers(help="database command")
 
 db_create = db_sub.add_parser("create")
-db_create.set_defaults(action=sites.db_create)
+db_create.set_defaults(action=command("sites.db_create"))
 db_create.add_argument("-d", "--dbms", help="Database system to use for this db (mysql or postgresql)", required=True)
 db_create.add_argument("-k", "--fake-create", action="store_true", help="Ignore existing db with this name (for adding existing dbs to piccolo)")
 
 db_delete = db_sub.add_parser("delete")
-db_delete.set_defaults(action=sites.db_delete)
+db_delete.set_defaults(action=command("sites.db_delete"))
+
+db_dump = db_sub.add_parser("dump", help="Write a gzipped dump of the database")
+db_dump.add_argument("file", nargs="?", help="Where to write it (- for stdout; default database_name.sql.gz)")
+db_dump.add_argument("--max-io", metavar="RATE", help="Take at most this much dump output per second, before compression (e.g. 20M)")
+db_dump.set_defaults(action=command("sites.db_dump"))
+
+db_restore = db_sub.add_parser("restore", help="Load a gzipped dump into the database, as the site's own database user")
+db_restore.add_argument("file", help="Dump to load (- for stdin)")
+db_restore.add_argument("--max-io", metavar="RATE", help="Read at most this much per second (e.g. 20M)")
+db_restore.set_defaults(action=command("sites.db_restore"))
+
+site_dbs = site_sub.add_parser("dbs", help="operations on several databases at once")
+dbs_sub = site_dbs.add_subparsers(help="databases command")
+
+dbs_create = dbs_sub.add_parser("create", help="Create several databases in one go")
+dbs_create.add_argument("database_names", nargs="+", metavar="database_name")
+dbs_create.add_argument("-d", "--dbms", help="Database system to use for these dbs (mysql or postgresql)", required=True)
+dbs_create.add_argument("-k", "--fake-create", action="store_true", help="Take over existing dbs with these names (for adding existing dbs to piccolo)")
+dbs_create.set_defaults(action=command("sites.db_create_many"))
+
+dbs_dump = dbs_sub.add_parser("dump", help="Dump several of the site's databases at once")
+dbs_dump.add_argument("database_names", nargs="*", metavar="database_name", help="Databases to dump (default: all of the site's)")
+dbs_dump.add_argument("-o", "--output-dir", default=".", help="Folder to write database_name.sql.gz files into")
+dbs_dump.add_argument("-j", "--jobs", type=int, default=4, help="Number of databases to dump at once")
+dbs_dump.add_argument("--max-io", metavar="RATE", help="Take at most this much dump output per second, before compression, in total (e.g. 20M)")
+dbs_dump.set_defaults(action=command("sites.db_dump_many"))
 
 # Backups
 
-# site_backup = site_sub.add_parser("backup")
-# site_backup.set_defaults(action=sites.backup)
+def add_backup_options(parser):
+    parser.add_argument("--max-io", metavar="RATE", help="Read at most this much per second (e.g. 20M)")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of processes compressing files (default: one per CPU)")
+    parser.add_argument("--db-jobs", type=int, default=2, help="Number of databases to dump at once")
+
+site_backup = site_sub.add_parser("backup", help="Take an incremental snapshot of the site's files and databases")
+add_backup_options(site_backup)
+site_backup.set_defaults(action=command("backups.site_backup"))
+
+backup_parser = subparsers.add_parser("backup", help="Take incremental snapshots of several sites")
+backup_parser.add_argument("shortnames", nargs="*", metavar="shortname")
+backup_parser.add_argument("--all", action="store_true", help="Back up every site")
+add_backup_options(backup_parser)
+backup_parser.set_defaults(action=command("backups.run"))
+
+# Bulk site management
+
+sites_parser = subparsers.add_parser("sites", help="operations on many sites at once")
+sites_sub = sites_parser.add_subparsers(help="sites command")
+
+sites_create_many = sites_sub.add_parser("create-many", help="Create every site listed in a CSV (shortname,full_name) or JSON file")
+sites_create_many.add_argument("file", help="Site list file (- for stdin)")
+sites_create_many.add_argument("-j", "--jobs", type=int, default=4, help="Number of sites to work on at once")
+sites_create_many.set_defaults(action=command("sites.create_many"))
+
+sites_delete_many = sites_sub.add_parser("delete-many", help="Delete every site listed in a CSV or JSON file")
+sites_delete_many.add_argument("file", help="Site list file (- for stdin)")
+sites_delete_many.add_argument("-j", "--jobs", type=int, default=4, help="Number of sites to work on at once")
+sites_delete_many.set_defaults(action=command("sites.delete_many"))
+
+sites_fix_perms = sites_sub.add_parser("fix-perms", help="Restore the modes and ownership of every site's files")
+sites_fix_perms.add_argument("-j", "--jobs", type=int, default=4, help="Number of sites to work on at once")
+sites_fix_perms.set_defaults(action=command("sites.fix_perms_all"))
 
 # User management
 
@@ -83,40 +186,155 @@ user_create.add_argument("full_name", help="full name")
 user_create.add_argument("email", help="contact email address")
 user_create.add_argument('-n', '--no-email', action='store_true', help="Suppress the automatic welcome email")
 user_create.add_argument("-k", "--fake-create", action="store_true", help="Ignore existing user with this name (for adding existing users to piccolo)")
-user_create.set_defaults(action=users.create)
+user_create.set_defaults(action=command("users.create"))
 
 user_delete = user_sub.add_parser("delete")
-user_delete.set_defaults(action=users.delete)
+user_delete.set_defaults(action=command("users.delete"))
+
+users_parser = subparsers.add_parser("users", help="operations on many users at once")
+users_sub = users_parser.add_subparsers(help="users command")
+
+users_import = users_sub.add_parser("import", help="Create every user listed in a CSV (username,full_name,email) or JSON file")
+users_import.add_argument("file", help="User list file (- for stdin)")
+users_import.add_argument('-n', '--no-email', action='store_true', help="Suppress the automatic welcome emails")
+users_import.set_defaults(action=command("users.import_users"))
+
+def add_listing_options(listing_parser):
+    listing_parser.add_argument("--format", choices=("table", "json", "csv"), default="table", help="Output format (default: table)")
+    listing_parser.add_argument("--limit", type=int, help="Show at most this many rows")
+    listing_parser.add_argument("--filter", help="Only show names matching this pattern (* and ? wildcards)")
 
 status_parser = subparsers.add_parser("status")
-status_parser.set_defaults(action=status.status)
+add_listing_options(status_parser)
+status_parser.set_defaults(action=command("status.status"))
 
 list_users_parser = subparsers.add_parser("list_users")
-list_users_parser.set_defaults(action=status.list_users)
+add_listing_options(list_users_parser)
+list_users_parser.set_defaults(action=command("status.list_users"))
 
 list_sites_parser = subparsers.add_parser("list_sites")
-list_sites_parser.set_defaults(action=status.list_sites)
+add_listing_options(list_sites_parser)
+list_sites_parser.set_defaults(action=command("status.list_sites"))
+
+batch_parser = subparsers.add_parser("batch", help="Run many piccolo commands from a file in one process")
+batch_parser.add_argument("file", help="File with one piccolo command per line (- for stdin)")
+batch_parser.add_argument("-x", "--stop-on-error", action="store_true", help="Stop at the first command that fails")
+batch_parser.set_defaults(action=command("batch.run"))
+
+audit_parser = subparsers.add_parser("audit", help="Compare piccolo's records with the accounts, configs and databases on this host")
+audit_parser.add_argument("-j", "--jobs", type=int, default=4, help="Number of checks to run at once")
+audit_parser.set_defaults(action=command("audit.run"))
+
+sync_parser = subparsers.add_parser("sync", help="Create and change users and sites to match an inventory file")
+sync_parser.add_argument("file", help="Inventory, in JSON or YAML (- for stdin)")
+sync_parser.add_argument("--plan", action="store_true", help="Only list the changes that would be made")
+sync_parser.add_argument("-n", "--no-email", action="store_true", help="Don't send welcome emails to new users and members")
+sync_parser.set_defaults(action=command("sync.run"))
+
+log_parser = subparsers.add_parser("log", help="Show the operation log: what piccolo did, step by step")
+log_which = log_parser.add_mutually_exclusive_group()
+log_which.add_argument("--site", metavar="SHORTNAME", help="Only operations and steps on this site")
+log_which.add_argument("--user", metavar="USERNAME", help="Only operations on this user")
+log_parser.add_argument("--op", metavar="ID", help="Only this operation")
+log_parser.add_argument("--since", default="1d", help="How far back to look: 30m, 2h, 3d, 1w or a date like 2024-05-01 (default 1d)")
+log_parser.add_argument("--steps", action="store_true", help="Only operations and their steps, without the messages")
+log_parser.add_argument("-j", "--json", action="store_true", help="Print the raw JSON lines")
+log_parser.set_defaults(action=command("oplog.show"))
+
+usage_parser = subparsers.add_parser("usage", help="Disk usage of site and user homes")
+usage_parser.add_argument("--top", type=int, metavar="N", help="Only show the N largest")
+usage_parser.add_argument("-j", "--jobs", type=int, default=4, help="Number of homes to scan at once")
+usage_parser.add_argument("--full", action="store_true", help="Recount every directory, not just the ones that changed")
+usage_parser.add_argument("--cached", action="store_true", help="Show the last scan's figures without scanning")
+usage_which = usage_parser.add_mutually_exclusive_group()
+usage_which.add_argument("--sites", action="store_true", help="Only sites")
+usage_which.add_argument("--users", action="store_true", help="Only users")
+usage_parser.set_defaults(action=command("usage.run"))
+
+mail_parser = subparsers.add_parser("mail", help="Outgoing email queue")
+mail_sub = mail_parser.add_subparsers(help="mail command")
+
+mail_flush = mail_sub.add_parser("flush", help="Send every queued email that's due")
+mail_flush.add_argument("--limit", type=int, help="Send at most this many emails")
+mail_flush.set_defaults(action=command("mail.flush"))
+
+mail_status = mail_sub.add_parser("status", help="Show queued, sent and failed emails")
+mail_status.add_argument("--limit", type=int, default=20, help="Show at most this many queued or failed emails")
+mail_status.set_defaults(action=command("mail.status"))
+
+mail_retry = mail_sub.add_parser("retry", help="Queue failed emails to be sent again")
+mail_retry.set_defaults(action=command("mail.retry"))
+
+daemon_parser = subparsers.add_parser("daemon", help="Run piccolod, which other piccolo commands hand their work to")
+daemon_parser.add_argument("-w", "--workers", type=int, default=4, help="Number of requests to work on at once")
+daemon_parser.set_defaults(action=command("daemon.serve"))
 
 # status_sub = status.add_subparsers(help="status command")
 # 
 # status_users = status_sub.add_parser("users")
-# status_users.set_defaults(action=users.list)
+# status_users.set_defaults(action=command("users.list"))
 # 
 # status_users = status_sub.add_parser("sites")
-# status_users.set_defaults(action=users.list)
+# status_users.set_defaults(action=command("users.list"))
 
 
-def execute_command():
-    args = parser.parse_args()
+def record_operation(args):
+    '''Records the command in the operation log, unless it can't change anything'''
+    command = getattr(args.action, 'command', None)
+    if args.pretend or command in READ_ONLY_COMMANDS:
+        return _nothing()
+    params = dict((key, value) for key, value in vars(args).items() if key != 'action')
+    return oplog.operation(command, oplog.target_of(params), params)
+
+@contextlib.contextmanager
+def _nothing():
+    yield
+
+def set_flags(args):
     if args.pretend:
         logger.info("Doing a pretend run... no changes will be made")
-        config.PRETEND = True
-    else:
-        config.PRETEND = False
     if args.force:
         logger.info("Forcing completion... will ignore failed shell actions.")
-        config.FORCE = True
-    else:
-        config.FORCE = False
-    
-    args.action(args) # perform selected action
+    shell.set_flags(bool(args.pretend), bool(args.force))
+
+def execute_command():
+    args = parser.parse_args()
+    if os.path.exists(config.DAEMON_SOCKET): # else there's no piccolod to hand it to
+        from piccolo import daemon
+        if daemon.should_forward(args):
+            status = daemon.forward(sys.argv[1:])
+            if status is not None:
+                sys.exit(status)
+    if not (args.profile or args.trace):
+        return run_command(args)
+    from piccolo import tracing
+    tracing.install()
+    try:
+        run_command(args)
+    finally:
+        tracing.report(args.trace)
+
+def run_command(args):
+    set_flags(args)
+    from piccolo import core
+    core.initialize()
+    if args.startup_profile:
+        from piccolo import startup
+        args.action.load() # the command's own imports count too
+        startup.report(config.STARTUP_BUDGET)
+    try:
+        with record_operation(args):
+            args.action(args) # perform selected action
+    finally:
+        # Only commands that loaded piccolo.nginx can have changed its config
+        nginx = sys.modules.get('piccolo.nginx')
+        if nginx is not None:
+            try:
+                nginx.reload_if_dirty()
+            except ShellActionFailed:
+                logger.error("nginx was not reloaded: its config failed validation or the reload failed. See log for details.")
+        # Emails the command queued go out now that its work is done. (Only
+        # commands that loaded the model can have queued any.)
+        mail = sys.modules.get('piccolo.mail')
+        if mail is not None and mail.queued_since_flush():
+            mail.flush()
@@ -2,8 +2,8 @@ from piccolo.sites import Site, Domain #, SiteExists, BadSiteName
 from piccolo.databases import Database
 from piccolo.users import User
 from piccolo.shell import ShellActionFailed
-from piccolo import db
-import logging, sys
+from piccolo import db, parallel, usage, shell, journal
+import logging, sys, os, csv, json, tempfile, time
 logger = logging.getLogger(__name__)
 
 def create(args):
@@ -90,18 +90,21 @@ def domain_remove(args):
             logger.exception("Could not remove {0} from {1} because shell actions failed.".format(args.domain_name, args.shortname))
 
 
-def db_create(args):
-    thesite = Site.get(args.shortname)
-    if not thesite:
-        logger.error("No site named {0} exists".format(thesite.shortname))
-        sys.exit(1)
+def _dbms(args):
     if args.dbms.lower() == "mysql":
-        dbms = Database.MYSQL
+        return Database.MYSQL
     elif args.dbms.lower() == "postgresql":
-        dbms = Database.POSTGRESQL
+        return Database.POSTGRESQL
     else:
         logger.error("Invalid DBMS!")
         sys.exit(1)
+
+def db_create(args):
+    thesite = Site.get(args.shortname)
+    if not thesite:
+        logger.error("No site named {0} exists".format(thesite.shortname))
+        sys.exit(1)
+    dbms = _dbms(args)
     try:
         Database.create(args.database_name, thesite, dbms, fake_create=args.fake_create)
     except Database.Exists as e:
@@ -109,6 +112,21 @@ def db_create(args):
     except Exception as e:
         logger.exception("Database creation failed")
 
+def db_create_many(args):
+    thesite = Site.get(args.shortname)
+    if not thesite:
+        logger.error("No site named {0} exists".format(args.shortname))
+        sys.exit(1)
+    dbms = _dbms(args)
+    try:
+        Database.create_many(args.database_names, thesite, dbms, fake_create=args.fake_create)
+    except (Database.Exists, Database.BadName) as e:
+        logger.error("No databases were created: {0}".format(e))
+    except Exception as e:
+        logger.exception("Database creation failed")
+    else:
+        logger.info("Created {0} databases for {1}".format(len(args.database_names), args.shortname))
+
 def db_delete(args):
     thesite = Site.get(args.shortname)
     if not thesite:
@@ -119,12 +137,225 @@ def db_delete(args):
     except Exception as e:
         logger.exception("Database deletion failed")
 
+def _site_database(shortname, dbname):
+    thesite = Site.get(shortname)
+    if not thesite:
+        logger.error("No site named {0} exists".format(shortname))
+        sys.exit(1)
+    the_db = Database.get(dbname)
+    if not the_db or the_db.site is not thesite:
+        logger.error("{0} has no database named {1}".format(shortname, dbname))
+        sys.exit(1)
+    return the_db
+
+def _throughput(size, seconds):
+    return "{0} in {1:.2f}s ({2:.1f} MB/s)".format(usage.format_size(size), seconds, size / 1048576.0 / max(seconds, 0.001))
+
+def _throttle(args):
+    return shell.Throttle(usage.parse_size(args.max_io)) if args.max_io else None
+
+def _dump_to(the_db, path, throttle):
+    '''Dumps a database to path (or stdout, for -), through a file readable only
+    by us that replaces path once the dump is complete. Returns the compressed
+    size.'''
+    if path == '-':
+        return the_db.dump(sys.stdout, throttle)
+    if shell.is_pretend():
+        with open(os.devnull, 'wb') as out:
+            return the_db.dump(out, throttle)
+    # mkstemp creates it u=rw, whatever is already at path
+    fd, partial = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.partial',
+        dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            size = the_db.dump(out, throttle)
+        os.rename(partial, path)
+    except:
+        os.unlink(partial) # an earlier dump at path is left as it was
+        raise
+    return size
+
+def db_dump(args):
+    the_db = _site_database(args.shortname, args.database_name)
+    path = args.file or the_db.dbname + '.sql.gz'
+    if path == '-' and sys.stdout.isatty():
+        logger.error("Not writing a compressed dump to a terminal; redirect it or give a file name")
+        sys.exit(1)
+    start = time.time()
+    try:
+        size = _dump_to(the_db, path, _throttle(args))
+    except ShellActionFailed:
+        logger.error("Could not dump {0}".format(the_db.dbname))
+        sys.exit(1)
+    logger.info("Dumped {0} to {1}: {2}".format(the_db.dbname, 'stdout' if path == '-' else path, _throughput(size, time.time() - start)))
+
+def db_dump_many(args):
+    thesite = Site.get(args.shortname)
+    if not thesite:
+        logger.error("No site named {0} exists".format(args.shortname))
+        sys.exit(1)
+    dbnames = args.database_names or [d.dbname for d in thesite.databases]
+    databases = [_site_database(args.shortname, dbname) for dbname in dbnames]
+    throttle = _throttle(args)
+    logger.info("Dumping {0} databases into {1} with {2} workers".format(len(databases), args.output_dir, args.jobs))
+    start = time.time()
+    results = parallel.run_each(
+        lambda the_db: _dump_to(the_db, os.path.join(args.output_dir, the_db.dbname + '.sql.gz'), throttle),
+        databases, workers=args.jobs)
+    for r in results:
+        if r.ok:
+            logger.info("  {0}: {1}".format(r.item.dbname, _throughput(r.value, r.elapsed)))
+        else:
+            logger.error("  {0}: FAILED ({1})".format(r.item.dbname, r.value))
+    failed = [r for r in results if not r.ok]
+    logger.info("Dumped {0} databases, {1}{2}".format(len(results) - len(failed),
+        _throughput(sum(r.value for r in results if r.ok), time.time() - start),
+        ", {0} failed".format(len(failed)) if failed else ""))
+    if failed:
+        sys.exit(1)
+
+def db_restore(args):
+    the_db = _site_database(args.shortname, args.database_name)
+    if args.file == '-':
+        source = sys.stdin
+    else:
+        try:
+            source = open(args.file, 'rb')
+        except IOError as e:
+            logger.error("Could not read {0}: {1}".format(args.file, e))
+            sys.exit(1)
+    start = time.time()
+    try:
+        size = the_db.restore(source, _throttle(args))
+    except ShellActionFailed:
+        logger.error("Could not restore {0}; see the errors above".format(the_db.dbname))
+        sys.exit(1)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    logger.info("Restored {0} from {1}: {2}".format(the_db.dbname, 'stdin' if args.file == '-' else args.file, _throughput(size, time.time() - start)))
+
 def status(args):
     s = Site.get(args.shortname)
     logger.info("\t[{0}] {1} ({2})".format(s.shortname, s.full_name, s._get_home()))
     logger.info("\t\tusers: {0}".format(', '.join([u.username for u in s.users])))
     logger.info("\t\tdatabases: {0}".format(', '.join([d.dbname for d in s.databases])))
     logger.info("\t\tdomains: {0}".format(', '.join([d.domain_name for d in s.domains])))
+    recorded = usage.get(usage.SITE, s.shortname)
+    if recorded is None:
+        logger.info("\t\tdisk usage: not scanned yet (see piccolo usage)")
+    elif recorded.over_threshold():
+        logger.warning("\t\tdisk usage: {0}".format(recorded.describe()))
+    else:
+        logger.info("\t\tdisk usage: {0}".format(recorded.describe()))
+    if journal.incomplete(s._journal_owner()):
+        logger.warning("\t\tprovisioning unfinished (see piccolo site {0} resume or rollback):".format(s.shortname))
+        for step in journal.steps(s._journal_owner()):
+            logger.warning("\t\t\t" + step.describe())
+
+def resume(args):
+    s = Site.get(args.shortname)
+    if not s:
+        logger.error("No site named {0} exists".format(args.shortname))
+        sys.exit(1)
+    try:
+        s.resume()
+    except Site.NothingToResume as e:
+        logger.error(e)
+        sys.exit(1)
+    except ShellActionFailed as e:
+        logger.error("Could not finish provisioning {0}: {1}".format(args.shortname, e))
+        sys.exit(1)
+
+def rollback(args):
+    s = Site.get(args.shortname)
+    if not s:
+        logger.error("No site named {0} exists".format(args.shortname))
+        sys.exit(1)
+    try:
+        s.rollback()
+    except Site.NothingToResume as e:
+        logger.error(e)
+        sys.exit(1)
+    except ShellActionFailed as e:
+        logger.error("Rollback of {0} stopped: {1}".format(args.shortname, e))
+        sys.exit(1)
 
-def backup(args):
-    logger.debug("back up " + args.shortname + " from console")
+def fix_perms(args):
+    s = Site.get(args.shortname)
+    if not s:
+        logger.error("There is no site named {0}".format(args.shortname))
+        sys.exit(1)
+    changes = s.fix_permissions()
+    logger.info("{0} changes under {1}".format(len(changes), s._get_home()))
+
+def _read_site_list(path):
+    '''Reads (shortname, full_name) pairs from a CSV file or a JSON list of
+    objects, pairs or bare shortnames. Full names may be missing.'''
+    source = sys.stdin if path == '-' else open(path, 'r')
+    try:
+        text = source.read()
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    if path.endswith('.json') or text.lstrip().startswith('['):
+        rows = []
+        for entry in json.loads(text):
+            if isinstance(entry, dict):
+                rows.append((entry['shortname'], entry.get('full_name')))
+            elif isinstance(entry, list):
+                rows.append((entry[0], entry[1] if len(entry) > 1 else None))
+            else:
+                rows.append((entry, None))
+        return rows
+    rows = []
+    for row in csv.reader(text.splitlines()):
+        if not row or row[0].strip().startswith('#') or row[0].strip() == 'shortname':
+            continue
+        rows.append((row[0].strip(), row[1].strip() if len(row) > 1 else None))
+    return rows
+
+def _check_unique(shortnames):
+    seen = set()
+    duplicates = set(s for s in shortnames if s in seen or seen.add(s))
+    if duplicates:
+        logger.error("Listed more than once: {0}".format(', '.join(sorted(duplicates))))
+        sys.exit(1)
+
+def create_many(args):
+    rows = _read_site_list(args.file)
+    _check_unique([shortname for shortname, full_name in rows])
+    missing = [shortname for shortname, full_name in rows if not full_name]
+    if missing:
+        logger.error("No full name given for: {0}".format(', '.join(missing)))
+        sys.exit(1)
+    logger.info("Creating {0} sites with {1} workers".format(len(rows), args.jobs))
+    start = time.time()
+    results = parallel.run_each(lambda row: Site.create(row[0], row[1]), rows, workers=args.jobs)
+    if parallel.summarize(results, time.time() - start, describe=lambda row: row[0]):
+        sys.exit(1)
+
+def delete_many(args):
+    shortnames = [shortname for shortname, full_name in _read_site_list(args.file)]
+    _check_unique(shortnames)
+    logger.info("Deleting {0} sites with {1} workers".format(len(shortnames), args.jobs))
+    start = time.time()
+    results = parallel.run_each(Site.delete, shortnames, workers=args.jobs)
+    if parallel.summarize(results, time.time() - start):
+        sys.exit(1)
+
+def fix_perms_all(args):
+    shortnames = [row[0] for row in db.Session().query(Site.shortname).order_by(Site.shortname)]
+    logger.info("Checking permissions on {0} sites with {1} workers".format(len(shortnames), args.jobs))
+    start = time.time()
+    results = parallel.run_each(lambda shortname: len(Site.get(shortname).fix_permissions()), shortnames, workers=args.jobs)
+    changed = [r for r in results if r.ok and r.value]
+    failed = [r for r in results if not r.ok]
+    for r in changed:
+        logger.info("  {0}: {1} changes".format(r.item, r.value))
+    for r in failed:
+        logger.error("  {0}: FAILED ({1})".format(r.item, r.value))
+    logger.info("{0} sites checked in {1:.2f}s: {2} changes on {3} sites, {4} failed".format(
+        len(results), time.time() - start, sum(r.value for r in changed), len(changed), len(failed)))
+    if failed:
+        sys.exit(1)
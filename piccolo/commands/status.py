@@ -2,33 +2,125 @@ from piccolo.sites import Site, Domain #, SiteExists, BadSiteName
 from piccolo.databases import Database
 from piccolo.users import User
 from piccolo import db
-import logging
+from sqlalchemy.orm import selectinload, lazyload
+import logging, sys, csv, json
 logger = logging.getLogger(__name__)
 
+YIELD_PER = 500 # rows fetched (and eager-loaded) per round trip
+
+SITE_FIELDS = ('shortname', 'full_name', 'home', 'users', 'databases', 'domains')
+USER_FIELDS = ('username', 'full_name', 'email', 'sites')
+
+def _like(pattern):
+    '''Turns a shell-style glob (foo*, *club*) into a LIKE pattern'''
+    escaped = pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped.replace('*', '%').replace('?', '_')
+
+def _filtered(q, name_column, args):
+    if args.filter:
+        q = q.filter(name_column.like(_like(args.filter), escape='\\'))
+    if args.limit:
+        q = q.limit(args.limit)
+    return q
+
+def _site_rows(session, args):
+    q = session.query(Site).options(
+        selectinload(Site.users),
+        selectinload(Site.databases),
+        selectinload(Site.domains),
+    ).order_by(Site.shortname)
+    for s in _filtered(q, Site.shortname, args).yield_per(YIELD_PER):
+        yield {
+            'shortname': s.shortname,
+            'full_name': s.full_name,
+            'home': s._get_home(),
+            'users': [u.username for u in s.users],
+            'databases': [d.dbname for d in s.databases],
+            'domains': [d.domain_name for d in s.domains],
+        }
+
+def _user_rows(session, args):
+    q = session.query(User).options(
+        selectinload(User.sites).lazyload(Site.users),
+    ).order_by(User.username)
+    for u in _filtered(q, User.username, args).yield_per(YIELD_PER):
+        yield {
+            'username': u.username,
+            'full_name': u.full_name,
+            'email': u.email,
+            'sites': sorted(s.shortname for s in u.sites),
+        }
+
+def _write_json_array(rows, out):
+    out.write('[')
+    separator = '\n'
+    for row in rows:
+        out.write(separator + json.dumps(row))
+        separator = ',\n'
+    out.write('\n]')
+
+def _write_csv(rows, fields, out):
+    writer = csv.writer(out)
+    writer.writerow(fields)
+    for row in rows:
+        writer.writerow([
+            u' '.join(row[f]).encode('utf-8') if isinstance(row[f], list) else (row[f] or u'').encode('utf-8')
+            for f in fields
+        ])
+
+def _log_site(row):
+    logger.info("\t[{0}] {1} ({2})".format(row['shortname'], row['full_name'], row['home']))
+    logger.info("\t\tusers: {0}".format(', '.join(row['users'])))
+    logger.info("\t\tdatabases: {0}".format(', '.join(row['databases'])))
+    logger.info("\t\tdomains: {0}".format(', '.join(row['domains'])))
+
+def _log_user(row):
+    logger.info("\t[{0}] {1} <{2}>".format(row['username'], row['full_name'], row['email']))
+    logger.info("\t\tsites: {0}".format(', '.join(row['sites'])))
+
 def status(args):
     session = db.Session()
-    sites = session.query(Site).all()
-    users = session.query(User).all()
-    logger.info("Sites:")
-    for s in sites:
-        logger.info("\t[{0}] {1} ({2})".format(s.shortname, s.full_name, s._get_home()))
-        logger.info("\t\tusers: {0}".format(', '.join([u.username for u in s.users])))
-        logger.info("\t\tdatabases: {0}".format(', '.join([d.dbname for d in s.databases])))
-        logger.info("\t\tdomains: {0}".format(', '.join([d.domain_name for d in s.domains])))
-    logger.info("Users:")
-    for u in users:
-        logger.info("\t[{0}] {1} <{2}>".format(u.username, u.full_name, u.email))
-        logger.info("\t\tsites: {0}".format(', '.join([s.shortname for s in u.sites])))
+    if args.format == 'json':
+        sys.stdout.write('{"sites": ')
+        _write_json_array(_site_rows(session, args), sys.stdout)
+        sys.stdout.write(',\n"users": ')
+        _write_json_array(_user_rows(session, args), sys.stdout)
+        sys.stdout.write('}\n')
+    elif args.format == 'csv':
+        _write_csv(_site_rows(session, args), SITE_FIELDS, sys.stdout)
+        sys.stdout.write('\n')
+        _write_csv(_user_rows(session, args), USER_FIELDS, sys.stdout)
+    else:
+        logger.info("Sites:")
+        for row in _site_rows(session, args):
+            _log_site(row)
+        logger.info("Users:")
+        for row in _user_rows(session, args):
+            _log_user(row)
 
 def list_users(args):
     session = db.Session()
-    all_users = session.query(User).all()
-    logger.info("Total users: {0}".format(len(all_users)))
-    user_emails = ["{0} <{1}>".format(u.full_name, u.email) for u in all_users]
-    print ', '.join(user_emails)
+    if args.format == 'json':
+        _write_json_array(_user_rows(session, args), sys.stdout)
+        sys.stdout.write('\n')
+    elif args.format == 'csv':
+        _write_csv(_user_rows(session, args), USER_FIELDS, sys.stdout)
+    else:
+        logger.info("Total users: {0}".format(session.query(User).count()))
+        q = session.query(User.full_name, User.email).order_by(User.username)
+        user_emails = ("{0} <{1}>".format(u.full_name, u.email)
+            for u in _filtered(q, User.username, args).yield_per(YIELD_PER))
+        print ', '.join(user_emails)
 
 def list_sites(args):
     session = db.Session()
-    sites = session.query(Site).all()
-    logger.info("Sites:")
-    print '\n'.join([s.shortname for s in sites])
+    if args.format == 'json':
+        _write_json_array(_site_rows(session, args), sys.stdout)
+        sys.stdout.write('\n')
+    elif args.format == 'csv':
+        _write_csv(_site_rows(session, args), SITE_FIELDS, sys.stdout)
+    else:
+        logger.info("Sites:")
+        q = session.query(Site.shortname).order_by(Site.shortname)
+        for row in _filtered(q, Site.shortname, args).yield_per(YIELD_PER):
+            print row.shortname
@@ -0,0 +1,30 @@
+from piccolo import sync, shell
+import logging, sys, time
+logger = logging.getLogger(__name__)
+
+def run(args):
+    source = sys.stdin if args.file == '-' else open(args.file, 'r')
+    try:
+        text = source.read()
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    start = time.time()
+    try:
+        changes = sync.plan(sync.load(args.file, text), suppress_welcome=args.no_email)
+    except sync.BadInventory as e:
+        logger.error("Nothing was changed: {0}".format(e))
+        sys.exit(1)
+    if not changes:
+        logger.info("Already in sync ({0:.2f}s)".format(time.time() - start))
+        return
+    if args.plan or shell.is_pretend():
+        for change in changes:
+            logger.info(str(change))
+        logger.info("{0} changes to make".format(len(changes)))
+        return
+    applied = sync.apply(changes)
+    logger.info("Applied {0} of {1} changes in {2:.2f}s".format(applied, len(changes), time.time() - start))
+    if applied < len(changes):
+        logger.error("Stopped at a failure; fix it and sync again to apply the rest")
+        sys.exit(1)
@@ -0,0 +1,50 @@
+from piccolo import usage, db, parallel
+from piccolo.usage import Usage, UsageDir, SITE, USER, format_size
+from piccolo.sites import Site
+from piccolo.users import User
+import logging, sys, time
+logger = logging.getLogger(__name__)
+
+def _forget_deleted(owners):
+    '''Drops usage records of sites and users that no longer exist'''
+    session = db.Session()
+    known = set("{0}:{1}".format(kind, name) for kind, name in owners)
+    stale = [row[0] for row in session.query(Usage.owner) if row[0] not in known]
+    if stale:
+        session.query(UsageDir).filter(UsageDir.owner.in_(stale)).delete(synchronize_session=False)
+        session.query(Usage).filter(Usage.owner.in_(stale)).delete(synchronize_session=False)
+        session.commit()
+
+def run(args):
+    db.ensure_tables(Usage, UsageDir)
+    session = db.Session()
+    kind = SITE if args.sites else USER if args.users else None
+    if not args.cached:
+        owners = [(SITE, row[0]) for row in session.query(Site.shortname)] + [(USER, row[0]) for row in session.query(User.username)]
+        _forget_deleted(owners)
+        if kind:
+            owners = [owner for owner in owners if owner[0] == kind]
+        logger.info("Scanning {0} homes with {1} workers{2}".format(len(owners), args.jobs, " (full rescan)" if args.full else ""))
+        start = time.time()
+        results = parallel.run_each(lambda owner: usage.scan(owner[0], owner[1], full=args.full), owners, workers=args.jobs)
+        failed = [r for r in results if not r.ok]
+        logger.info("Scanned in {0:.2f}s{1}".format(time.time() - start, ", {0} failed".format(len(failed)) if failed else ""))
+    rows = usage.top(args.top, kind)
+    logger.info("{0:<6} {1:<32} {2:>9} {3:>9} {4:>10}".format("kind", "name", "size", "files", "threshold"))
+    for u in rows:
+        line = "{0:<6} {1:<32} {2:>9} {3:>9} {4:>10}".format(u.kind, u.name, format_size(u.bytes), u.files,
+            format_size(u.threshold) if u.threshold is not None else "-")
+        if u.over_threshold():
+            logger.warning(line + "  OVER")
+        else:
+            logger.info(line)
+
+def site_usage(args):
+    if not Site.get(args.shortname):
+        logger.error("There is no site named {0}".format(args.shortname))
+        sys.exit(1)
+    if args.threshold:
+        threshold = None if args.threshold.lower() == 'none' else usage.parse_size(args.threshold)
+        usage.set_threshold(SITE, args.shortname, threshold)
+    u = usage.scan(SITE, args.shortname)
+    logger.info("{0}: {1}".format(usage.home(SITE, args.shortname), u.describe()))
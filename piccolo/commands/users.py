@@ -1,6 +1,6 @@
 from piccolo.users import User
 from piccolo.config import DATA_DIR
-import logging, subprocess
+import logging, subprocess, sys, csv, json, time
 logger = logging.getLogger(__name__)
 
 def create(args):
@@ -18,3 +18,43 @@ def delete(args):
         User.delete(args.username)
     except User.DoesNotExist:
         logger.exception("There is no user named {0}".format(args.username))
+
+def _read_user_list(path):
+    '''Reads (username, full_name, email) rows from a CSV file or a JSON list of
+    objects or lists'''
+    source = sys.stdin if path == '-' else open(path, 'r')
+    try:
+        text = source.read()
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    if path.endswith('.json') or text.lstrip().startswith('['):
+        rows = []
+        for entry in json.loads(text):
+            if isinstance(entry, dict):
+                rows.append((entry['username'], entry.get('full_name'), entry.get('email')))
+            else:
+                entry = list(entry) + [None, None]
+                rows.append((entry[0], entry[1], entry[2]))
+        return rows
+    rows = []
+    for row in csv.reader(text.splitlines()):
+        if not row or row[0].strip().startswith('#') or row[0].strip() == 'username':
+            continue
+        row = [field.strip() for field in row] + [None, None]
+        rows.append((row[0], row[1], row[2]))
+    return rows
+
+def import_users(args):
+    rows = _read_user_list(args.file)
+    logger.info("Importing {0} users".format(len(rows)))
+    start = time.time()
+    try:
+        failed = User.create_many(rows, suppress_welcome=args.no_email)
+    except User.BadName, why:
+        logger.error(why)
+        sys.exit(1)
+    logger.info("Imported {0} users in {1:.1f}s".format(len(rows) - len(failed), time.time() - start))
+    if failed:
+        logger.error("Couldn't create accounts for: {0}".format(', '.join(failed)))
+        sys.exit(1)
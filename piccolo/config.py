@@ -2,8 +2,7 @@ import ConfigParser, sys, os.path, stat, re
 
 PICCOLO_SRC_DIR = os.path.dirname(__file__)
 PICCOLO_ROOT = os.path.abspath(os.path.join(PICCOLO_SRC_DIR, '..'))
-CONFIG_PATH = "/etc/piccolo/piccolo.cfg"
-TEMPLATE_ROOT = os.path.join(PICCOLO_ROOT, "templates")
+CONFIG_PATH = os.environ.get("PICCOLO_CONFIG", "/etc/piccolo/piccolo.cfg") # another host's (or a benchmark's) config
 NAME_LIMIT = 32
 NAME_REGEX = re.compile(r'^([A-Za-z0-9\-]{2,})$')
 
@@ -25,18 +24,31 @@ except IOError as e:
     sys.stderr.write(str(e))
     sys.exit(1)
 
+# Set from --pretend/--force by the command line
+PRETEND = False
+FORCE = False
+
 DATA_DIR = config.get("piccolo", "data")
 USERS_ROOT = config.get("piccolo", "users_root")
 SITES_ROOT = config.get("piccolo", "sites_root")
 DEFAULT_DOMAIN = config.get("piccolo", "default_domain")
+# Seconds piccolo may take to start before --startup-profile complains
+STARTUP_BUDGET = config.getfloat("piccolo", "startup_budget") if config.has_option("piccolo", "startup_budget") else 0.5
 NGINX_CONF_ROOT = config.get("piccolo", "nginx_conf_root")
+SUDOERS_DIR = config.get("piccolo", "sudoers_dir") if config.has_option("piccolo", "sudoers_dir") else "/etc/sudoers.d"
+TEMPLATE_ROOT = config.get("piccolo", "templates") if config.has_option("piccolo", "templates") else os.path.join(PICCOLO_ROOT, "templates")
 LOGGING = {
     'directory': config.get("piccolo", "logs"),
     'max_size': 1, # in MB
     'retain_count': 1, # Keep this many copies of the old logs after rotating
+    # The operation log (see piccolo.oplog) keeps whole days, up to both limits
+    'operations_max_size': config.getint("piccolo", "oplog_max_size") if config.has_option("piccolo", "oplog_max_size") else 100, # in MB
+    'operations_max_age': config.getint("piccolo", "oplog_max_age") if config.has_option("piccolo", "oplog_max_age") else 90, # in days
 }
 
 DATABASE = os.path.join(DATA_DIR, "piccolo.sqlite")
+BACKUP_ROOT = config.get("piccolo", "backups") if config.has_option("piccolo", "backups") else os.path.join(DATA_DIR, "backups")
+DAEMON_SOCKET = config.get("piccolo", "socket") if config.has_option("piccolo", "socket") else os.path.join(DATA_DIR, "piccolod.sock")
 MYSQL = {
     'username': config.get("mysql", "username"),
     'password': config.get("mysql", "password"),
@@ -51,4 +63,6 @@ EMAIL = {
     'smtp_server': config.get("email", "smtp_server"),
     'smtp_port': config.get("email", "smtp_port"),
     'friendly_name': config.get("email", "friendly_name"),
+    # Off for a local relay (or a test SMTP server) that doesn't do TLS
+    'starttls': config.getboolean("email", "starttls") if config.has_option("email", "starttls") else True,
 }
@@ -1,21 +1,17 @@
 import piccolo.log
 import piccolo.config
 from piccolo.shell import flags_to_mode, ugo_mode, exists
-from piccolo import db
 import os, stat, logging, sys
-from piccolo import sites, users, databases
 
 """
-Really just serves to set things up (initialize database, etc.)
+Really just serves to set things up (initialize database, etc.). Nothing
+happens on import; the command line calls initialize() once it knows what
+it's going to run.
 """
 
 VERSION = (0, 1)
 logger = logging.getLogger(__name__)
 
-if not exists(piccolo.config.DATABASE):
-    db.Base.metadata.create_all(db.sqlite_db)
-    os.chmod(piccolo.config.DATABASE, flags_to_mode("u=rw"))
-
 # Test security settings
 mode_checks = [
     (piccolo.config.DATA_DIR, "u=rwx,g=rx"),
@@ -26,14 +22,35 @@ mode_checks = [
     (piccolo.config.DATABASE, "u=rw")
 ]
 
-for path, required_flags in mode_checks:
-    if not exists(path):
-        logger.error("{0} is missing. Cannot start.".format(path))
-        sys.exit(1)
-    if ugo_mode(path) != flags_to_mode(required_flags):
-        logger.warning("{0} has incorrect permissions:"
-            " mode is {1:04o}, but should be {2:04o}. Running piccolo"
-            " with the current permissions is a security risk!".format(path, ugo_mode(path), flags_to_mode(required_flags)))
-    else:
-        logger.debug("Correct permissions on {0} :]".format(path))
+# path -> (inode, mtime, mode) of paths that passed their check, so a batch or
+# long-running process only re-examines paths that have changed
+_verified = {}
+
+def _check_modes():
+    for path, required_flags in mode_checks:
+        try:
+            st = os.stat(path)
+        except OSError:
+            logger.error("{0} is missing. Cannot start.".format(path))
+            sys.exit(1)
+        signature = (st.st_ino, st.st_mtime, st.st_mode)
+        if _verified.get(path) == signature:
+            continue
+        mode = stat.S_IMODE(st.st_mode) & (stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
+        if mode != flags_to_mode(required_flags):
+            logger.warning("{0} has incorrect permissions:"
+                " mode is {1:04o}, but should be {2:04o}. Running piccolo"
+                " with the current permissions is a security risk!".format(path, mode, flags_to_mode(required_flags)))
+        else:
+            logger.debug("Correct permissions on {0} :]".format(path))
+            _verified[path] = signature
 
+def initialize():
+    # Commands load the models they use themselves; only creating the DB
+    # needs every table
+    if not exists(piccolo.config.DATABASE):
+        from piccolo import db, sites, users, databases, mail
+        # Private from the start: queued mail (initial passwords included) is kept in it
+        os.close(os.open(piccolo.config.DATABASE, os.O_WRONLY | os.O_CREAT, flags_to_mode("u=rw")))
+        db.Base.metadata.create_all(db.sqlite_db)
+    _check_modes()
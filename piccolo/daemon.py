@@ -0,0 +1,459 @@
+import json, logging, os, socket, struct, sys, threading, traceback
+from piccolo import config, oplog
+
+"""
+piccolod: a long-running piccolo that keeps the model, the session factory and
+the DB servers' admin connections warm, and takes requests from root over a
+Unix socket.
+
+The protocol is one JSON object per line. A client sends one request:
+
+    {"argv": ["site", "foo", "status"]}     run a command line
+    {"op": "site.create", "params": {...}}   call an operation (see OPERATIONS)
+
+and gets back any number of {"log": [levelno, message]}, {"stdout": text}
+and {"stderr": text} messages, ending with {"exit": status} for a command
+line or {"ok": true, "result": ...} / {"ok": false, "error": message} for an
+operation.
+
+Requests run on a fixed pool of threads. Requests for the same site or user
+run one at a time; requests for different ones run side by side.
+"""
+
+logger = logging.getLogger(__name__)
+
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17) # Linux
+MAIL_INTERVAL = 60 # seconds between outbox flushes when nothing new is queued
+
+def _send(stream, message):
+    stream.write(json.dumps(message) + '\n')
+    stream.flush()
+
+# Client side: the command line hands its arguments to piccolod when it's up
+
+# Commands with these arguments use the caller's paths, stdin or stdout
+LOCAL_ARGUMENTS = ('file', 'output_dir')
+# Commands that always run in the caller's process: the daemon itself, and
+# backups, which fork a process pool (unsafe from a threaded process)
+LOCAL_COMMANDS = ('daemon.serve', 'backups.site_backup', 'backups.run')
+
+def should_forward(args):
+    if os.environ.get('PICCOLO_NO_DAEMON') or args.local or args.startup_profile or args.profile or args.trace:
+        return False
+    if getattr(args.action, 'command', None) in LOCAL_COMMANDS:
+        return False
+    if any(hasattr(args, name) for name in LOCAL_ARGUMENTS):
+        return False # reads or writes the caller's files, stdin or stdout
+    return os.path.exists(config.DAEMON_SOCKET)
+
+def forward(argv):
+    '''Runs a piccolo command line in piccolod and replays its output here.
+    Returns the exit status, or None if piccolod couldn't be reached.'''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(config.DAEMON_SOCKET)
+    except socket.error as e:
+        logger.debug("piccolod is not answering ({0}); running locally".format(e))
+        return None
+
+    import piccolo.log
+    remote = logging.getLogger('piccolod')
+    remote.propagate = False # piccolod keeps its own log file
+    if piccolo.log.ch not in remote.handlers:
+        remote.addHandler(piccolo.log.ch)
+
+    stream = client.makefile('rw')
+    try:
+        _send(stream, {'argv': argv})
+        for line in stream:
+            message = json.loads(line)
+            if 'log' in message:
+                remote.log(message['log'][0], message['log'][1])
+            elif 'stdout' in message:
+                sys.stdout.write(message['stdout'])
+            elif 'stderr' in message:
+                sys.stderr.write(message['stderr'])
+            elif 'exit' in message:
+                return message['exit']
+    finally:
+        stream.close()
+        client.close()
+    logger.error("piccolod closed the connection before the command finished")
+    return 1
+
+# Server side
+
+class _ThreadRouter(logging.Handler):
+    '''Sends log records to whichever client the logging thread is serving'''
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.sinks = {}
+
+    def emit(self, record):
+        send = self.sinks.get(record.thread)
+        if send is not None:
+            try:
+                send({'log': [record.levelno, record.getMessage()]})
+            except Exception:
+                pass # the client went away; the command carries on
+
+class _StreamRouter(object):
+    '''Stands in for sys.stdout/sys.stderr, passing writes from request threads
+    to their clients and everything else to the real stream'''
+    def __init__(self, name, real):
+        self.name = name
+        self.real = real
+        self.sinks = {}
+
+    def write(self, text):
+        send = self.sinks.get(threading.current_thread().ident)
+        if send is None:
+            self.real.write(text)
+        else:
+            try:
+                send({self.name: text})
+            except Exception:
+                pass
+
+    def flush(self):
+        self.real.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.real, name)
+
+class _SharedLock(object):
+    '''Held shared by requests for particular sites/users, and exclusively by
+    requests that could touch anything (bulk commands, batches)'''
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+
+    def acquire(self, exclusive):
+        with self._condition:
+            if exclusive:
+                while self._writer or self._readers:
+                    self._condition.wait()
+                self._writer = True
+            else:
+                while self._writer:
+                    self._condition.wait()
+                self._readers += 1
+
+    def release(self, exclusive):
+        with self._condition:
+            if exclusive:
+                self._writer = False
+            else:
+                self._readers -= 1
+            self._condition.notify_all()
+
+class ResourceLocks(object):
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}
+        self._everything = _SharedLock()
+
+    def _lock(self, key):
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def acquire(self, keys, exclusive):
+        self._everything.acquire(exclusive)
+        for key in sorted(keys): # always in the same order, so no deadlocks
+            self._lock(key).acquire()
+
+    def release(self, keys, exclusive):
+        for key in sorted(keys, reverse=True):
+            self._lock(key).release()
+        self._everything.release(exclusive)
+
+def _resources(params):
+    keys = []
+    if params.get('shortname'):
+        keys.append('site:' + params['shortname'])
+    if params.get('username'):
+        keys.append('user:' + params['username'])
+    return keys
+
+# Operations
+
+def _site(shortname):
+    from piccolo.sites import Site
+    the_site = Site.get(shortname)
+    if not the_site:
+        raise Site.DoesNotExist("No site named {0}".format(shortname))
+    return the_site
+
+def _user(username):
+    from piccolo.users import User
+    the_user = User.get(username)
+    if not the_user:
+        raise User.DoesNotExist("No user named {0}".format(username))
+    return the_user
+
+def _dbms(name):
+    from piccolo.databases import Database
+    return {'mysql': Database.MYSQL, 'postgresql': Database.POSTGRESQL}[name.lower()]
+
+def _site_info(p):
+    s = _site(p['shortname'])
+    return {
+        'shortname': s.shortname,
+        'full_name': s.full_name,
+        'home': s._get_home(),
+        'users': [u.username for u in s.users],
+        'databases': [d.dbname for d in s.databases],
+        'domains': [d.domain_name for d in s.domains],
+    }
+
+def _user_info(p):
+    u = _user(p['username'])
+    return {
+        'username': u.username,
+        'full_name': u.full_name,
+        'email': u.email,
+        'sites': sorted(s.shortname for s in u.sites),
+    }
+
+def _site_create(p):
+    from piccolo.sites import Site
+    Site.create(p['shortname'], p['full_name'])
+
+def _site_delete(p):
+    from piccolo.sites import Site
+    Site.delete(p['shortname'])
+
+def _site_resume(p):
+    _site(p['shortname']).resume()
+
+def _site_rollback(p):
+    _site(p['shortname']).rollback()
+
+def _site_adduser(p):
+    _site(p['shortname']).addUser(_user(p['username']), suppress_welcome=p.get('no_email', False))
+
+def _site_removeuser(p):
+    _site(p['shortname']).removeUser(_user(p['username']))
+
+def _user_create(p):
+    from piccolo.users import User
+    User.create(p['username'], p['full_name'], p['email'],
+        suppress_welcome=p.get('no_email', False), fake_create=p.get('fake_create', False))
+
+def _user_delete(p):
+    from piccolo.users import User
+    User.delete(p['username'])
+
+def _domain_create(p):
+    from piccolo.sites import Domain
+    Domain.create(p['domain_name'], _site(p['shortname']))
+
+def _domain_delete(p):
+    from piccolo.sites import Domain
+    Domain.delete(p['domain_name'], _site(p['shortname']))
+
+def _database_create(p):
+    from piccolo.databases import Database
+    Database.create(p['dbname'], _site(p['shortname']), _dbms(p['dbms']), p.get('fake_create', False))
+
+def _database_delete(p):
+    from piccolo.databases import Database
+    Database.delete(p['dbname'], _site(p['shortname']))
+
+# name -> (function, read only?)
+OPERATIONS = {
+    'site.get': (_site_info, True),
+    'site.create': (_site_create, False),
+    'site.delete': (_site_delete, False),
+    'site.resume': (_site_resume, False),
+    'site.rollback': (_site_rollback, False),
+    'site.adduser': (_site_adduser, False),
+    'site.removeuser': (_site_removeuser, False),
+    'user.get': (_user_info, True),
+    'user.create': (_user_create, False),
+    'user.delete': (_user_delete, False),
+    'domain.create': (_domain_create, False),
+    'domain.delete': (_domain_delete, False),
+    'database.create': (_database_create, False),
+    'database.delete': (_database_delete, False),
+}
+
+class Daemon(object):
+    def __init__(self, workers):
+        self.workers = workers
+        self.locks = ResourceLocks()
+        self.log_router = _ThreadRouter()
+        self.stdout = _StreamRouter('stdout', sys.stdout)
+        self.stderr = _StreamRouter('stderr', sys.stderr)
+
+    def _attach(self, send):
+        ident = threading.current_thread().ident
+        for router in (self.log_router, self.stdout, self.stderr):
+            router.sinks[ident] = send
+
+    def _detach(self):
+        ident = threading.current_thread().ident
+        for router in (self.log_router, self.stdout, self.stderr):
+            router.sinks.pop(ident, None)
+
+    def _run(self, keys, exclusive, pretend, force, func):
+        from piccolo import db, shell, nginx
+        shell.isolate_flags(pretend, force)
+        nginx.track()
+        self.locks.acquire(keys, exclusive)
+        try:
+            try:
+                return func()
+            finally:
+                # For this request's changes only, while it still holds its resources
+                try:
+                    nginx.reload_if_dirty()
+                except shell.ShellActionFailed:
+                    logger.error("nginx was not reloaded: its config failed validation or the reload failed.")
+        finally:
+            self.locks.release(keys, exclusive)
+            db.Session.remove()
+            shell.release_flags()
+            nginx.adopt(None)
+
+    def run_argv(self, argv):
+        from piccolo.commands.parser import parser, set_flags, record_operation, READ_ONLY_COMMANDS
+        try:
+            args = parser.parse_args(argv)
+        except SystemExit as e:
+            return e.code
+        command = getattr(args.action, 'command', None)
+        if command == 'daemon.serve':
+            logger.error("piccolod is already running")
+            return 1
+        if command in LOCAL_COMMANDS:
+            logger.error("{0} can't run in piccolod; run it with --local".format(' '.join(argv)))
+            return 1
+        read_only = command in READ_ONLY_COMMANDS
+        params = vars(args)
+        keys = [] if read_only else _resources(params)
+
+        def run():
+            set_flags(args)
+            try:
+                with record_operation(args):
+                    args.action(args)
+            except SystemExit as e:
+                if e.code is None:
+                    return 0
+                return e.code if isinstance(e.code, int) else 1
+            except Exception:
+                logger.exception("Command failed")
+                return 1
+            return 0
+        return self._run(keys, not keys and not read_only, args.pretend, args.force, run)
+
+    def run_operation(self, name, params):
+        if name not in OPERATIONS:
+            return {'ok': False, 'error': "Unknown operation {0}".format(name)}
+        func, read_only = OPERATIONS[name]
+        keys = [] if read_only else _resources(params)
+
+        def run():
+            try:
+                if read_only or params.get('pretend'):
+                    return {'ok': True, 'result': func(params)}
+                with oplog.operation(name, oplog.target_of(params), params):
+                    return {'ok': True, 'result': func(params)}
+            except Exception as e:
+                logger.debug(traceback.format_exc())
+                return {'ok': False, 'error': "{0}: {1}".format(type(e).__name__, e)}
+        return self._run(keys, not keys and not read_only, params.get('pretend', False), params.get('force', False), run)
+
+    def handle(self, connection):
+        pid, uid, gid = struct.unpack('3i', connection.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i')))
+        stream = connection.makefile('rw')
+        if uid != 0:
+            logger.warning("Refused piccolod request from uid {0} (pid {1})".format(uid, pid))
+            _send(stream, {'ok': False, 'error': "piccolod only takes requests from root", 'exit': 1})
+            return
+        request = json.loads(stream.readline() or 'null')
+        if not isinstance(request, dict):
+            return
+        lock = threading.Lock()
+        def send(message):
+            with lock:
+                _send(stream, message)
+        self._attach(send)
+        try:
+            if 'argv' in request:
+                send({'exit': self.run_argv(request['argv'])})
+            elif 'op' in request:
+                send(self.run_operation(request['op'], request.get('params', {})))
+        finally:
+            self._detach()
+            stream.close()
+
+    def serve(self):
+        import SocketServer, signal
+        from multiprocessing.pool import ThreadPool
+        from piccolo import sites, users, databases, mail # warm up the model
+        daemon = self
+
+        class Handler(SocketServer.BaseRequestHandler):
+            def handle(self):
+                daemon.handle(self.request)
+
+        class Server(SocketServer.UnixStreamServer):
+            def process_request(self, request, client_address):
+                # A fixed pool, so each thread's session and admin connections stay warm
+                pool.apply_async(self._process, (request, client_address))
+
+            def _process(self, request, client_address):
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    logger.exception("Error handling piccolod request")
+                finally:
+                    self.shutdown_request(request)
+
+        path = config.DAEMON_SOCKET
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.unlink(path) # left over from a piccolod that didn't exit cleanly
+            else:
+                logger.error("piccolod is already running on {0}".format(path))
+                sys.exit(1)
+            finally:
+                probe.close()
+
+        pool = ThreadPool(self.workers)
+        old_umask = os.umask(0177)
+        try:
+            server = Server(path, Handler)
+        finally:
+            os.umask(old_umask)
+        os.chmod(path, 0600)
+
+        logging.getLogger().addHandler(self.log_router)
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+
+        def stop(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, stop)
+
+        sender = threading.Thread(target=mail.sender_loop, args=(MAIL_INTERVAL,), name="mail sender")
+        sender.daemon = True
+        sender.start()
+
+        logger.info("piccolod listening on {0} with {1} workers".format(path, self.workers))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(path)
+            pool.close()
+            pool.join()
+            sys.stdout, sys.stderr = self.stdout.real, self.stderr.real
+            logger.info("piccolod stopped")
@@ -1,11 +1,150 @@
-import logging, psycopg2, MySQLdb
+import logging, threading, time, atexit, os
 from piccolo import db, config, shell
 
 logger = logging.getLogger(__name__)
 
+class AdminConnections(object):
+    '''Keeps one admin connection per DBMS (per thread) open for the life of
+    the process, so provisioning doesn't log in to the database servers for
+    every statement. Connections that have sat idle are health-checked
+    before reuse and reopened if the server has dropped them; one that fails
+    mid-statement is dropped at once. Short-lived threads (parallel.run_each's)
+    close theirs with close_thread().'''
+    HEALTH_CHECK_AFTER = 30 # seconds idle
+    MYSQL_LOST = (2006, 2013, 2055) # server has gone away, lost connection, lost connection to server
+    
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._open = []
+    
+    def _connect(self, dbms):
+        # The drivers are only imported once a command actually needs a server
+        if dbms == Database.POSTGRESQL:
+            import psycopg2, psycopg2.extensions
+            logger.debug("Opening PostgreSQL admin connection")
+            conn = psycopg2.connect(
+                user=config.POSTGRESQL['username'],
+                password=config.POSTGRESQL['password'],
+                database="postgres")
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        elif dbms == Database.MYSQL:
+            import MySQLdb
+            logger.debug("Opening MySQL admin connection")
+            conn = MySQLdb.connect(
+                user=config.MYSQL['username'],
+                passwd=config.MYSQL['password'],
+                db="mysql",
+            )
+            conn.autocommit(True)
+        else:
+            raise Exception("Invalid DBMS")
+        with self._lock:
+            self._open.append(conn)
+        return conn
+    
+    def _healthy(self, dbms, conn):
+        try:
+            if dbms == Database.POSTGRESQL:
+                if conn.closed:
+                    return False
+                cur = conn.cursor()
+                cur.execute("SELECT 1;")
+                cur.close()
+            else:
+                conn.ping()
+        except Exception:
+            return False
+        return True
+    
+    def _discard(self, conn):
+        with self._lock:
+            if conn in self._open:
+                self._open.remove(conn)
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def _lost(self, dbms, conn, error):
+        '''Whether error means conn itself is no use any more'''
+        if dbms == Database.POSTGRESQL:
+            return bool(conn.closed)
+        import MySQLdb
+        return isinstance(error, MySQLdb.InterfaceError) or bool(error.args) and error.args[0] in AdminConnections.MYSQL_LOST
+    
+    def cursor(self, dbms):
+        '''Returns (connection, cursor) for dbms. If a statement fails because
+        the connection is gone, the connection is dropped, so the next caller
+        gets a new one.'''
+        conn = self.get(dbms)
+        def failed(error):
+            if self._lost(dbms, conn, error):
+                logger.info("Admin connection was lost; it will be reopened")
+                connections = getattr(self._local, 'connections', {})
+                if connections.get(dbms, (None,))[0] is conn:
+                    del connections[dbms]
+                self._discard(conn)
+        return conn, _AdminCursor(conn.cursor(), failed)
+    
+    def get(self, dbms):
+        '''Returns this thread's admin connection for dbms, opening or
+        replacing it as needed'''
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        conn, last_used = self._local.connections.get(dbms, (None, 0))
+        now = time.time()
+        if conn is not None and now - last_used > AdminConnections.HEALTH_CHECK_AFTER:
+            if not self._healthy(dbms, conn):
+                logger.info("Admin connection was lost; reconnecting")
+                self._discard(conn)
+                conn = None
+        if conn is None:
+            conn = self._connect(dbms)
+        self._local.connections[dbms] = (conn, now)
+        return conn
+    
+    def close_thread(self):
+        '''Closes the calling thread's connections'''
+        connections = getattr(self._local, 'connections', {})
+        for conn, last_used in connections.values():
+            self._discard(conn)
+        connections.clear()
+    
+    def close_all(self):
+        with self._lock:
+            connections, self._open = self._open, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self._local = threading.local()
+
+class _AdminCursor(object):
+    '''A DB-API cursor that reports errors from execute() to `failed`'''
+    def __init__(self, cursor, failed):
+        self._cursor = cursor
+        self._failed = failed
+    
+    def execute(self, *args, **kwargs):
+        try:
+            return self._cursor.execute(*args, **kwargs)
+        except Exception as e:
+            self._failed(e)
+            raise
+    
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+admin_connections = AdminConnections()
+atexit.register(admin_connections.close_all)
+
 class Database(db.Base):
     MYSQL = 1
     POSTGRESQL = 2
+    COMPRESSOR = ['gzip', '-c']
+    DECOMPRESSOR = ['gunzip', '-c']
     
     __tablename__ = 'databases'
     dbname = db.Column(db.String(64), primary_key=True)
@@ -32,40 +171,43 @@ class Database(db.Base):
     
     @staticmethod
     def _postgres():
-        conn = psycopg2.connect(
-            user=config.POSTGRESQL['username'],
-            password=config.POSTGRESQL['password'],
-            database="postgres")
-        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        return conn, conn.cursor()
+        return admin_connections.cursor(Database.POSTGRESQL)
     
     @staticmethod
     def _mysql():
-        conn = MySQLdb.connect(
-            user=config.MYSQL['username'],
-            passwd=config.MYSQL['password'],
-            db="mysql",
-        )
-        return conn, conn.cursor()
+        return admin_connections.cursor(Database.MYSQL)
     
     @staticmethod
     def _mysql_exists(dbname):
         conn, cur = Database._mysql()
         cur.execute("SELECT SCHEMA_NAME FROM INFORMATION_SCHEMA.SCHEMATA WHERE SCHEMA_NAME = %s;", (dbname,))
-        if cur.fetchone():
-            return True
-        else:
-            return False
+        found = cur.fetchone()
+        cur.close()
+        return bool(found)
         
     @staticmethod
     def _postgres_exists(dbname):
         conn, cur = Database._postgres()
         cur.execute("SELECT datname FROM pg_database WHERE datname = %s;", (dbname,))
-        if cur.fetchone():
-            return True
+        found = cur.fetchone()
+        cur.close()
+        return bool(found)
+    
+    @staticmethod
+    def _existing(dbms, dbnames):
+        '''Returns the subset of dbnames that already exist on the server, in
+        one query'''
+        if dbms == Database.MYSQL:
+            conn, cur = Database._mysql()
+            cur.execute("SELECT SCHEMA_NAME FROM INFORMATION_SCHEMA.SCHEMATA WHERE SCHEMA_NAME IN %s;", (tuple(dbnames),))
+        elif dbms == Database.POSTGRESQL:
+            conn, cur = Database._postgres()
+            cur.execute("SELECT datname FROM pg_database WHERE datname IN %s;", (tuple(dbnames),))
         else:
-            return False
-        conn.close()
+            raise Exception("Invalid DBMS")
+        found = set(row[0] for row in cur.fetchall())
+        cur.close()
+        return found
     
     def _create(self, ignore_exists):
         if self.dbms == Database.MYSQL:
@@ -87,7 +229,8 @@ class Database(db.Base):
             conn, cur = Database._mysql()
             if not ignore_exists:
                 cur.execute("CREATE DATABASE `{0}`;".format(self.dbname)) # not using builtin escapes because they quote wrong, and the risk of injection is tiny here
-            cur.execute("GRANT ALL PRIVILEGES ON `{0}`.* TO %s@localhost;".format(self.dbname), (self.site.db_username,))
+            cur.execute("GRANT ALL PRIVILEGES ON `{0}`.* TO %s@localhost;".format(self.dbname), (self.site.db_username_mysql,))
+            cur.close()
     
     def _postgres_create(self, ignore_exists):
         if Database._postgres_exists(self.dbname):
@@ -99,6 +242,7 @@ class Database(db.Base):
                 cur.execute("ALTER DATABASE {0} OWNER TO {1};".format(self.dbname, self.site.db_username))
             else:
                 cur.execute("CREATE DATABASE {0} WITH OWNER = {1};".format(self.dbname, self.site.db_username))
+            cur.close()
     
     def _drop(self):
         if self.dbms == Database.MYSQL:
@@ -117,6 +261,7 @@ class Database(db.Base):
             raise Database.DoesNotExist
         conn, cur = Database._mysql()
         cur.execute("DROP DATABASE {0};".format(self.dbname))
+        cur.close()
         # cur.execute("REVOKE ALL PRIVILEGES ON {0}.* FROM %s@localhost;".format(self.dbname), (self.site.shortname,))
     
     def _postgres_drop(self):
@@ -124,6 +269,7 @@ class Database(db.Base):
             raise Database.DoesNotExist
         conn, cur = Database._postgres()
         cur.execute("DROP DATABASE {0};".format(self.dbname))
+        cur.close()
     
     def _dbms_string(self):
         if self.dbms == Database.MYSQL:
@@ -135,12 +281,7 @@ class Database(db.Base):
     
     @staticmethod
     def get(dbname):
-        session = db.Session()
-        q = session.query(Database).filter(Database.dbname == dbname)
-        if (q.count() == 1):
-            return q.first()
-        else:
-            return None
+        return db.get(Database, dbname)
     
     @staticmethod
     def create(dbname, site, dbms, fake_create):
@@ -157,6 +298,67 @@ class Database(db.Base):
             with open(shell.join(site._get_home(), 'config', 'databases.txt'), 'a') as db_list:
                 db_list.write("[{0}] {1}\n".format(new_db._dbms_string(), new_db.dbname))
     
+    @staticmethod
+    def create_many(dbnames, site, dbms, fake_create):
+        '''Creates several databases for one site, checking for existing
+        databases with one query and creating and granting them all on the same
+        admin connection. With fake_create, databases that already exist on
+        the server are handed to the site instead.'''
+        session = db.Session()
+        dbnames = list(dbnames)
+        if len(set(dbnames)) != len(dbnames):
+            raise Database.BadName("Database names were listed more than once")
+        for dbname in dbnames:
+            if len(dbname) > 63:
+                raise Database.BadName("Database names must be < 63 characters long")
+        in_piccolo = session.query(Database.dbname).filter(Database.dbname.in_(dbnames)).all()
+        if in_piccolo:
+            raise Database.Exists("Already in piccolo: {0}".format(', '.join(row[0] for row in in_piccolo)))
+        dbms_string = {Database.MYSQL: 'MySQL', Database.POSTGRESQL: 'PostgreSQL'}[dbms]
+        
+        if shell.is_pretend():
+            for dbname in dbnames:
+                logger.info("Creating {0} database {1}".format(dbms_string, dbname))
+            return
+        
+        existing = Database._existing(dbms, dbnames)
+        if existing and not fake_create:
+            raise Database.Exists("Already on the {0} server: {1}".format(dbms_string, ', '.join(sorted(existing))))
+        
+        recorded = [] # created or handed over so far; recorded even if a later one fails
+        try:
+            if dbms == Database.MYSQL:
+                conn, cur = Database._mysql()
+                for dbname in dbnames:
+                    if dbname not in existing:
+                        logger.info("Creating MySQL database {0}".format(dbname))
+                        cur.execute("CREATE DATABASE `{0}`;".format(dbname))
+                        recorded.append(dbname)
+                    cur.execute("GRANT ALL PRIVILEGES ON `{0}`.* TO %s@localhost;".format(dbname), (site.db_username_mysql,))
+                    if dbname in existing:
+                        recorded.append(dbname)
+            else:
+                conn, cur = Database._postgres()
+                for dbname in dbnames:
+                    if dbname in existing:
+                        logger.info("Handing existing PostgreSQL database {0} to {1}".format(dbname, site.db_username))
+                        cur.execute("ALTER DATABASE {0} OWNER TO {1};".format(dbname, site.db_username))
+                    else:
+                        logger.info("Creating PostgreSQL database {0}".format(dbname))
+                        cur.execute("CREATE DATABASE {0} WITH OWNER = {1};".format(dbname, site.db_username))
+                    recorded.append(dbname)
+            cur.close()
+        finally:
+            if len(recorded) < len(dbnames):
+                logger.error("Only some databases were created; recording {0}".format(', '.join(recorded) or "none of them"))
+            if recorded:
+                # Only build the rows now: attaching them to the site puts them in the session
+                new_dbs = [Database(dbname, site, dbms) for dbname in recorded]
+                session.add_all(new_dbs)
+                session.commit()
+                with open(shell.join(site._get_home(), 'config', 'databases.txt'), 'a') as db_list:
+                    db_list.write(''.join("[{0}] {1}\n".format(dbms_string, new_db.dbname) for new_db in new_dbs))
+    
     @staticmethod
     def delete(dbname, site):
         session = db.Session()
@@ -179,16 +381,46 @@ class Database(db.Base):
             with open(shell.join(site._get_home(), 'config', 'databases.txt'), 'w') as db_list:
                 db_list.write(new_db_list)
     
-    def dump(dbname, destination):
-        if Database.get(dbname):
-            raise Database.DoesNotExist
-        # test exists
-        # dump (_my,_post)
-        pass
+    def _dump_command(self):
+        '''The dump program's arguments, and the environment that carries the
+        admin password (so it never shows up in ps)'''
+        if self.dbms == Database.MYSQL:
+            return (['mysqldump', '--single-transaction', '--routines', '--user=' + config.MYSQL['username'], self.dbname],
+                {'MYSQL_PWD': config.MYSQL['password']})
+        elif self.dbms == Database.POSTGRESQL:
+            return (['pg_dump', '--no-owner', '--no-privileges', '--username=' + config.POSTGRESQL['username'], self.dbname],
+                {'PGPASSWORD': config.POSTGRESQL['password']})
+        else:
+            raise Exception("Invalid DBMS")
     
-    def restore(dbname, source):
-        if Database.get(dbname):
-            raise Database.DoesNotExist
-        # hmm don't run this without knowing what the source file does...
-        # limit it to one db?
-        pass
\ No newline at end of file
+    def dump(self, out, throttle=None):
+        '''Streams a gzipped dump of the database into file object out, piping
+        the dump program straight into the compressor. A throttle holds the
+        dump (before compression) to its rate. Returns the compressed size.'''
+        command, env = self._dump_command()
+        return shell.pipe([command, Database.COMPRESSOR], out, env=env, throttle=throttle)
+    
+    def _restore_command(self):
+        '''The client program's arguments and environment for loading SQL as the
+        site's own role, so a restore can't touch anything the site couldn't'''
+        if self.dbms == Database.MYSQL:
+            return (['mysql', '--user=' + self.site.db_username_mysql, self.dbname],
+                {'MYSQL_PWD': self.site.db_password})
+        elif self.dbms == Database.POSTGRESQL:
+            return (['psql', '--quiet', '--no-psqlrc', '--single-transaction', '--set=ON_ERROR_STOP=1',
+                    '--host=localhost', '--username=' + self.site.db_username, '--dbname=' + self.dbname],
+                {'PGPASSWORD': self.site.db_password})
+        else:
+            raise Exception("Invalid DBMS")
+    
+    def restore(self, source, throttle=None):
+        '''Streams a gzipped dump from file object source through the
+        decompressor into the database. Returns the compressed size read.'''
+        command, env = self._restore_command()
+        source = shell.Metered(source, throttle)
+        with open(os.devnull, 'wb') as discard: # the client's chatter; errors are on stderr
+            shell.pipe([Database.DECOMPRESSOR, command], discard, env=env, input=source)
+        return source.bytes
+
+# Database.site names Site, which piccolo.sites declares
+import piccolo.sites
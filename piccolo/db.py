@@ -1,12 +1,58 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Table, Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Table, Column, Integer, Float, String, Text, Boolean, DateTime, ForeignKey
 from sqlalchemy.orm import relationship, backref
 from piccolo.config import DATABASE
+import threading
 
 Base = declarative_base()
 
-sqlite_db = create_engine('sqlite:///' +  DATABASE)
-Session = scoped_session(sessionmaker(bind=sqlite_db))
\ No newline at end of file
+sqlite_db = create_engine('sqlite:///' +  DATABASE, connect_args={'timeout': 30}) # wait out concurrent writers
+# A session lasts one command (or one piccolod request, which removes it when
+# done), so objects stay usable after commit instead of being reloaded on next
+# access
+session_factory = sessionmaker(bind=sqlite_db, expire_on_commit=False)
+Session = scoped_session(session_factory)
+
+def _missing(session):
+    '''(class, primary key) pairs this session found not to exist. Hits don't
+    need a cache of their own: the session's identity map already holds them.
+    Kept with the session so that rows other processes add are seen by the
+    next command or request.'''
+    return session.info.setdefault('missing', set())
+
+def get(cls, key):
+    '''Looks up a row by primary key. Objects already loaded in this session
+    come from its identity map without a query, and keys already found to be
+    missing are remembered until a row with that key is flushed.'''
+    session = Session()
+    missing = _missing(session)
+    if (cls, key) in missing:
+        return None
+    found = session.query(cls).get(key)
+    if found is None:
+        missing.add((cls, key))
+    return found
+
+_created = set()
+_create_lock = threading.Lock()
+
+def ensure_tables(*classes):
+    '''Creates tables added after a piccolo DB was first set up, once per process'''
+    with _create_lock:
+        for cls in classes:
+            if cls not in _created:
+                cls.__table__.create(sqlite_db, checkfirst=True)
+                _created.add(cls)
+
+def clear_lookup_cache():
+    _missing(Session()).clear()
+
+@event.listens_for(session_factory, 'after_flush')
+def _invalidate_missing(session, flush_context):
+    missing = _missing(session)
+    for obj in session.new:
+        key = inspect(obj).mapper.primary_key_from_instance(obj)
+        missing.discard((type(obj), key[0] if len(key) == 1 else tuple(key)))
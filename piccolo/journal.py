@@ -0,0 +1,141 @@
+import datetime, json, logging
+from piccolo import db, shell, oplog
+
+"""
+A record of each provisioning step taken for a site or domain, so that a
+provisioning run that fails partway can be finished (resume) or taken back
+(rollback) without redoing or guessing at the steps that already worked.
+
+A plan is a list of (name, do, undo) tuples, where do and undo take no
+arguments and undo may be None when a later undo covers it. Steps must be safe
+to run again after failing partway, since resuming reruns the failed one, and
+undos must cope with a step that only got partway, since rolling back undoes
+the failed one too.
+
+Users aren't journaled: User.create removes an account that fails partway, so
+there's never a half-made one to resume or roll back.
+"""
+
+logger = logging.getLogger(__name__)
+
+class Step(db.Base):
+    __tablename__ = 'journal'
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    UNDONE = 'undone'
+
+    id = db.Column(db.Integer, primary_key=True)
+    owner = db.Column(db.String(64), index=True) # "site:foo" or "domain:foo.example.com"
+    position = db.Column(db.Integer)
+    name = db.Column(db.String(64))
+    inputs = db.Column(db.Text) # JSON
+    status = db.Column(db.String(10))
+    error = db.Column(db.String(255))
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __init__(self, owner, position, name, inputs):
+        self.owner = owner
+        self.position = position
+        self.name = name
+        self.inputs = json.dumps(inputs, sort_keys=True)
+        self.status = Step.PENDING
+
+    def __str__(self):
+        return u"<Step {0} {1}: {2}>".format(self.owner, self.name, self.status)
+
+    __unicode__ = __str__
+
+    def describe(self):
+        text = "{0:<16} {1}".format(self.name, self.status)
+        if self.finished_at:
+            text += " at {0:%Y-%m-%d %H:%M:%S}".format(self.finished_at)
+        if self.error:
+            text += ": " + self.error
+        return text
+
+def steps(owner):
+    '''The journal for owner, in plan order'''
+    db.ensure_tables(Step)
+    return db.Session().query(Step).filter_by(owner=owner).order_by(Step.position).all()
+
+def incomplete(owner):
+    return any(step.status != Step.DONE for step in steps(owner))
+
+def incomplete_owners():
+    '''Every owner with unfinished provisioning, in one query'''
+    db.ensure_tables(Step)
+    return set(row[0] for row in db.Session().query(Step.owner).filter(Step.status != Step.DONE).distinct())
+
+def _record(session, step, status, error=None):
+    step.status = status
+    step.error = None if error is None else str(error)[:255]
+    step.finished_at = datetime.datetime.now()
+    session.commit()
+
+def run(owner, plan, inputs):
+    '''Runs each step of plan that the journal doesn't already have as done,
+    in order, recording each outcome as it goes. Stops at (and re-raises) the
+    first failure. In pretend mode the steps run but nothing is recorded.'''
+    if shell.is_pretend():
+        for name, do, undo in plan:
+            do()
+        return
+    db.ensure_tables(Step)
+    session = db.Session()
+    journal = dict((step.name, step) for step in steps(owner))
+    for position, (name, do, undo) in enumerate(plan):
+        step = journal.get(name)
+        if step is not None and step.status == Step.DONE:
+            logger.debug("{0}: {1} already done".format(owner, name))
+            continue
+        if step is None:
+            step = Step(owner, position, name, inputs)
+            session.add(step)
+        elif step.status == Step.FAILED:
+            logger.info("{0}: retrying {1}, which failed: {2}".format(owner, name, step.error))
+        step.started_at = datetime.datetime.now()
+        session.commit()
+        try:
+            with oplog.step(name, owner):
+                do()
+        except Exception as e:
+            session.rollback() # in case it was the DB that failed
+            _record(session, step, Step.FAILED, e)
+            raise
+        _record(session, step, Step.DONE)
+
+def rollback(owner, plan):
+    '''Undoes the steps the journal has as started (done, failed, or cut off
+    partway), last first, marking each as undone. In pretend mode the same
+    undos run but nothing is recorded.'''
+    session = db.Session()
+    journal = dict((step.name, step) for step in steps(owner))
+    for name, do, undo in reversed(plan):
+        step = journal.get(name)
+        if step is None or step.status == Step.UNDONE or step.started_at is None:
+            continue
+        logger.info("{0}: undoing {1}".format(owner, name))
+        if shell.is_pretend():
+            if undo is not None:
+                undo()
+            continue
+        if undo is not None:
+            try:
+                with oplog.step('undo ' + name, owner):
+                    undo()
+            except Exception as e:
+                step.error = "undo failed: {0}".format(e)[:255]
+                session.commit()
+                raise
+        _record(session, step, Step.UNDONE)
+
+def forget(owner):
+    '''Drops owner's journal, once what it provisioned is gone'''
+    if shell.is_pretend():
+        return
+    db.ensure_tables(Step)
+    session = db.Session()
+    session.query(Step).filter_by(owner=owner).delete(synchronize_session=False)
+    session.commit()
@@ -1,5 +1,6 @@
-import logging, logging.handlers, os, os.path
+import logging, logging.handlers, os, os.path, atexit
 from piccolo.config import LOGGING
+from piccolo import oplog
 from piccolo.commands.colors import *
 
 class ColorFormatter(logging.Formatter):
@@ -40,6 +41,8 @@ plain_formatter = logging.Formatter('%(asctime)s - [%(levelname)s] %(message)s')
 ch.setFormatter(color_formatter)
 fh.setFormatter(plain_formatter)
 
-# add ch, fh to logger
+# add ch to logger; fh and the operation log are written from a background
+# thread, so logging never waits on the disk
 logger.addHandler(ch)
-logger.addHandler(fh)
\ No newline at end of file
+listener = oplog.start([fh])
+atexit.register(listener.stop)
\ No newline at end of file
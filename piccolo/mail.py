@@ -0,0 +1,254 @@
+import logging, os, smtplib, socket, threading, datetime
+from email.mime.text import MIMEText
+from piccolo import db, config, shell
+
+"""
+Outgoing email. Messages are queued in the outbox table as part of whatever
+command generated them, and sent afterwards by flush(), which drains the queue
+over a single SMTP connection: at the end of the command, by piccolod's sender
+thread, or by `piccolo mail flush`.
+"""
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50 # messages claimed (and committed) at a time
+MAX_ATTEMPTS = 6
+RETRY_DELAY = 60 # seconds before the first retry, doubled for each one after
+CLAIM_TIMEOUT = 600 # seconds after which a claim by a flusher that died is released
+SMTP_TIMEOUT = 30
+
+class Message(db.Base):
+    __tablename__ = 'outbox'
+    QUEUED = 'queued'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(255))
+    recipient_name = db.Column(db.String(255))
+    subject = db.Column(db.String(255))
+    body = db.Column(db.Text)
+    status = db.Column(db.String(10), index=True)
+    attempts = db.Column(db.Integer)
+    queued_at = db.Column(db.DateTime)
+    next_attempt = db.Column(db.DateTime)
+    claimed_by = db.Column(db.String(64))
+    claimed_at = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String(255))
+
+    def __init__(self, recipient, recipient_name, subject, body):
+        now = datetime.datetime.utcnow()
+        self.recipient = recipient
+        self.recipient_name = recipient_name
+        self.subject = subject
+        self.body = body
+        self.status = Message.QUEUED
+        self.attempts = 0
+        self.queued_at = now
+        self.next_attempt = now
+
+    def __str__(self):
+        return u"<Message {0}: {1} to {2}>".format(self.id, self.subject, self.recipient)
+
+    __unicode__ = __str__
+
+    def as_string(self):
+        msg = MIMEText(self.body)
+        msg['Subject'] = self.subject
+        msg['From'] = "{0} <{1}>".format(config.EMAIL['friendly_name'], config.EMAIL['username'])
+        msg['To'] = "{0} <{1}>".format(self.recipient_name, self.recipient)
+        return msg.as_string()
+
+# Set whenever this process queues a message, so the command line (and piccolod's
+# sender thread) know there's something to flush
+_queued = threading.Event()
+
+def queued_since_flush():
+    return _queued.is_set()
+
+def queue(recipient, recipient_name, subject, body):
+    '''Adds a message to the outbox. It's committed with the caller's session.'''
+    if shell.is_pretend():
+        logger.info("Pretending to queue email to {0}: {1}".format(recipient, subject))
+        return None
+    db.ensure_tables(Message)
+    message = Message(recipient, recipient_name, subject, body)
+    db.Session().add(message)
+    _queued.set()
+    logger.debug("Queued email to {0}: {1}".format(recipient, subject))
+    return message
+
+class _Connection(object):
+    '''One SMTP connection, opened on first use and reopened after it breaks'''
+    def __init__(self):
+        self.smtp = None
+
+    def open(self):
+        smtp = smtplib.SMTP(config.EMAIL['smtp_server'], int(config.EMAIL['smtp_port']), timeout=SMTP_TIMEOUT)
+        if config.EMAIL['starttls']:
+            smtp.starttls()
+        if config.EMAIL['password']:
+            smtp.login(config.EMAIL['username'], config.EMAIL['password'])
+        self.smtp = smtp
+
+    def send(self, message):
+        if self.smtp is None:
+            self.open()
+        self.smtp.sendmail(config.EMAIL['username'], [message.recipient], message.as_string())
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.smtp = None
+
+def _is_permanent(e):
+    '''Whether the server refused for good (5xx), so retrying is pointless'''
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, response in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return e.smtp_code >= 500
+    return False
+
+def _defer(message, error, now, quiet=False):
+    '''Schedules another attempt, unless this was the last one. Returns whether
+    the message will be retried.'''
+    message.attempts += 1
+    message.last_error = str(error)[:255]
+    message.claimed_by = None
+    if message.attempts >= MAX_ATTEMPTS:
+        message.status = Message.FAILED
+        logger.error("Giving up on email to {0} after {1} attempts: {2}".format(message.recipient, message.attempts, error))
+        return False
+    else:
+        message.status = Message.QUEUED
+        message.next_attempt = now + datetime.timedelta(seconds=RETRY_DELAY * 2 ** (message.attempts - 1))
+        (logger.debug if quiet else logger.warning)("Couldn't send email to {0} (will retry at {1:%H:%M:%S} UTC): {2}".format(message.recipient, message.next_attempt, error))
+    return True
+
+def _claim(session, token, now, limit):
+    '''Marks a batch of due messages as ours, so concurrent flushers (say, the
+    command line and piccolod) never send the same message twice'''
+    due = session.query(Message.id).filter(
+        Message.status == Message.QUEUED,
+        Message.next_attempt <= now,
+    ).order_by(Message.id).limit(limit)
+    ids = [row.id for row in due]
+    if not ids:
+        return []
+    session.query(Message).filter(
+        Message.id.in_(ids),
+        Message.status == Message.QUEUED,
+    ).update({'status': Message.SENDING, 'claimed_by': token, 'claimed_at': now}, synchronize_session=False)
+    session.commit()
+    return session.query(Message).filter_by(status=Message.SENDING, claimed_by=token).order_by(Message.id).all()
+
+def _release_stale_claims(session, now):
+    stale = session.query(Message).filter(
+        Message.status == Message.SENDING,
+        Message.claimed_at < now - datetime.timedelta(seconds=CLAIM_TIMEOUT),
+    ).update({'status': Message.QUEUED, 'claimed_by': None}, synchronize_session=False)
+    if stale:
+        logger.warning("Requeued {0} emails claimed by a sender that never finished".format(stale))
+    # Messages sent before bodies were cleared on sending
+    session.query(Message).filter(
+        Message.status == Message.SENT,
+        Message.body != None,
+    ).update({'body': None}, synchronize_session=False)
+    session.commit()
+
+def flush(limit=None):
+    '''Sends every due message over one SMTP connection. Returns the number of
+    messages sent, deferred for a retry, and given up on.'''
+    if shell.is_pretend():
+        logger.info("Pretending to send queued email")
+        return 0, 0, 0
+    db.ensure_tables(Message)
+    _queued.clear()
+    session = db.Session()
+    token = "{0}:{1}:{2}".format(socket.gethostname(), os.getpid(), threading.current_thread().ident)
+    sent = deferred = failed = 0
+    _release_stale_claims(session, datetime.datetime.utcnow())
+    connection = _Connection()
+    try:
+        while limit is None or sent + deferred + failed < limit:
+            now = datetime.datetime.utcnow()
+            batch_size = BATCH_SIZE if limit is None else min(BATCH_SIZE, limit - sent - deferred - failed)
+            batch = _claim(session, token, now, batch_size)
+            if not batch:
+                break
+            for i, message in enumerate(batch):
+                if connection.smtp is None:
+                    try:
+                        connection.open()
+                    except (smtplib.SMTPException, socket.error) as e:
+                        # The rest of the batch would only fail the same way
+                        logger.error("Couldn't connect to mail server {0}: {1}".format(config.EMAIL['smtp_server'], e))
+                        for unsent in batch[i:]:
+                            if _defer(unsent, e, now, quiet=True):
+                                deferred += 1
+                            else:
+                                failed += 1
+                        session.commit()
+                        return sent, deferred, failed
+                try:
+                    connection.send(message)
+                except (smtplib.SMTPException, socket.error) as e:
+                    if _is_permanent(e):
+                        message.attempts += 1
+                        message.status = Message.FAILED
+                        message.last_error = str(e)[:255]
+                        message.claimed_by = None
+                        failed += 1
+                        logger.error("Mail server refused email to {0}: {1}".format(message.recipient, e))
+                        continue
+                    if not isinstance(e, smtplib.SMTPResponseException) and not isinstance(e, smtplib.SMTPRecipientsRefused):
+                        connection.close() # lost the connection; reconnect for the next message
+                    if _defer(message, e, now):
+                        deferred += 1
+                    else:
+                        failed += 1
+                else:
+                    message.status = Message.SENT
+                    message.body = None # may hold an initial password; nothing reads it once sent
+                    message.attempts += 1
+                    message.sent_at = datetime.datetime.utcnow()
+                    message.claimed_by = None
+                    sent += 1
+                    logger.info("Sent email to {0}: {1}".format(message.recipient, message.subject))
+            session.commit()
+    finally:
+        connection.close()
+        if sent or deferred or failed:
+            logger.debug("Mail flush: {0} sent, {1} deferred, {2} failed".format(sent, deferred, failed))
+    return sent, deferred, failed
+
+def retry_failed():
+    '''Puts every message that was given up on back in the queue'''
+    db.ensure_tables(Message)
+    session = db.Session()
+    count = session.query(Message).filter_by(status=Message.FAILED).update({
+        'status': Message.QUEUED,
+        'attempts': 0,
+        'next_attempt': datetime.datetime.utcnow(),
+    }, synchronize_session=False)
+    session.commit()
+    if count:
+        _queued.set()
+    return count
+
+def sender_loop(interval):
+    '''Flushes the outbox whenever this process queues something, and every
+    interval seconds so retries go out. For piccolod's sender thread.'''
+    while True:
+        _queued.wait(interval)
+        try:
+            flush()
+        except Exception:
+            logger.exception("Mail flush failed")
+        finally:
+            db.Session.remove()
@@ -0,0 +1,111 @@
+import fcntl, logging, os, threading, time
+from contextlib import contextmanager
+from piccolo import config, shell
+from piccolo.shell import do
+
+"""
+Coalesces nginx reloads. Anything that changes nginx config does so inside
+changing() (or calls mark_dirty()), and the command line calls reload_if_dirty()
+once at the end of a command or batch, which validates the config and reloads
+nginx a single time. In piccolod each request tracks, and reloads for, its own
+changes; a reload waits for changes other threads are partway through.
+"""
+
+logger = logging.getLogger(__name__)
+
+LOCK_PATH = os.path.join(config.DATA_DIR, "nginx-reload.lock")
+STAMP_PATH = os.path.join(config.DATA_DIR, "nginx-reload.stamp")
+
+_state_lock = threading.Lock()
+_config_lock = threading.RLock() # held while config is written, and while it's validated and loaded
+
+class _Changes(object):
+    def __init__(self):
+        self.last = None # when config last changed, or None if it hasn't since the last reload
+
+_process = _Changes() # the command line's, and any thread that isn't tracking its own
+_local = threading.local()
+
+def _changes():
+    return getattr(_local, 'changes', None) or _process
+
+def track():
+    '''Gives the calling thread (a piccolod request) its own record of changes,
+    so its reload is for its own changes only'''
+    _local.changes = _Changes()
+
+def current():
+    '''This thread's record of changes, to hand to worker threads'''
+    return getattr(_local, 'changes', None)
+
+def adopt(changes):
+    '''Makes a worker thread's changes count towards `changes` (or the process's)'''
+    _local.changes = changes
+
+def mark_dirty():
+    '''Records that nginx config has changed and nginx needs a reload'''
+    if shell.is_pretend():
+        logger.debug("Pretending to schedule an nginx reload")
+        return
+    changes = _changes()
+    with _state_lock:
+        if changes.last is None:
+            logger.debug("nginx config changed; scheduling reload")
+        # The latest change, so a reload another process starts partway through
+        # a long batch doesn't stand in for the changes made after it
+        changes.last = time.time()
+
+@contextmanager
+def changing():
+    '''Wraps writing nginx config: reloads wait until it's done, and it's
+    marked for a reload even if it fails partway'''
+    with _config_lock:
+        try:
+            yield
+        finally:
+            mark_dirty()
+
+def is_dirty():
+    return _changes().last is not None
+
+def _last_reload_started():
+    try:
+        with open(STAMP_PATH, 'r') as stamp:
+            return float(stamp.read().strip())
+    except (IOError, ValueError):
+        return None
+
+def _validate_and_reload():
+    with _config_lock: # so neither step sees another thread's config half-written
+        start = time.time()
+        do("nginx -t", strict=True) # never reload a broken config, even with --force
+        validated = time.time()
+        do("service nginx reload")
+        done = time.time()
+    logger.info("Reloaded nginx (validate {0:.2f}s, reload {1:.2f}s)".format(validated - start, done - validated))
+
+def reload_if_dirty():
+    '''Validates and reloads nginx if this thread's changes (or the process's)
+    were marked since the last reload. Concurrent piccolo processes take
+    turns on a lock file, and a process skips its reload if another one
+    started reloading after its last change was made.'''
+    changes = _changes()
+    with _state_lock:
+        last_change, changes.last = changes.last, None
+    if last_change is None:
+        return
+    
+    wait_start = time.time()
+    with open(LOCK_PATH, 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        waited = time.time() - wait_start
+        if waited > 0.1:
+            logger.info("Waited {0:.2f}s for another piccolo process to reload nginx".format(waited))
+        last_started = _last_reload_started()
+        if last_started is not None and last_started >= last_change:
+            logger.info("nginx was reloaded by another piccolo process after these changes; not reloading again")
+            return
+        started = time.time()
+        _validate_and_reload()
+        with open(STAMP_PATH, 'w') as stamp:
+            stamp.write(repr(started))
@@ -0,0 +1,306 @@
+import logging, logging.handlers, threading, os, time, json, datetime, re, glob, random
+from contextlib import contextmanager
+from piccolo.config import LOGGING
+
+"""
+The operation log: one JSON object per line recording each command piccolo
+runs (an operation, with an id and a target like "site:foo"), each provisioning
+step it takes with its duration and outcome, and what it logged at INFO and
+above along the way. Records reach the files through a queue drained by a
+background thread, so provisioning never waits on log I/O, and messages are
+only formatted there.
+
+Each day's lines go to LOGGING['directory']/operations-YYYYMMDD.jsonl, which
+keeps retention (by age, then total size) to deleting whole files, and lets a
+query skip the days before --since without reading them.
+"""
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError: # Python 2
+    class QueueHandler(logging.Handler):
+        '''Hands records to a queue, for a QueueListener to emit from its own thread'''
+        def __init__(self, queue):
+            logging.Handler.__init__(self)
+            self.queue = queue
+
+        def prepare(self, record):
+            return record
+
+        def emit(self, record):
+            try:
+                self.queue.put_nowait(self.prepare(record))
+            except Exception:
+                self.handleError(record)
+
+    class QueueListener(object):
+        '''Emits records from a queue to handlers, on a background thread'''
+        _sentinel = None
+
+        def __init__(self, queue, *handlers, **kwargs):
+            self.queue = queue
+            self.handlers = handlers
+            self.respect_handler_level = kwargs.get('respect_handler_level', False)
+            self._thread = None
+
+        def start(self):
+            self._thread = threading.Thread(target=self._monitor, name="piccolo-log")
+            self._thread.daemon = True
+            self._thread.start()
+
+        def handle(self, record):
+            for handler in self.handlers:
+                if not self.respect_handler_level or record.levelno >= handler.level:
+                    handler.handle(record)
+
+        def _monitor(self):
+            while True:
+                record = self.queue.get()
+                if record is self._sentinel:
+                    break
+                self.handle(record)
+
+        def stop(self):
+            self.queue.put_nowait(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+
+SEGMENT_PREFIX = 'operations-'
+SEGMENT_SUFFIX = '.jsonl'
+
+_local = threading.local()
+
+class Operation(object):
+    def __init__(self, command, target):
+        self.id = '%012x' % random.getrandbits(48)
+        self.command = command
+        self.target = target
+        self.errors = 0 # commands often log a failure rather than raise it
+
+def current():
+    '''This thread's operation, to hand to worker threads'''
+    return getattr(_local, 'operation', None)
+
+def adopt(operation):
+    '''Makes a worker thread's records part of operation (or of none)'''
+    _local.operation = operation
+    _local.steps = []
+
+def target_of(params):
+    if params.get('shortname'):
+        return 'site:' + params['shortname']
+    if params.get('username'):
+        return 'user:' + params['username']
+    if params.get('domain_name'):
+        return 'domain:' + params['domain_name']
+    return None
+
+# Operation and step events go only to the operation log, not the console
+events = logging.getLogger('piccolo.oplog')
+events.propagate = False
+
+def _event(level, message, *args, **fields):
+    events.log(level, message, *args, extra={'oplog': fields})
+
+@contextmanager
+def operation(command, target=None, params=None):
+    '''Records a command from start to finish. Operations don't nest: inside
+    one, this does nothing.'''
+    if current() is not None:
+        yield current()
+        return
+    op = Operation(command, target)
+    adopt(op)
+    _event(logging.INFO, "%s started", command, event='start', params=params)
+    start = time.time()
+    outcome = 'failed'
+    try:
+        yield op
+        outcome = 'errors' if op.errors else 'ok'
+    except SystemExit as e:
+        outcome = 'failed' if e.code else 'errors' if op.errors else 'ok'
+        raise
+    finally:
+        _event(logging.INFO if outcome == 'ok' else logging.ERROR, "%s %s", command, outcome,
+            event='end', duration=round(time.time() - start, 3), outcome=outcome)
+        adopt(None)
+
+@contextmanager
+def step(name, target=None):
+    '''Records one step of the current operation, with its duration and
+    outcome. Records logged inside it carry the step's name, and its target if
+    given.'''
+    if not hasattr(_local, 'steps'):
+        _local.steps = []
+    _local.steps.append((name, target))
+    start = time.time()
+    outcome = 'failed'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        _event(logging.INFO if outcome == 'ok' else logging.ERROR, "step %s %s", name, outcome,
+            event='step', duration=round(time.time() - start, 3), outcome=outcome)
+        _local.steps.pop()
+
+class _Stamp(logging.Filter):
+    '''Tags each record, in the thread that logged it, with that thread's
+    operation and step'''
+    def filter(self, record):
+        op = current()
+        steps = getattr(_local, 'steps', None)
+        record.op = op
+        if op is not None and record.levelno >= logging.ERROR and record.name != events.name:
+            op.errors += 1
+        record.step = steps[-1][0] if steps else None
+        target = None
+        for name, step_target in reversed(steps or []):
+            if step_target:
+                target = step_target
+                break
+        record.target = target or (op.target if op else None)
+        return True
+
+class _LazyQueueHandler(QueueHandler):
+    def prepare(self, record):
+        return record # formatted by the listener, not the caller
+
+def _segments(directory):
+    return sorted(glob.glob(os.path.join(directory, SEGMENT_PREFIX + '*' + SEGMENT_SUFFIX)))
+
+def _segment_day(path):
+    return os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass # another piccolo process got there first
+
+class OperationLogHandler(logging.Handler):
+    '''Appends records that belong to an operation to the day's JSON-lines
+    file, enforcing retention whenever it starts a new file'''
+    def __init__(self, directory, max_bytes, max_age_days):
+        logging.Handler.__init__(self)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self._day = None
+        self._stream = None
+
+    def _open(self, day):
+        if self._stream is not None:
+            self._stream.close()
+        self._day = day
+        self._stream = open(os.path.join(self.directory, SEGMENT_PREFIX + day + SEGMENT_SUFFIX), 'a')
+        self.prune()
+
+    def prune(self):
+        '''Deletes whole days older than max_age_days, then the oldest days
+        until the rest fit in max_bytes. The current day is always kept.'''
+        oldest = (datetime.date.today() - datetime.timedelta(days=self.max_age_days)).strftime('%Y%m%d')
+        kept = []
+        for path in _segments(self.directory):
+            if _segment_day(path) < oldest and _segment_day(path) != self._day:
+                _remove(path)
+            else:
+                kept.append((path, os.path.getsize(path)))
+        total = sum(size for path, size in kept)
+        for path, size in kept:
+            if total <= self.max_bytes or _segment_day(path) == self._day:
+                break
+            _remove(path)
+            total -= size
+
+    def emit(self, record):
+        if getattr(record, 'op', None) is None:
+            return
+        try:
+            entry = {
+                'ts': datetime.datetime.fromtimestamp(record.created).isoformat(),
+                'op': record.op.id,
+                'command': record.op.command,
+                'target': record.target,
+                'step': record.step,
+                'level': record.levelname,
+                'msg': record.getMessage(),
+            }
+            entry.update(getattr(record, 'oplog', None) or {'event': 'log'})
+            if record.exc_info:
+                entry['exception'] = logging.Formatter().formatException(record.exc_info)
+            day = time.strftime('%Y%m%d', time.localtime(record.created))
+            if day != self._day:
+                self._open(day)
+            self._stream.write(json.dumps(entry, sort_keys=True, default=str) + '\n')
+            self._stream.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        logging.Handler.close(self)
+
+def start(handlers):
+    '''Sends root and operation records at INFO and above through a queue to
+    the given handlers (plus the operation log), emitted on a background
+    thread. Returns the listener; stop it to flush at exit.'''
+    records = queue.Queue()
+    handler = _LazyQueueHandler(records)
+    handler.setLevel(logging.INFO)
+    handler.addFilter(_Stamp())
+    operations = OperationLogHandler(LOGGING['directory'],
+        LOGGING['operations_max_size'] * 1024 * 1024, LOGGING['operations_max_age'])
+    operations.setLevel(logging.INFO)
+    listener = QueueListener(records, operations, *handlers, respect_handler_level=True)
+    listener.start()
+    logging.getLogger().addHandler(handler)
+    events.addHandler(handler)
+    return listener
+
+_DURATION = re.compile(r'^(\d+)([mhdw])$')
+_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+
+def parse_since(text):
+    '''Turns "30m", "2h", "3d", "1w", "2024-05-01" or "2024-05-01 14:00" into a datetime'''
+    match = _DURATION.match(text.strip())
+    if match:
+        return datetime.datetime.now() - datetime.timedelta(**{_UNITS[match.group(2)]: int(match.group(1))})
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(text.strip(), fmt)
+        except ValueError:
+            pass
+    raise ValueError("Not a time: {0} (try 2h, 3d or 2024-05-01)".format(text))
+
+def query(since, target=None, op=None):
+    '''Yields the logged entries from since onwards, optionally only those for
+    one target or operation, oldest first'''
+    since_ts = since.isoformat()
+    # Cheap substring checks skip most lines without parsing them
+    needle = json.dumps(target) if target else json.dumps(op) if op else None
+    for path in _segments(LOGGING['directory']):
+        if _segment_day(path) < since.strftime('%Y%m%d'):
+            continue
+        with open(path) as segment:
+            for line in segment:
+                if needle and needle not in line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # a line cut short by a crash
+                if entry['ts'] < since_ts:
+                    continue
+                if target and entry.get('target') != target:
+                    continue
+                if op and entry.get('op') != op:
+                    continue
+                yield entry
@@ -0,0 +1,67 @@
+import logging, sys, time
+from multiprocessing.pool import ThreadPool
+from piccolo import db, shell, oplog, nginx
+
+"""
+Runs provisioning work for many targets concurrently. Piccolo mostly waits on
+subprocesses and database servers, so threads are enough; each worker thread
+gets its own db.Session through the scoped session registry.
+"""
+
+logger = logging.getLogger(__name__)
+
+class Result(object):
+    def __init__(self, item, ok, elapsed, value):
+        self.item = item
+        self.ok = ok
+        self.elapsed = elapsed
+        self.value = value # return value, or the exception if not ok
+
+def _run_isolated(func, item, flags, operation, changes):
+    start = time.time()
+    shell.isolate_flags(*flags)
+    oplog.adopt(operation)
+    nginx.adopt(changes)
+    try:
+        value = func(item)
+        ok = True
+    except Exception as e:
+        logger.exception("Failed on {0}".format(item))
+        value = e
+        ok = False
+    finally:
+        db.Session.remove() # discard this thread's session, failed or not
+        databases = sys.modules.get('piccolo.databases') # only loaded if something used a server
+        if databases is not None:
+            databases.admin_connections.close_thread() # this thread won't be back
+        shell.release_flags()
+        oplog.adopt(None)
+        nginx.adopt(None)
+    return Result(item, ok, time.time() - start, value)
+
+def run_each(func, items, workers=4):
+    '''Calls func(item) for each item on up to `workers` threads. An exception
+    only fails its own item. Returns a Result per item, in input order.'''
+    items = list(items)
+    pool = ThreadPool(max(1, min(workers, len(items) or 1)))
+    try:
+        flags = (shell.is_pretend(), shell.is_forced()) # workers inherit the caller's
+        operation = oplog.current() # and its operation
+        changes = nginx.current() # and nginx changes to reload for
+        return pool.map(lambda item: _run_isolated(func, item, flags, operation, changes), items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def summarize(results, wall_time, describe=str):
+    '''Logs one line per result and the totals'''
+    for r in results:
+        if r.ok:
+            logger.info("  ok     {0:>8.2f}s  {1}".format(r.elapsed, describe(r.item)))
+        else:
+            logger.error("  FAILED {0:>8.2f}s  {1}: {2}".format(r.elapsed, describe(r.item), r.value))
+    failed = len([r for r in results if not r.ok])
+    busy = sum(r.elapsed for r in results)
+    logger.info("{0} succeeded, {1} failed; {2:.2f}s of work in {3:.2f}s wall time".format(
+        len(results) - failed, failed, busy, wall_time))
+    return failed
@@ -1,27 +1,113 @@
-import stat, os, errno, shlex, subprocess, logging, random, string, time
+import stat, os, errno, shlex, subprocess, logging, random, string, time, shutil, pwd, grp, re, fcntl, fnmatch, threading, signal
 from os.path import exists, join, basename
 from piccolo import config
 logger = logging.getLogger(__name__)
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 class ShellActionFailed(Exception):
     pass
 
+class UnknownTemplateVariable(Exception):
+    pass
+
+# Per-thread --pretend/--force, for threads that run commands side by side
+# (piccolod requests, bulk workers). Other threads use config.PRETEND/FORCE.
+_flags = threading.local()
+
 def is_pretend():
-    return config.PRETEND
+    return getattr(_flags, 'pretend', config.PRETEND)
 
 def is_forced():
-    return config.FORCE
+    return getattr(_flags, 'force', config.FORCE)
+
+def set_flags(pretend, force):
+    if hasattr(_flags, 'pretend'):
+        _flags.pretend, _flags.force = pretend, force
+    else:
+        config.PRETEND, config.FORCE = pretend, force
+
+def isolate_flags(pretend, force):
+    '''Gives the calling thread its own --pretend/--force settings'''
+    _flags.pretend, _flags.force = pretend, force
+
+def release_flags():
+    for name in ('pretend', 'force'):
+        if hasattr(_flags, name):
+            delattr(_flags, name)
 
 FLAGS = {
-    'u': {'r': stat.S_IRUSR, 'w': stat.S_IWUSR, 'x': stat.S_IXUSR,},
-    'g': {'r': stat.S_IRGRP, 'w': stat.S_IWGRP, 'x': stat.S_IXGRP,},
+    'u': {'r': stat.S_IRUSR, 'w': stat.S_IWUSR, 'x': stat.S_IXUSR, 's': stat.S_ISUID,},
+    'g': {'r': stat.S_IRGRP, 'w': stat.S_IWGRP, 'x': stat.S_IXGRP, 's': stat.S_ISGID,},
     'o': {'r': stat.S_IROTH, 'w': stat.S_IWOTH, 'x': stat.S_IXOTH,},
 }
 
+# Upper-case words joined by single underscores, so a variable can run
+# straight into lower-case text ($SHORTNAME_domains) and nothing else
+_VARIABLE = re.compile(r'\$[A-Z][A-Z0-9]*(?:_[A-Z0-9]+)*')
+
+class Template(object):
+    '''A template split once into literal text and $VARIABLE tokens, so that
+    rendering it is a single pass over the pieces'''
+    def __init__(self, text, name="<string>"):
+        self.name = name
+        self._literals = []
+        self._tokens = []
+        position = 0
+        for match in _VARIABLE.finditer(text):
+            self._literals.append(text[position:match.start()])
+            self._tokens.append(match.group())
+            position = match.end()
+        self._literals.append(text[position:])
+    
+    def _resolve(self, token, vars, strict):
+        if token in vars:
+            return vars[token]
+        if strict:
+            raise UnknownTemplateVariable("Unknown variable {0} in {1}".format(token, self.name))
+        return token
+    
+    def check(self, vars):
+        '''Raises UnknownTemplateVariable if vars is missing any variable the
+        template uses'''
+        for token in self._tokens:
+            self._resolve(token, vars, True)
+    
+    def iter_render(self, vars, strict=True):
+        for literal, token in zip(self._literals, self._tokens):
+            yield literal
+            yield self._resolve(token, vars, strict)
+        yield self._literals[-1]
+    
+    def render(self, vars, strict=True):
+        return ''.join(self.iter_render(vars, strict))
+
+_template_cache = {}
+
+def load_template(path):
+    '''Returns the compiled Template for `path`, recompiling only when the
+    file's mtime has changed'''
+    mtime = os.stat(path).st_mtime
+    cached = _template_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'r') as source:
+        template = Template(source.read(), name=path)
+    _template_cache[path] = (mtime, template)
+    return template
+
+def render_template(path, vars):
+    return load_template(path).render(vars)
+
 def format(instring, vars):
-    for k in vars.keys():
-        instring = instring.replace(k, vars[k])
-    return instring
+    '''Substitutes vars into a string, leaving unknown $VARIABLES alone'''
+    return Template(instring).render(vars, strict=False)
 
 def format_file(infile, vars):
     logger.info("Formatting {0} with vars {1}".format(infile, vars))
@@ -35,18 +121,10 @@ def format_file(infile, vars):
 
 def _template_copy(src, dest, vars, mode):
     try:
-        source = open(src, 'r')
+        rendered = load_template(src).render(vars)
         if not is_pretend():
-            destination = open(dest, mode)
-        for line in source:
-            for k in vars.keys():
-                line = format(line, vars)
-            logger.debug("Writing {0}: {1}".format(dest, line))
-            if not is_pretend():
-                destination.write(line)
-        if not is_pretend():
-            destination.close()
-        source.close()
+            with open(dest, mode) as destination:
+                destination.write(rendered)
     except:
         if is_forced():
             pass
@@ -54,45 +132,467 @@ def _template_copy(src, dest, vars, mode):
             raise
 
 def template_copy(src, dest, vars):
-    logger.info("Copying template from {0} to {1}".format(src, dest))
+    logger.info("Copying template from %s to %s", src, dest)
     _template_copy(src, dest, vars, 'w')
     
 def template_append(src, dest, vars):
-    logger.info("Appending template from {0} to {1}".format(src, dest))
+    logger.info("Appending template from %s to %s", src, dest)
     _template_copy(src, dest, vars, 'a')
 
-def do(command, shell=False, ignore_errors=False):
+def do(command, shell=False, ignore_errors=False, input=None, strict=False):
+    '''Runs a command, optionally feeding it input on stdin (which is never
+    logged). A strict command's failure raises even under --force. Returns
+    what the command printed, if it ran and succeeded.'''
     if not shell:
         args = shlex.split(command)
     else:
         args = command
-    logger.info("Executing shell command: {0}".format(command))
+    logger.info("Executing shell command: %s", command)
     if not is_pretend():
         try:
-            output = subprocess.check_output(args, shell=shell, stderr=subprocess.STDOUT)
+            if input is None:
+                output = subprocess.check_output(args, shell=shell, stderr=subprocess.STDOUT)
+            else:
+                process = subprocess.Popen(args, shell=shell, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                output = process.communicate(input)[0]
+                if process.returncode:
+                    raise subprocess.CalledProcessError(process.returncode, command, output)
         except subprocess.CalledProcessError as e:
             if not ignore_errors:
                 logger.error("Error executing {0}, process exited with code {1}".format(command, e.returncode))
                 logger.error(e.output)
-            if not (is_forced() or ignore_errors):
+            if not ((is_forced() and not strict) or ignore_errors):
                 raise ShellActionFailed(command)
         else:
             if output:
                 logger.debug(output)
+            return output
+
+class Throttle(object):
+    '''Holds a stream (or several, from different threads) to an average of
+    `rate` bytes per second'''
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._lock = threading.Lock()
+        self._start = None
+        self._bytes = 0
+    
+    def consume(self, count):
+        with self._lock:
+            now = time.time()
+            if self._start is None:
+                self._start = now
+            self._bytes += count
+            delay = self._start + self._bytes / self.rate - now
+        if delay > 0:
+            time.sleep(delay)
+
+class Metered(object):
+    '''Wraps a file object being read, counting the bytes that pass through
+    and optionally holding them to a Throttle'''
+    def __init__(self, stream, throttle=None):
+        self.stream = stream
+        self.throttle = throttle
+        self.bytes = 0
+    
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.bytes += len(chunk)
+        if self.throttle is not None:
+            self.throttle.consume(len(chunk))
+        return chunk
+
+def pipe(commands, out, env=None, input=None, throttle=None):
+    '''Runs commands (argument lists) as a pipeline, like a | b | c, streaming
+    the last one's output into file object `out` (and, if given, file object
+    `input` into the first one). Nothing is staged on disk. A throttle holds
+    the first command's output, what the pipeline reads, to its rate. Returns
+    the number of bytes written to out.'''
+    description = ' | '.join(' '.join(command) for command in commands)
+    logger.info("Executing shell command: %s", description)
+    if is_pretend():
+        return 0
+    import tempfile
+    environment = dict(os.environ, **(env or {}))
+    processes, errors = [], []
+    metered = throttle is not None and len(commands) > 1 # else the output is throttled below
+    stdin = subprocess.PIPE if input is not None else None
+    for command in commands:
+        if metered and len(processes) == 1:
+            stdin = subprocess.PIPE # fed from the first process through the throttle
+        error = tempfile.TemporaryFile() # a pipe could fill up and stall the process
+        process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=error, env=environment, close_fds=True)
+        if processes and not (metered and len(processes) == 1):
+            processes[-1].stdout.close() # so the upstream process sees SIGPIPE if this one dies
+        processes.append(process)
+        errors.append(error)
+        stdin = process.stdout
+    def feed(source, sink):
+        try:
+            for chunk in iter(lambda: source.read(COPY_BUFFER_SIZE), ''):
+                sink.write(chunk)
+        except IOError:
+            pass # the pipeline quit early; its exit status says why
+        finally:
+            sink.close()
+    feeders = []
+    if input is not None:
+        feeders.append(threading.Thread(target=feed, args=(input, processes[0].stdin)))
+    if metered:
+        feeders.append(threading.Thread(target=feed, args=(Metered(processes[0].stdout, throttle), processes[1].stdin)))
+    for feeder in feeders:
+        feeder.daemon = True
+        feeder.start()
+    written = 0
+    for chunk in iter(lambda: processes[-1].stdout.read(COPY_BUFFER_SIZE), ''):
+        out.write(chunk)
+        written += len(chunk)
+        if throttle is not None and not metered:
+            throttle.consume(len(chunk))
+    processes[-1].stdout.close()
+    for feeder in feeders:
+        feeder.join()
+    if metered:
+        processes[0].stdout.close()
+    failed = False
+    for command, process, error in zip(commands, processes, errors):
+        if process.wait():
+            error.seek(0)
+            logger.error("Error executing {0}, process exited with code {1}".format(command[0], process.returncode))
+            logger.error(error.read())
+            failed = True
+        error.close()
+    if failed and not is_forced():
+        raise ShellActionFailed(description)
+    return written
+
+class _DirEntry(object):
+    '''Minimal stand-in for os.scandir entries on Pythons without scandir'''
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = join(dirpath, name)
+        self._lstat = None
+    
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            return os.stat(self.path)
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+    
+    def is_symlink(self):
+        return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+    
+    def is_dir(self, follow_symlinks=True):
+        if follow_symlinks:
+            return os.path.isdir(self.path)
+        return stat.S_ISDIR(self.stat(follow_symlinks=False).st_mode)
+
+def entries(path):
+    '''Lists a directory as scandir-style entries'''
+    if scandir is not None:
+        return scandir(path)
+    return [_DirEntry(path, name) for name in os.listdir(path)]
 
-def wait(message, delay=2):
-    logger.info("{0} [{1}s]".format(message, delay))
+def walk_entries(path):
+    '''Yields an entry for everything below `path`, parents before children,
+    without following symlinks'''
+    for entry in entries(path):
+        yield entry
+        if entry.is_dir(follow_symlinks=False):
+            for child in walk_entries(entry.path):
+                yield child
+
+def _fs_do(description, action, *args):
+    '''Runs a native filesystem action with the same logging, --pretend and
+    --force handling as do()'''
+    logger.info("Filesystem action: %s", description)
     if not is_pretend():
-        time.sleep(delay)
+        try:
+            action(*args)
+        except (OSError, IOError, KeyError, UnknownTemplateVariable) as e:
+            logger.error("Error performing {0}: {1}".format(description, e))
+            if not is_forced():
+                raise ShellActionFailed(description)
+
+def _chmod(path, permstring, recursive):
+    st = os.lstat(path)
+    os.chmod(path, apply_flags(permstring, st.st_mode, stat.S_ISDIR(st.st_mode)))
+    if recursive and stat.S_ISDIR(st.st_mode):
+        for entry in walk_entries(path):
+            if not entry.is_symlink():
+                entry_mode = entry.stat(follow_symlinks=False).st_mode
+                os.chmod(entry.path, apply_flags(permstring, entry_mode, stat.S_ISDIR(entry_mode)))
+
+def chmod(path, permstring, recursive=False):
+    _fs_do("chmod {0}{1} {2}".format("-R " if recursive else "", permstring, path),
+        _chmod, path, permstring, recursive)
+
+def _chown(path, user, group, recursive):
+    uid = pwd.getpwnam(user).pw_uid
+    gid = grp.getgrnam(group).gr_gid if group else -1
+    os.lchown(path, uid, gid)
+    if recursive and os.path.isdir(path) and not os.path.islink(path):
+        for entry in walk_entries(path):
+            os.lchown(entry.path, uid, gid)
+
+def chown(path, user, group=None, recursive=False):
+    _fs_do("chown {0}{1}{2} {3}".format(
+            "-R " if recursive else "", user, ":" + group if group else "", path),
+        _chown, path, user, group, recursive)
 
-def flags_to_mode(permstring):
+def mkdir(path):
+    _fs_do("mkdir {0}".format(path), os.mkdir, path)
+
+def _copy(src, dest):
+    if os.path.isdir(src) and not os.path.islink(src):
+        shutil.copytree(src, dest, symlinks=True)
+    else:
+        shutil.copy(src, dest)
+
+def copy(src, dest):
+    '''Copies a file or directory tree (like cp -R) to `dest`'''
+    _fs_do("cp -R {0} {1}".format(src, dest), _copy, src, dest)
+
+def remove(path):
+    _fs_do("rm {0}".format(path), os.remove, path)
+
+def _rmtree(path):
+    if os.path.lexists(path):
+        shutil.rmtree(path)
+
+def rmtree(path):
+    _fs_do("rm -rf {0}".format(path), _rmtree, path)
+
+def symlink(target, path):
+    _fs_do("ln -s {0} {1}".format(target, path), os.symlink, target, path)
+
+FICLONE = 0x40049409 # from linux/fs.h
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def _clone_into(source, destination):
+    '''Shares the source's blocks with the destination where the filesystem
+    supports reflinks (btrfs, xfs), otherwise copies the bytes'''
+    try:
+        fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+    except (IOError, OSError):
+        shutil.copyfileobj(source, destination, COPY_BUFFER_SIZE)
+
+def _matches(relpath, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatch(relpath, pattern):
+            return True
+    return False
+
+def _file_mode(relpath, source_mode, file_modes):
+    for pattern, permstring in file_modes:
+        if fnmatch.fnmatch(relpath, pattern):
+            return apply_flags(permstring, source_mode, False)
+    return stat.S_IMODE(source_mode)
+
+def _materialize(src_root, dest_root, vars, user, group, templates, file_modes):
+    uid = pwd.getpwnam(user).pw_uid
+    gid = grp.getgrnam(group).gr_gid
+    plan = []
+    for entry in walk_entries(src_root):
+        relpath = os.path.relpath(entry.path, src_root)
+        template = None
+        if entry.is_symlink() or entry.is_dir(follow_symlinks=False):
+            pass
+        elif _matches(relpath, templates):
+            template = load_template(entry.path)
+            template.check(vars)
+        plan.append((entry, relpath, template))
+    
+    # Every template renders, so nothing can fail halfway on a bad variable
+    for entry, relpath, template in plan:
+        dest = join(dest_root, relpath)
+        source_mode = entry.stat(follow_symlinks=False).st_mode
+        if entry.is_symlink():
+            os.symlink(os.readlink(entry.path), dest)
+            os.lchown(dest, uid, gid)
+        elif stat.S_ISDIR(source_mode):
+            os.mkdir(dest)
+            os.chown(dest, uid, gid)
+            os.chmod(dest, stat.S_IMODE(source_mode))
+        else:
+            mode = _file_mode(relpath, source_mode, file_modes)
+            fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, stat.S_IRUSR | stat.S_IWUSR)
+            with os.fdopen(fd, 'wb') as destination:
+                if template is not None:
+                    logger.debug("Rendering %s", dest)
+                    destination.writelines(template.iter_render(vars))
+                else:
+                    logger.debug("Cloning %s", dest)
+                    with open(entry.path, 'rb') as source:
+                        _clone_into(source, destination)
+                os.fchown(fd, uid, gid)
+                os.fchmod(fd, mode) # after fchown, which can clear setgid
+
+def materialize(src_root, dest_root, vars, user, group, templates=(), file_modes=()):
+    '''Builds the tree under src_root inside dest_root in one pass. Files
+    matching a `templates` glob are rendered with vars, anything else is
+    reflinked or copied unchanged. Everything is owned by user:group, and
+    files matching a `file_modes` glob get that chmod string applied to the
+    source file's mode.'''
+    _fs_do("materialize {0} into {1}".format(src_root, dest_root),
+        _materialize, src_root, dest_root, vars, user, group, templates, file_modes)
+
+def _describe_owner(uid, gid):
+    try:
+        user = pwd.getpwuid(uid).pw_name
+    except KeyError:
+        user = str(uid)
+    try:
+        group = grp.getgrgid(gid).gr_name
+    except KeyError:
+        group = str(gid)
+    return "{0}:{1}".format(user, group)
+
+def _enforce(path, relpath, st, modes, uid, gid, owners, file_modes):
+    changes = []
+    is_dir = stat.S_ISDIR(st.st_mode)
+    if stat.S_ISREG(st.st_mode):
+        modes = list(file_modes) + list(modes)
+    new_uid = st.st_uid if st.st_uid == uid or st.st_uid in owners else uid
+    chowned = (new_uid, gid) != (st.st_uid, st.st_gid)
+    if chowned:
+        changes.append("owner {0} -> {1}".format(_describe_owner(st.st_uid, st.st_gid), _describe_owner(new_uid, gid)))
+        if not is_pretend():
+            os.lchown(path, new_uid, gid)
+    for pattern, permstring in modes:
+        if fnmatch.fnmatch(relpath, pattern):
+            wanted = apply_flags(permstring, st.st_mode, is_dir)
+            if wanted != stat.S_IMODE(st.st_mode):
+                changes.append("mode {0:04o} -> {1:04o}".format(stat.S_IMODE(st.st_mode), wanted))
+            if not is_pretend() and (chowned or wanted != stat.S_IMODE(st.st_mode)):
+                os.chmod(path, wanted) # chown can clear setgid, so always reapply after one
+            break
+    return changes
+
+def enforce_tree(root, modes, uid, gid, owners=(), file_modes=()):
+    '''Brings the tree under root in line with a permission policy, changing
+    only entries that differ from it. `modes` is a list of (relative path glob,
+    chmod string), first match wins, with '' for root itself; `file_modes` is
+    the same but only for regular files (as in materialize), and is checked
+    first. Entries with no match keep their mode. Everything gets group gid, and anything not owned by
+    uid or one of `owners` is given to uid. Symlinks are left alone. Returns
+    (path, change) pairs for what was (or, with --pretend, would be) changed.'''
+    changes = []
+    failed = []
+    def visit(path, relpath, lstat):
+        try:
+            st = lstat()
+            if not stat.S_ISLNK(st.st_mode):
+                changes.extend((path, change) for change in _enforce(path, relpath, st, modes, uid, gid, owners, file_modes))
+        except OSError as e:
+            if e.errno != errno.ENOENT: # deleted while we walked
+                logger.error("Error fixing permissions on {0}: {1}".format(path, e))
+                failed.append(path)
+    visit(root, '', lambda: os.lstat(root))
+    prefix = len(root.rstrip('/')) + 1
+    for entry in walk_entries(root):
+        visit(entry.path, entry.path[prefix:], lambda: entry.stat(follow_symlinks=False))
+    if failed and not is_forced():
+        raise ShellActionFailed("fix permissions under {0}".format(root))
+    return changes
+
+REAP_POLL_MAX = 0.25 # longest pause between looks at /proc while reaping
+
+def _pids_of(uid):
+    '''Live (non-zombie) processes whose real, effective or saved uid is uid,
+    which is what userdel checks before it will delete an account'''
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit() or int(name) == os.getpid():
+            continue
+        try:
+            with open('/proc/{0}/status'.format(name)) as status:
+                fields = dict(line.split(':', 1) for line in status if ':' in line)
+        except IOError:
+            continue # exited while we looked
+        if fields.get('State', '').strip().startswith('Z'):
+            continue
+        if str(uid) in fields.get('Uid', '').split()[:3]:
+            pids.append(int(name))
+    return pids
+
+def _signal_all(uid, sig):
+    pids = _pids_of(uid)
+    for pid in pids:
+        try:
+            os.kill(pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+    return pids
+
+def reap(username, term_timeout=5, kill_timeout=5):
+    '''Stops every process running as username: SIGTERM, then SIGKILL for
+    anything still running after term_timeout seconds. Returns as soon as /proc
+    shows none left, with the number of seconds it took.'''
+    logger.info("Stopping processes of {0}".format(username))
+    if is_pretend():
+        return 0.0
+    try:
+        uid = pwd.getpwnam(username).pw_uid
+    except KeyError:
+        return 0.0
+    if uid == 0:
+        raise ShellActionFailed("Refusing to kill root's processes")
+    start = time.time()
+    for sig, timeout in ((signal.SIGTERM, term_timeout), (signal.SIGKILL, kill_timeout)):
+        deadline = time.time() + timeout
+        delay = 0.01
+        # Signal on every pass, to catch anything forked since the last one
+        while _signal_all(uid, sig):
+            if time.time() >= deadline:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, REAP_POLL_MAX)
+        else:
+            elapsed = time.time() - start
+            logger.debug("Processes of {0} gone after {1:.2f}s".format(username, elapsed))
+            return elapsed
+        if sig == signal.SIGTERM:
+            logger.warning("Processes of {0} still running {1}s after SIGTERM; sending SIGKILL".format(username, term_timeout))
+    logger.error("Processes of {0} still running after SIGKILL: {1}".format(username, ' '.join(str(pid) for pid in _pids_of(uid))))
+    if not is_forced():
+        raise ShellActionFailed("reap {0}".format(username))
+    return time.time() - start
+
+def flags_to_mode(permstring, executable=False):
+    '''Converts a chmod-style string like "u=rwX,g=rwXs,o=X" to a mode. As with
+    chmod, X only grants execute if `executable` (the target is a directory or
+    already executable by someone)'''
     mask = 0
     for perm in permstring.split(','):
         type, attrs = perm.split('=')
-        for a in attrs:
-            mask |= FLAGS[type][a]
+        for t in type:
+            for a in attrs:
+                if a == 'X':
+                    if executable:
+                        mask |= FLAGS[t]['x']
+                else:
+                    mask |= FLAGS[t][a]
     return mask
 
+def apply_flags(permstring, current, is_dir):
+    '''Returns the mode chmod would leave a file with mode `current` in after
+    applying `permstring`. Like GNU chmod, directories keep their setuid/setgid
+    bits unless the string sets them explicitly.'''
+    executable = is_dir or bool(current & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH))
+    new_mode = stat.S_IMODE(current)
+    for perm in permstring.split(','):
+        type, attrs = perm.split('=')
+        for t in type:
+            cleared = FLAGS[t]['r'] | FLAGS[t]['w'] | FLAGS[t]['x']
+            if 's' in FLAGS[t] and not is_dir:
+                cleared |= FLAGS[t]['s']
+            new_mode &= ~cleared
+        new_mode |= flags_to_mode(perm, executable)
+    return new_mode
+
 def mode(path):
     '''Returns the file mode, including the SETUID/SETGID/ISVTX bits'''
     return stat.S_IMODE(os.stat(path).st_mode)
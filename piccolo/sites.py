@@ -1,9 +1,9 @@
-import logging, shutil, glob, os, string, time, re
+import logging, shutil, glob, os, string, time, re, pwd
 import piccolo.log
-from piccolo import db, config, shell
+from piccolo import db, config, shell, nginx, journal
 from piccolo.users import User
 from piccolo.databases import Database
-from piccolo.shell import do, wait
+from piccolo.shell import do
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +25,8 @@ class Site(db.Base):
                     lazy='joined',
                     join_depth=1)
     
+    _home_permissions = 'u=rwX,g=rwXs,o=X'
+    
     _permissions = (
         ('bin', 'u=rx,g=rx,o='),
         ('config', 'u=rwx,g=rwx,o='),
@@ -34,6 +36,19 @@ class Site(db.Base):
         ('temp', 'u=rwx,g=rxs,o=')
     )
     
+    _file_permissions = (
+        ('bin/*', 'u=rwx,g=rx,o='),
+        ('config/*', 'u=rw,g=rw,o='),
+    )
+    
+    # Files in templates/site that get variable substitution; everything
+    # else is copied as-is
+    _skeleton_templates = (
+        'bin/*',
+        'config/*',
+        'public/index.html',
+    )
+    
     _additional_dirs = (
         'logs',
         'run',
@@ -56,6 +71,9 @@ class Site(db.Base):
     class NoSuchUser(Exception):
         pass
     
+    class NothingToResume(Exception):
+        pass
+    
     def __init__(self, shortname, full_name):
         self.shortname = shortname
         self.full_name = full_name
@@ -70,20 +88,23 @@ class Site(db.Base):
     
     
     def _create_db_accounts(self):
+        # Accounts left by an earlier attempt just get the site's password again
         logger.info("Creating PostgreSQL user account {0}".format(self.db_username))
         if not shell.is_pretend():
             conn, cur = Database._postgres()
-            cur.execute("CREATE ROLE {0} PASSWORD '{1}' LOGIN;".format(self.db_username, self.db_password))
+            cur.execute("SELECT 1 FROM pg_roles WHERE rolname = %s;", (self.db_username,))
+            verb = "ALTER" if cur.fetchone() else "CREATE"
+            cur.execute("{0} ROLE {1} PASSWORD '{2}' LOGIN;".format(verb, self.db_username, self.db_password))
             cur.execute('SELECT pg_reload_conf();')
             cur.close()
-            conn.close()
         
         logger.info("Creating MySQL user account {0}".format(self.db_username_mysql))
         if not shell.is_pretend():
             conn, cur = Database._mysql()
-            cur.execute("CREATE USER '{0}'@'localhost' IDENTIFIED BY '{1}';".format(self.db_username_mysql, self.db_password))
+            cur.execute("SELECT 1 FROM mysql.user WHERE User = %s AND Host = 'localhost';", (self.db_username_mysql,))
+            verb = "ALTER" if cur.fetchone() else "CREATE"
+            cur.execute("{0} USER '{1}'@'localhost' IDENTIFIED BY '{2}';".format(verb, self.db_username_mysql, self.db_password))
             cur.close()
-            conn.close()
     
     def _drop_db_accounts(self):
         logger.info("Dropping databases associated with {0}".format(self.shortname))
@@ -97,11 +118,12 @@ class Site(db.Base):
             logger.info("Dropping PostgreSQL user account {0}".format(self.db_username))
             if not shell.is_pretend():
                 conn, cur = Database._postgres()
-                cur.execute("DROP OWNED BY {0};".format(self.db_username))
-                cur.execute("DROP ROLE {0};".format(self.db_username))
-                cur.execute('SELECT pg_reload_conf();')
+                cur.execute("SELECT 1 FROM pg_roles WHERE rolname = %s;", (self.db_username,))
+                if cur.fetchone(): # a rollback may find it never got this far
+                    cur.execute("DROP OWNED BY {0};".format(self.db_username))
+                    cur.execute("DROP ROLE {0};".format(self.db_username))
+                    cur.execute('SELECT pg_reload_conf();')
                 cur.close()
-                conn.close()
         except:
             if not shell.is_forced():
                 raise
@@ -110,102 +132,219 @@ class Site(db.Base):
             logger.info("Dropping MySQL user account {0}".format(self.db_username_mysql))
             if not shell.is_pretend():
                 conn, cur = Database._mysql()
-                cur.execute("DROP USER '{0}'@'localhost';".format(self.db_username_mysql))
+                cur.execute("SELECT 1 FROM mysql.user WHERE User = %s AND Host = 'localhost';", (self.db_username_mysql,))
+                if cur.fetchone():
+                    cur.execute("DROP USER '{0}'@'localhost';".format(self.db_username_mysql))
                 cur.close()
-                conn.close()
         except:
             if not shell.is_forced():
                 raise
     
-    def _shell_delete(self):
-        for service in ("httpd.sh", "php.sh"):
-            do("sudo -u {0} {1} stop".format(self.shortname, shell.join(self._get_home(), "bin", service)))
-        do("pkill -u {0}".format(self.shortname), ignore_errors=True)
-        
-        wait("Waiting for services to be removed from process list")
-        
+    def _create_account(self):
         try:
-            self._drop_db_accounts()
-        except:
-            if not shell.is_forced():
-                raise
-        
-        do("rm /etc/sudoers.d/{0}".format(self.shortname))
-        do("rm /etc/piccolo/nginx/{0}.conf".format(self.shortname))
-        do("rm -rf /etc/piccolo/nginx/{0}_domains".format(self.shortname))
-        do("userdel -r {0}".format(self.shortname))
+            account = pwd.getpwnam(self.shortname)
+        except KeyError:
+            do("useradd -U -b {0} -m -s /bin/bash {1}".format(
+                config.SITES_ROOT,
+                self.shortname
+            ))
+        else:
+            # Site.create refuses existing accounts, so this one is from an earlier attempt
+            if account.pw_dir != self._get_home():
+                raise shell.ShellActionFailed("Account {0} exists with home {1}".format(self.shortname, account.pw_dir))
+            logger.info("Account {0} already exists".format(self.shortname))
+    
+    def _delete_account(self):
+        # userdel refuses while the account has processes, and a start that
+        # failed partway can leave some behind
+        shell.reap(self.shortname)
+        try:
+            pwd.getpwnam(self.shortname)
+        except KeyError:
+            logger.info("Account {0} doesn't exist".format(self.shortname))
+        else:
+            do("userdel -r {0}".format(self.shortname))
         do("groupdel {0}".format(self.shortname), ignore_errors=True)
     
-    def _shell_create(self, pretend=False):
-        # Actual shell-level business of provisioning the site goes here
-        
-        # Set up siteuser and sitegroup
-        do("useradd -U -b {0} -m -s /bin/bash {1}".format(
-            config.SITES_ROOT,
-            self.shortname
-        ))
+    def _build_home(self):
+        shell.chmod(self._get_home(), Site._home_permissions)
         
-        # Set up template and permissions
-        do("chmod u=rwX,g=rwXs,o=X {0}".format(self._get_home()))
+        # Clear out anything an earlier attempt got partway through
+        skeleton = shell.join(config.TEMPLATE_ROOT, 'site')
+        for name in set(os.listdir(skeleton)) | set(d.split('/')[0] for d in Site._additional_dirs):
+            if os.path.lexists(shell.join(self._get_home(), name)):
+                shell.rmtree(shell.join(self._get_home(), name))
         
-        for path in glob.glob(shell.join(config.TEMPLATE_ROOT, 'site', '*')):
-            do("cp -R {0} {1}".format(path, self._get_home()))
+        shell.materialize(skeleton, self._get_home(), self._vars(),
+            self.shortname, self.shortname,
+            templates=Site._skeleton_templates,
+            file_modes=Site._file_permissions)
         
         for d in Site._additional_dirs:
-            do("mkdir {0}".format(shell.join(self._get_home(), d)))
-        
-        do("chown -R {0}:{0} {1}".format(self.shortname, self._get_home()))
+            shell.mkdir(shell.join(self._get_home(), d))
+            shell.chown(shell.join(self._get_home(), d), self.shortname, self.shortname)
         
         for p in Site._permissions:
-            do("chmod {0} {1}".format(p[1], shell.join(self._get_home(), p[0])))
-        
-        # Do variable substitution in template files
-        
-        for root, dirs, files in os.walk(self._get_home()):
-            for name in files:
-                shell.format_file(shell.join(root, name), self._vars())
-        
-        for root, dirs, files in os.walk(shell.join(self._get_home(), "bin")):
-            for name in files:
-                do("chmod u=rwx,g=rx,o= {0}".format(shell.join(root, name)))
-        
-        for root, dirs, files in os.walk(shell.join(self._get_home(), "config")):
-            for name in files:
-                do("chmod u=rw,g=rw,o= {0}".format(shell.join(root, name)))
-        
-        # Install crontab from temp file
-        
+            shell.chmod(shell.join(self._get_home(), p[0]), p[1])
+    
+    def _install_crontab(self):
         crontab_path = shell.join(self._get_home(), 'crontab')
         self._format_copy('site.crontab', crontab_path)
         
         do("crontab -u {0} {1}".format(self.shortname, crontab_path))
-        do("rm {0}".format(crontab_path))
-        
-        # Install sudoers
-        sudoers_dest = '/etc/sudoers.d/{0}'.format(self.shortname)
-        if shell.exists(sudoers_dest):
-            raise shell.ShellActionFailed("{0} exists. Abort!".format(sudoers_dest))
+        shell.remove(crontab_path)
+    
+    def _remove_crontab(self):
+        do("crontab -r -u {0}".format(self.shortname), ignore_errors=True)
+    
+    def _sudoers_path(self):
+        return shell.join(config.SUDOERS_DIR, self.shortname)
+    
+    def _install_sudoers(self):
+        sudoers_dest = self._sudoers_path()
         self._format_copy('site.sudoers', sudoers_dest)
-        do("chmod u=r,g=r,o= {0}".format(sudoers_dest))
-        do("chown root:root {0}".format(sudoers_dest))
-        
-        # Install nginx config
-        nginx_dest = shell.join(config.NGINX_CONF_ROOT, "{0}.conf".format(self.shortname))
-        if shell.exists(nginx_dest):
-            raise shell.ShellActionFailed("{0} exists. Abort!".format(nginx_dest))
-        self._format_copy('site.nginx.conf', nginx_dest)
-        do("chmod u=rw,g=rw,o=r {0}".format(nginx_dest))
-        do("chown root:admin {0}".format(nginx_dest))
-        
-        do("mkdir {0}".format(shell.join(config.NGINX_CONF_ROOT, "{0}_domains".format(self.shortname))))
-        
-        # Set up db users
-        self._create_db_accounts()
-        
-        # Start site
+        shell.chmod(sudoers_dest, "u=r,g=r,o=")
+        shell.chown(sudoers_dest, "root", "root")
+    
+    def _remove_sudoers(self):
+        if shell.exists(self._sudoers_path()):
+            shell.remove(self._sudoers_path())
+    
+    def _nginx_path(self):
+        return shell.join(config.NGINX_CONF_ROOT, "{0}.conf".format(self.shortname))
+    
+    def _install_nginx(self):
+        nginx_dest = self._nginx_path()
+        domains_folder = shell.join(config.NGINX_CONF_ROOT, "{0}_domains".format(self.shortname))
+        with nginx.changing():
+            self._format_copy('site.nginx.conf', nginx_dest)
+            shell.chmod(nginx_dest, "u=rw,g=rw,o=r")
+            shell.chown(nginx_dest, "root", "admin")
+            if not shell.exists(domains_folder):
+                shell.mkdir(domains_folder)
+    
+    def _remove_nginx(self):
+        domains_folder = shell.join(config.NGINX_CONF_ROOT, "{0}_domains".format(self.shortname))
+        with nginx.changing():
+            if shell.exists(self._nginx_path()):
+                shell.remove(self._nginx_path())
+            if shell.exists(domains_folder):
+                shell.rmtree(domains_folder)
+    
+    def _default_domain_name(self):
+        return '.'.join([self.shortname, config.DEFAULT_DOMAIN])
+    
+    def _add_default_domain(self):
+        if shell.is_pretend():
+            return
+        existing = Domain.get(self._default_domain_name())
+        if existing:
+            existing._shell_create() # finishes it if an earlier attempt didn't
+        else:
+            Domain.create(self._default_domain_name(), self)
+    
+    def _remove_default_domain(self):
+        the_domain = Domain.get(self._default_domain_name())
+        if the_domain:
+            the_domain._shell_delete()
+            if not shell.is_pretend():
+                db.Session().delete(the_domain)
+                db.Session().commit()
+            journal.forget(the_domain._journal_owner())
+    
+    def _start(self):
         for service in ("httpd.sh", "php.sh"):
             do("sudo -u {0} {1} start".format(self.shortname, shell.join(self._get_home(), "bin", service)))
     
+    def _stop(self):
+        # Either may not be running (a start can fail between them);
+        # _delete_account reaps whatever is left
+        for service in ("httpd.sh", "php.sh"):
+            do("sudo -u {0} {1} stop".format(self.shortname, shell.join(self._get_home(), "bin", service)), ignore_errors=True)
+    
+    def _shell_delete(self):
+        self._stop()
+        
+        try:
+            self._drop_db_accounts()
+        except:
+            if not shell.is_forced():
+                raise
+        
+        self._remove_sudoers()
+        self._remove_nginx()
+        self._delete_account()
+    
+    def _journal_owner(self):
+        return "site:" + self.shortname
+    
+    def _provisioning_steps(self):
+        # (name, do, undo), in order
+        return [
+            ('account', self._create_account, self._delete_account),
+            ('home', self._build_home, None), # goes with the account
+            ('crontab', self._install_crontab, self._remove_crontab),
+            ('sudoers', self._install_sudoers, self._remove_sudoers),
+            ('nginx', self._install_nginx, self._remove_nginx),
+            ('db_accounts', self._create_db_accounts, self._drop_db_accounts),
+            ('default_domain', self._add_default_domain, self._remove_default_domain),
+            ('start', self._start, self._stop),
+        ]
+    
+    def _shell_create(self):
+        journal.run(self._journal_owner(), self._provisioning_steps(), {
+            'shortname': self.shortname,
+            'full_name': self.full_name,
+            'home': self._get_home(),
+            'db_username': self.db_username,
+            'db_username_mysql': self.db_username_mysql,
+        })
+    
+    def resume(self):
+        '''Finishes provisioning that failed partway, running only the steps
+        the journal doesn't have as done'''
+        if not journal.incomplete(self._journal_owner()):
+            raise Site.NothingToResume("{0} has no unfinished provisioning".format(self.shortname))
+        self._shell_create()
+        for the_domain in self.domains:
+            if journal.incomplete(the_domain._journal_owner()):
+                the_domain._shell_create()
+        logger.info("Finished provisioning {0}".format(self.shortname))
+    
+    def rollback(self):
+        '''Undoes the provisioning steps that completed, last first, and
+        removes the half-built site from the DB'''
+        if not journal.incomplete(self._journal_owner()):
+            raise Site.NothingToResume("{0} has no unfinished provisioning; delete it instead".format(self.shortname))
+        journal.rollback(self._journal_owner(), self._provisioning_steps())
+        for the_domain in self.domains:
+            journal.forget(the_domain._journal_owner())
+        journal.forget(self._journal_owner())
+        if not shell.is_pretend():
+            session = db.Session()
+            session.delete(self)
+            session.commit()
+        logger.info("Rolled back {0}".format(self.shortname))
+    
+    def fix_permissions(self):
+        '''Puts back the modes and ownership _shell_create set up, wherever
+        they've drifted. Files may belong to the site or any of its users; the
+        group is always the site's. Returns (path, change) pairs.'''
+        modes = list(Site._permissions) + [('', Site._home_permissions)]
+        site_account = pwd.getpwnam(self.shortname)
+        owners = set()
+        for user in self.users:
+            try:
+                owners.add(pwd.getpwnam(user.username).pw_uid)
+            except KeyError:
+                pass
+        logger.info("Checking permissions under {0}".format(self._get_home()))
+        changes = shell.enforce_tree(self._get_home(), modes, site_account.pw_uid, site_account.pw_gid, owners,
+            file_modes=Site._file_permissions)
+        for path, change in changes:
+            logger.info("{0}: {1}".format(path, change))
+        return changes
+    
     def _vars(self):
         return {
             '$SHORTNAME': self.shortname,
@@ -218,8 +357,7 @@ class Site(db.Base):
         }
     
     def _format_template(self, src):
-        src = shell.join(config.TEMPLATE_ROOT, src)
-        return shell.format(open(src, 'r').read(), self._vars())
+        return shell.render_template(shell.join(config.TEMPLATE_ROOT, src), self._vars())
     
     def _format_copy(self, src, dest):
         src = shell.join(config.TEMPLATE_ROOT, src)
@@ -227,12 +365,7 @@ class Site(db.Base):
     
     @staticmethod
     def get(shortname):
-        session = db.Session()
-        siteq = session.query(Site).filter(Site.shortname == shortname)
-        if (siteq.count() == 1):
-            return siteq.first()
-        else:
-            return None
+        return db.get(Site, shortname)
     
     @staticmethod
     def delete(shortname):
@@ -246,10 +379,13 @@ class Site(db.Base):
             logger.exception("Shell action failed")
             raise
         else:
+            for the_domain in the_site.domains:
+                journal.forget(the_domain._journal_owner())
+            journal.forget(the_site._journal_owner())
             if not shell.is_pretend():
                 session.delete(the_site)
                 session.commit()
-                do("service nginx reload")
+                nginx.mark_dirty()
             logger.info("Deleted {0} from the DB".format(shortname))
     
     @staticmethod
@@ -261,14 +397,22 @@ class Site(db.Base):
             raise Site.Exists
         elif not config.NAME_REGEX.match(shortname) or len(shortname) > config.NAME_LIMIT:
             raise Site.BadName("Site names must be between 2 and {0} characters and be valid hostnames (only letters, numbers, and dashes)".format(config.NAME_LIMIT))
-        elif Domain.get('.'.join([shortname, config.DEFAULT_DOMAIN])):
-            existing = Domain.get('.'.join([shortname, config.DEFAULT_DOMAIN]))
+        try:
+            pwd.getpwnam(shortname)
+        except KeyError:
+            pass
+        else:
+            raise Site.Exists("There is already an account named {0} in /etc/passwd".format(shortname))
+        for path in (shell.join(config.SUDOERS_DIR, shortname), shell.join(config.NGINX_CONF_ROOT, "{0}.conf".format(shortname))):
+            if shell.exists(path):
+                raise Site.Exists("{0} already exists".format(path))
+        existing = Domain.get('.'.join([shortname, config.DEFAULT_DOMAIN]))
+        if existing:
             raise Site.BadName("There is already a domain {0} in piccolo, so adding this site would "\
                 "create a name conflict. Remove {0} from {1} before "\
                 "adding this site.".format(existing.domain_name, existing.site.shortname))
-        else:
-            logger.debug("site doesn't exist yet in db")
-            new_site = Site(shortname, full_name)
+        logger.debug("site doesn't exist yet in db")
+        new_site = Site(shortname, full_name)
         
         new_site.db_password = shell.generate_password(length=20)
         new_site.db_username = re.sub(r'[^\w\d]', '_', new_site.shortname)
@@ -279,13 +423,13 @@ class Site(db.Base):
             session.commit()
         try:
             new_site._shell_create()
-            if not shell.is_pretend():
-                Domain.create('.'.join([new_site.shortname, config.DEFAULT_DOMAIN]), new_site)
         except shell.ShellActionFailed as e:
             logger.exception("Shell action failed")
+            logger.error("Run `piccolo site {0} resume` to finish creating it once the problem is fixed, "\
+                "or `piccolo site {0} rollback` to undo the steps that worked".format(shortname))
             raise
         else:
-            do("service nginx reload")
+            nginx.mark_dirty()
             logger.info('Created site "{0}" [{1}]'.format(full_name, shortname))
     
     def addUser(self, user, suppress_welcome=False):
@@ -302,7 +446,7 @@ class Site(db.Base):
             session.commit()
         try:
             do("gpasswd -a {0} {1}".format(user.username, self.shortname))
-            do("ln -s {0} {1}".format(self._get_home(), shell.join(user._get_home(), self.shortname)))
+            shell.symlink(self._get_home(), shell.join(user._get_home(), self.shortname))
         except shell.ShellActionFailed:
             if not shell.is_pretend():
                 self.users.remove(user)
@@ -315,10 +459,11 @@ class Site(db.Base):
                     "$SITE_SHORTNAME": self.shortname,
                 }
                 
-                email_message = shell.format(open(shell.join(config.TEMPLATE_ROOT, 'site_adduser_email.txt')).read(), email_vars)
+                email_message = shell.render_template(shell.join(config.TEMPLATE_ROOT, 'site_adduser_email.txt'), email_vars)
                 email_subject = "Peninsula Account Update: {0} added to site {1}".format(user.username, self.shortname)
                 user.send_email(email_subject, email_message)
-                logger.info("Sent adduser email to {0}".format(user.email))
+                session.commit()
+                logger.info("Queued adduser email to {0}".format(user.email))
             logger.info('Added {0} to {1}'.format(user.username, self.shortname))
     
     def removeUser(self, user):
@@ -331,7 +476,7 @@ class Site(db.Base):
             raise Site.NoSuchUser
         try:
             do("gpasswd -d {0} {1}".format(user.username, self.shortname))
-            do("rm {0}".format(shell.join(user._get_home(), self.shortname)))
+            shell.remove(shell.join(user._get_home(), self.shortname))
         except shell.ShellActionFailed:
             logger.exception("Removal failed; user is still member of site in DB.")
             raise
@@ -373,13 +518,23 @@ class Domain(db.Base):
     def _get_path(self):
         return shell.join(self._get_folder(), "{0}.conf".format(self.domain_name))
     
+    def _write_config(self):
+        with nginx.changing():
+            self._format_copy("site.nginx.domain.conf", self._get_path())
+    
+    def _journal_owner(self):
+        return "domain:" + self.domain_name
+    
     def _shell_create(self):
-        self._format_copy("site.nginx.domain.conf", self._get_path())
-        do("service nginx reload")
+        journal.run(self._journal_owner(), [('config', self._write_config, self._shell_delete)], {
+            'domain_name': self.domain_name,
+            'site': self.site.shortname,
+        })
     
     def _shell_delete(self):
-        do("rm {0}".format(self._get_path()))
-        do("service nginx reload")
+        with nginx.changing():
+            if shell.exists(self._get_path()):
+                shell.remove(self._get_path())
     
     def _format_copy(self, src, dest):
         src = shell.join(config.TEMPLATE_ROOT, src)
@@ -387,12 +542,7 @@ class Domain(db.Base):
     
     @staticmethod
     def get(domain_name):
-        session = db.Session()
-        q = session.query(Domain).filter(Domain.domain_name == domain_name)
-        if (q.count() == 1):
-            return q.first()
-        else:
-            return None
+        return db.get(Domain, domain_name)
     
     @staticmethod
     def create(domain_name, site_instance):
@@ -429,6 +579,7 @@ class Domain(db.Base):
             logger.exception("Shell action failed")
             raise
         else:
+            journal.forget(the_domain._journal_owner())
             if not shell.is_pretend():
                 session.delete(the_domain)
                 session.commit()
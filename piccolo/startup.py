@@ -0,0 +1,52 @@
+import sys, time
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+"""
+Measures how long piccolo takes to start (piccolo --startup-profile): times
+every module's first import, so slow imports can be kept off the cold path.
+"""
+
+_original_import = builtins.__import__
+_imports = [] # [name, depth, seconds], in the order imports began
+_depth = [0]
+_started = None
+
+def _timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return _original_import(name, *args, **kwargs)
+    label = name
+    if not name: # "from . import x"
+        fromlist = args[2] if len(args) > 2 else kwargs.get('fromlist')
+        label = '.' + ','.join(fromlist or ())
+    record = [label, _depth[0], None]
+    _imports.append(record)
+    _depth[0] += 1
+    start = time.time()
+    try:
+        return _original_import(name, *args, **kwargs)
+    finally:
+        record[2] = time.time() - start
+        _depth[0] -= 1
+
+def install():
+    global _started
+    _started = time.time()
+    builtins.__import__ = _timed_import
+
+def report(budget, max_depth=3):
+    '''Prints the import tree (down to max_depth) with inclusive times in ms,
+    and how the startup time so far compares with the budget (in seconds)'''
+    if _started is None:
+        sys.stderr.write("Import profiling was not started before piccolo was imported\n")
+        return
+    builtins.__import__ = _original_import
+    total = time.time() - _started
+    sys.stderr.write("Import times (ms, including nested imports):\n")
+    for name, depth, seconds in _imports:
+        if seconds is not None and seconds >= 0.001 and depth <= max_depth:
+            sys.stderr.write("{0:>9.1f}  {1}{2}\n".format(seconds * 1000, '  ' * depth, name))
+    sys.stderr.write("Startup took {0:.0f} ms (budget {1:.0f} ms){2}\n".format(
+        total * 1000, budget * 1000, "" if total <= budget else " -- OVER BUDGET"))
@@ -0,0 +1,221 @@
+import json, logging
+from sqlalchemy.orm import selectinload
+from piccolo import db, config, shell, journal
+from piccolo.sites import Site, Domain
+from piccolo.users import User
+from piccolo.databases import Database
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+"""
+Converges piccolo on an inventory of users and sites:
+
+    users:
+      - {username: alice, full_name: Alice Smith, email: alice@example.edu}
+    sites:
+      - shortname: chess
+        full_name: Chess Club
+        users: [alice]
+        domains: [chess.example.org]
+        databases: [{name: chess_wp, dbms: mysql}]
+
+Everything listed is created or brought in line, through the same paths as the
+command line. Within a listed site, each of users, domains and databases is
+only managed when its key is present, and then it's exact: members, domains and
+databases missing from the list are removed. Sites and users that aren't listed
+are left alone. The plan comes from DB reads alone, so syncing a host that
+already matches runs nothing.
+"""
+
+logger = logging.getLogger(__name__)
+
+class BadInventory(Exception):
+    pass
+
+DBMS_NAMES = {'mysql': Database.MYSQL, 'postgresql': Database.POSTGRESQL}
+DBMS_LABELS = {Database.MYSQL: 'MySQL', Database.POSTGRESQL: 'PostgreSQL'}
+
+class Change(object):
+    def __init__(self, symbol, description, apply):
+        self.symbol = symbol # + add, - remove, ~ update or finish
+        self.description = description
+        self.apply = apply
+
+    def __str__(self):
+        return "{0} {1}".format(self.symbol, self.description)
+
+def load(path, text):
+    '''Parses an inventory: YAML for .yaml/.yml files, otherwise JSON (or YAML,
+    if it isn't JSON and PyYAML is installed)'''
+    if not path.endswith(('.yaml', '.yml')):
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            if yaml is None:
+                raise BadInventory("{0} is not valid JSON: {1}".format(path, e))
+    if yaml is None:
+        raise BadInventory("Reading YAML inventories needs PyYAML (pip install pyyaml); or use JSON")
+    try:
+        return yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        raise BadInventory("{0} is not valid YAML: {1}".format(path, e))
+
+def _normalize(inventory):
+    '''Checks the inventory's shape and returns (users, sites) as dicts keyed by
+    name, where a site's users/domains/databases is None if it's not managed'''
+    if not isinstance(inventory, dict):
+        raise BadInventory("The inventory must be a mapping with 'users' and/or 'sites'")
+    users, sites = {}, {}
+    for entry in inventory.get('users') or []:
+        missing = [key for key in ('username', 'full_name', 'email') if not entry.get(key)]
+        if missing:
+            raise BadInventory("User {0} is missing {1}".format(entry.get('username', entry), ', '.join(missing)))
+        if entry['username'] in users:
+            raise BadInventory("User {0} is listed more than once".format(entry['username']))
+        users[entry['username']] = entry
+    for entry in inventory.get('sites') or []:
+        if not entry.get('shortname'):
+            raise BadInventory("A site is missing its shortname: {0}".format(entry))
+        shortname = entry['shortname']
+        if shortname in sites:
+            raise BadInventory("Site {0} is listed more than once".format(shortname))
+        site = {'shortname': shortname, 'full_name': entry.get('full_name'), 'users': None, 'domains': None, 'databases': None}
+        if 'users' in entry:
+            site['users'] = set(entry['users'] or [])
+        if 'domains' in entry:
+            site['domains'] = set(entry['domains'] or [])
+            site['domains'].add('.'.join([shortname, config.DEFAULT_DOMAIN]))
+        if 'databases' in entry:
+            site['databases'] = {}
+            for database in entry['databases'] or []:
+                dbms = DBMS_NAMES.get(str(database.get('dbms', '')).lower())
+                if not database.get('name') or dbms is None:
+                    raise BadInventory("Site {0} has a database without a name or a dbms of mysql or postgresql: {1}".format(shortname, database))
+                site['databases'][database['name']] = dbms
+        sites[shortname] = site
+    return users, sites
+
+def _lookup(query, column, names):
+    '''Runs query filtered to rows whose column is in names, a chunk at a time'''
+    names = sorted(names)
+    rows = []
+    for i in range(0, len(names), User.QUERY_CHUNK):
+        rows.extend(query.filter(column.in_(names[i:i + User.QUERY_CHUNK])))
+    return rows
+
+def plan(inventory, suppress_welcome=False):
+    '''The changes, in the order they must be applied, that would make piccolo
+    match the inventory'''
+    users, sites = _normalize(inventory)
+    session = db.Session()
+    current_sites = dict((s.shortname, s) for s in _lookup(session.query(Site).options(
+        selectinload(Site.users),
+        selectinload(Site.databases),
+        selectinload(Site.domains),
+    ), Site.shortname, sites))
+    usernames = set(users)
+    for site in sites.values():
+        usernames.update(site['users'] or ())
+    known_users = dict((u.username, u) for u in _lookup(session.query(User), User.username, usernames))
+    domain_owners = dict(_lookup(session.query(Domain.domain_name, Domain.site_shortname), Domain.domain_name,
+        set(name for site in sites.values() for name in site['domains'] or ())))
+    database_owners = dict(_lookup(session.query(Database.dbname, Database.site_shortname), Database.dbname,
+        set(name for site in sites.values() for name in site['databases'] or ())))
+
+    for shortname, site in sites.items():
+        for username in site['users'] or ():
+            if username not in users and username not in known_users:
+                raise BadInventory("Site {0} lists user {1}, who is neither in the inventory nor in piccolo".format(shortname, username))
+        for domain_name in site['domains'] or ():
+            owner = domain_owners.get(domain_name)
+            if owner and owner != shortname and not (owner in sites and sites[owner]['domains'] is not None
+                    and domain_name not in sites[owner]['domains']):
+                raise BadInventory("Domain {0} belongs to site {1}".format(domain_name, owner))
+        for dbname in site['databases'] or ():
+            owner = database_owners.get(dbname)
+            if owner and owner != shortname:
+                raise BadInventory("Database {0} belongs to site {1}; move its data by hand".format(dbname, owner))
+
+    unfinished = journal.incomplete_owners()
+
+    user_changes, site_changes, member_changes, domain_removals, domain_additions, database_changes = [], [], [], [], [], []
+
+    new_users = [(u['username'], u['full_name'], u['email']) for name, u in sorted(users.items()) if name not in known_users]
+    if new_users:
+        def create_users(rows=new_users):
+            failed = User.create_many(rows, suppress_welcome=suppress_welcome)
+            if failed:
+                raise User.ShellActionFailed("Could not create accounts for " + ', '.join(failed))
+        user_changes.append(Change('+', "users " + ', '.join(row[0] for row in new_users), create_users))
+    for name, u in sorted(users.items()):
+        existing = known_users.get(name)
+        if existing and (existing.full_name, existing.email) != (u['full_name'], u['email']):
+            def update_user(existing=existing, u=u):
+                if not shell.is_pretend():
+                    existing.full_name, existing.email = u['full_name'], u['email']
+                    session.commit()
+            user_changes.append(Change('~', "user {0} name/email".format(name), update_user))
+
+    for shortname, site in sorted(sites.items()):
+        current = current_sites.get(shortname)
+        if current is None:
+            site_changes.append(Change('+', "site " + shortname, lambda site=site: Site.create(site['shortname'], site['full_name'] or site['shortname'])))
+            members, domains, databases = set(), set(['.'.join([shortname, config.DEFAULT_DOMAIN])]), {}
+        else:
+            if current._journal_owner() in unfinished:
+                site_changes.append(Change('~', "site {0}: finish provisioning".format(shortname), current.resume))
+            if site['full_name'] and site['full_name'] != current.full_name:
+                def update_site(current=current, full_name=site['full_name']):
+                    if not shell.is_pretend():
+                        current.full_name = full_name
+                        session.commit()
+                site_changes.append(Change('~', "site {0} full name".format(shortname), update_site))
+            members = set(u.username for u in current.users)
+            domains = set(d.domain_name for d in current.domains)
+            databases = dict((d.dbname, d.dbms) for d in current.databases)
+
+        if site['users'] is not None:
+            for username in sorted(site['users'] - members):
+                member_changes.append(Change('+', "{0} to site {1}".format(username, shortname),
+                    lambda shortname=shortname, username=username: Site.get(shortname).addUser(User.get(username), suppress_welcome=suppress_welcome)))
+            for username in sorted(members - site['users']):
+                member_changes.append(Change('-', "{0} from site {1}".format(username, shortname),
+                    lambda shortname=shortname, username=username: Site.get(shortname).removeUser(User.get(username))))
+        if site['domains'] is not None:
+            for domain_name in sorted(domains - site['domains']):
+                domain_removals.append(Change('-', "domain {0} from site {1}".format(domain_name, shortname),
+                    lambda shortname=shortname, domain_name=domain_name: Domain.delete(domain_name, Site.get(shortname))))
+            for domain_name in sorted(site['domains'] - domains):
+                domain_additions.append(Change('+', "domain {0} for site {1}".format(domain_name, shortname),
+                    lambda shortname=shortname, domain_name=domain_name: Domain.create(domain_name, Site.get(shortname))))
+        if site['databases'] is not None:
+            for dbms in (Database.MYSQL, Database.POSTGRESQL):
+                wanted = sorted(name for name, kind in site['databases'].items() if kind == dbms and name not in databases)
+                if wanted:
+                    database_changes.append(Change('+', "{0} databases {1} for site {2}".format(DBMS_LABELS[dbms], ', '.join(wanted), shortname),
+                        lambda shortname=shortname, wanted=wanted, dbms=dbms: Database.create_many(wanted, Site.get(shortname), dbms, False)))
+            for dbname in sorted(databases):
+                if dbname in site['databases'] and site['databases'][dbname] != databases[dbname]:
+                    raise BadInventory("Database {0} of site {1} can't change DBMS".format(dbname, shortname))
+                if dbname not in site['databases']:
+                    database_changes.append(Change('-', "database {0} from site {1}".format(dbname, shortname),
+                        lambda shortname=shortname, dbname=dbname: Database.delete(dbname, Site.get(shortname))))
+
+    # Users exist before they join sites, and sites before their domains and
+    # databases; domains go before others are added, so one can move between sites
+    return user_changes + site_changes + member_changes + domain_removals + domain_additions + database_changes
+
+def apply(changes):
+    '''Applies changes in order, stopping at the first that fails (a later
+    sync picks up from there). Returns how many were applied.'''
+    for i, change in enumerate(changes):
+        logger.info("Applying: {0}".format(change))
+        try:
+            change.apply()
+        except Exception:
+            logger.exception("Failed to apply: {0}".format(change))
+            return i
+    return len(changes)
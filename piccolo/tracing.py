@@ -0,0 +1,236 @@
+import sys, time, json, os, threading, functools
+from contextlib import contextmanager
+
+"""
+Shows where a command's time goes (piccolo --profile): shell commands, queries
+to piccolo's SQLite DB and to the MySQL/PostgreSQL admin connections, email and
+waits are timed as spans, nested by the thread that ran them. At exit the spans
+are summed into a flame-style tree, and optionally written out as a Chrome
+trace (load it in chrome://tracing or ui.perfetto.dev).
+
+Nothing here is imported unless --profile is given: install() wraps the
+functions it times in place, so untraced runs pay nothing.
+"""
+
+_local = threading.local()
+_spans = [] # [name, category, start, seconds, thread id, path, args, outermost of its category]
+_originals = []
+_listeners = []
+_started = None
+_main_thread = None
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+        thread = threading.current_thread()
+        _local.root = () if thread is _main_thread else ('[{0}]'.format(thread.name),)
+    return stack
+
+def begin(name, category, args=None):
+    '''Opens a span; pass what it returns to end()'''
+    stack = _stack()
+    path = (stack[-1][5] if stack else _local.root) + (name,)
+    outermost = all(parent[1] != category for parent in stack)
+    record = [name, category, time.time(), None, threading.current_thread().ident, path, args, outermost]
+    _spans.append(record)
+    stack.append(record)
+    return record
+
+def end(record):
+    record[3] = time.time() - record[2]
+    stack = _stack()
+    # A span that failed without closing its own children closes them here
+    for i in range(len(stack) - 1, -1, -1):
+        if stack[i] is record:
+            del stack[i:]
+            break
+
+@contextmanager
+def span(name, category, args=None):
+    record = begin(name, category, args)
+    try:
+        yield
+    finally:
+        end(record)
+
+def _timed(func, category, describe):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        name, span_args = describe(*args, **kwargs)
+        record = begin(name, category, span_args)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            end(record)
+    return wrapper
+
+def _wrap(owner, attribute, category, describe):
+    '''Replaces owner.attribute (a function in a module, or a method or
+    staticmethod in a class) with one that records a span for each call'''
+    original = owner.__dict__[attribute]
+    if isinstance(original, staticmethod):
+        replacement = staticmethod(_timed(original.__func__, category, describe))
+    else:
+        replacement = _timed(original, category, describe)
+    setattr(owner, attribute, replacement)
+    _originals.append((owner, attribute, original))
+    return replacement
+
+def _first_word(text):
+    words = text.split() if isinstance(text, basestring) else list(text)
+    return os.path.basename(words[0]) if words else '?'
+
+class _TimedCursor(object):
+    '''A DB-API cursor whose statements are recorded as spans'''
+    def __init__(self, cursor, category):
+        self._cursor = cursor
+        self._category = category
+
+    def execute(self, statement, *args, **kwargs):
+        with span(self._category + ' ' + _first_word(statement).upper(), self._category, {'statement': statement[:200]}):
+            return self._cursor.execute(statement, *args, **kwargs)
+
+    def executemany(self, statement, *args, **kwargs):
+        with span(self._category + ' ' + _first_word(statement).upper(), self._category, {'statement': statement[:200]}):
+            return self._cursor.executemany(statement, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+def _timed_connection(func, category):
+    @functools.wraps(func)
+    def wrapper():
+        with span(category + ' connect', category):
+            conn, cur = func()
+        return conn, _TimedCursor(cur, category)
+    return wrapper
+
+def _trace_sqlite(engine):
+    from sqlalchemy import event
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('tracing', []).append(begin('sqlite ' + _first_word(statement).upper(), 'sqlite', {'statement': statement[:200]}))
+    def after(conn, cursor, statement, parameters, context, executemany):
+        end(conn.info['tracing'].pop())
+    def failed(context):
+        pending = context.connection.info.get('tracing') if context.connection is not None else None
+        if pending:
+            end(pending.pop())
+    for name, listener in (('before_cursor_execute', before), ('after_cursor_execute', after), ('handle_error', failed)):
+        event.listen(engine, name, listener)
+        _listeners.append((engine, name, listener))
+
+def install():
+    '''Starts tracing. Loads the model, so the functions it times can be
+    wrapped wherever they've been imported.'''
+    global _started, _main_thread
+    from piccolo import shell, db, databases, users, sites, nginx, mail, oplog, parallel
+    _started = time.time()
+    _main_thread = threading.current_thread()
+
+    do = _wrap(shell, 'do', 'subprocess', lambda command, *a, **k: (_first_word(command), {'command': command}))
+    for module in (users, sites, nginx): # from piccolo.shell import do
+        _originals.append((module, 'do', module.do))
+        module.do = do
+    _wrap(shell, 'pipe', 'subprocess', lambda commands, *a, **k: (' | '.join(_first_word(c) for c in commands), None))
+    _wrap(shell, 'reap', 'wait', lambda username, *a, **k: ('reap ' + username, None))
+    _wrap(parallel, 'run_each', 'parallel', lambda func, items, *a, **k: ('run_each', None))
+    _wrap(shell.Throttle, 'consume', 'throttle', lambda throttle, count: ('throttle', None))
+
+    step = oplog.step
+    @contextmanager
+    def traced_step(name, target=None):
+        with span(name, 'step', {'target': target} if target else None):
+            with step(name, target):
+                yield
+    oplog.step = traced_step # provisioning steps, so the tree shows what each was for
+    _originals.append((oplog, 'step', step))
+
+    _trace_sqlite(db.sqlite_db)
+    for attribute, category in (('_postgres', 'postgres'), ('_mysql', 'mysql')):
+        original = databases.Database.__dict__[attribute]
+        setattr(databases.Database, attribute, staticmethod(_timed_connection(original.__func__, category)))
+        _originals.append((databases.Database, attribute, original))
+
+    _wrap(users.User, 'send_email', 'mail', lambda user, subject, message: ('send_email', {'to': user.email}))
+    _wrap(mail._Connection, 'open', 'smtp', lambda connection: ('smtp connect', None))
+    _wrap(mail._Connection, 'send', 'smtp', lambda connection, message: ('smtp send', {'to': message.recipient}))
+
+def uninstall():
+    while _originals:
+        owner, attribute, original = _originals.pop()
+        setattr(owner, attribute, original)
+    from sqlalchemy import event
+    while _listeners:
+        event.remove(*_listeners.pop())
+
+def _finished():
+    return [record for record in _spans if record[3] is not None]
+
+def summary(min_share=0.005):
+    '''The spans summed by call path, as a flame-style tree: each line is a
+    path's total time, self time (not in traced children) and calls'''
+    spans = _finished()
+    totals = {}
+    for name, category, start, seconds, tid, path, args, outermost in spans:
+        entry = totals.setdefault(path, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+    # Worker threads' spans hang off a "[thread name]" that isn't a span itself
+    grouping = set(path[:i] for path in totals for i in range(1, len(path)) if path[:i] not in totals)
+    children = {}
+    for path in list(totals) + list(grouping):
+        children.setdefault(path[:-1], []).append(path)
+    for path in sorted(grouping, key=len, reverse=True):
+        totals[path] = [sum(totals[child][0] for child in children[path]), 0]
+    wall = time.time() - _started if _started else sum(totals[path][0] for path in children.get((), []))
+    floor = wall * min_share
+    lines = ["{0:>10} {1:>10} {2:>7}  {3}".format("total ms", "self ms", "calls", "span")]
+
+    def visit(path):
+        total, calls = totals[path]
+        inner = sum(totals[child][0] for child in children.get(path, []))
+        lines.append("{0:>10.1f} {1:>10.1f} {2:>7}  {3}{4}".format(
+            total * 1000, max(total - inner, 0) * 1000, calls, '  ' * (len(path) - 1), path[-1]))
+        for child in sorted(children.get(path, []), key=lambda p: -totals[p][0]):
+            if totals[child][0] >= floor:
+                visit(child)
+
+    for root in sorted(children.get((), []), key=lambda p: -totals[p][0]):
+        visit(root)
+
+    by_category = {}
+    for record in spans:
+        if record[7]: # nested spans of the same category are already counted
+            by_category[record[1]] = by_category.get(record[1], 0.0) + record[3]
+    lines.append("")
+    lines.append("By category (ms): " + ", ".join("{0} {1:.1f}".format(category, seconds * 1000)
+        for category, seconds in sorted(by_category.items(), key=lambda item: -item[1])))
+    traced = sum(totals[path][0] for path in children.get((), []) if path not in grouping)
+    lines.append("Wall time: {0:.1f} ms, {1:.1f} ms of it outside traced spans (Python, imports, file I/O)".format(
+        wall * 1000, max(wall - traced, 0) * 1000))
+    return '\n'.join(lines)
+
+def chrome_trace():
+    '''The spans as Chrome trace events'''
+    pid = os.getpid()
+    events = []
+    for name, category, start, seconds, tid, path, args, outermost in _finished():
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+            'ts': int((start - _started) * 1e6), 'dur': int(seconds * 1e6)}
+        if args:
+            event['args'] = args
+        events.append(event)
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def report(trace_file=None):
+    '''Prints the summary to stderr and writes the Chrome trace, if asked'''
+    uninstall()
+    sys.stderr.write(summary() + "\n")
+    if trace_file:
+        with open(trace_file, 'w') as out:
+            json.dump(chrome_trace(), out, default=str)
+        sys.stderr.write("Wrote Chrome trace to {0}\n".format(trace_file))
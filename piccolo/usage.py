@@ -0,0 +1,179 @@
+import logging, os, stat, datetime, re
+from piccolo import db, config, shell
+
+"""
+Disk usage of site and user homes. Scans remember each directory's mtime and
+the size of the files directly in it, so a rescan only lists directories whose
+entries changed and just stats the rest.
+
+A file growing in place doesn't touch its directory's mtime, so rescans miss
+that until something is added, removed or renamed next to it; scan with
+full=True (`piccolo usage --full`) to recount everything.
+"""
+
+logger = logging.getLogger(__name__)
+
+SITE = 'site'
+USER = 'user'
+
+class Usage(db.Base):
+    '''Latest totals for one site or user home, and its threshold'''
+    __tablename__ = 'usage'
+    owner = db.Column(db.String(64), primary_key=True) # "site:foo" or "user:bar"
+    kind = db.Column(db.String(10))
+    name = db.Column(db.String(config.NAME_LIMIT))
+    bytes = db.Column(db.Integer)
+    files = db.Column(db.Integer)
+    dirs = db.Column(db.Integer)
+    scanned_at = db.Column(db.DateTime)
+    threshold = db.Column(db.Integer) # bytes, or None for no limit
+
+    def __init__(self, kind, name):
+        self.owner = "{0}:{1}".format(kind, name)
+        self.kind = kind
+        self.name = name
+
+    def __str__(self):
+        return u"<Usage: {0} {1}>".format(self.owner, format_size(self.bytes or 0))
+
+    __unicode__ = __str__
+
+    def over_threshold(self):
+        return self.threshold is not None and self.bytes is not None and self.bytes > self.threshold
+
+    def describe(self):
+        if self.bytes is None:
+            text = "not scanned yet"
+        else:
+            text = "{0} in {1} files as of {2:%Y-%m-%d %H:%M}".format(format_size(self.bytes), self.files, self.scanned_at)
+        if self.threshold is not None:
+            text += "; threshold {0}".format(format_size(self.threshold))
+            if self.over_threshold():
+                text += " (OVER by {0})".format(format_size(self.bytes - self.threshold))
+        return text
+
+class UsageDir(db.Base):
+    '''What a scan found directly inside one directory'''
+    __tablename__ = 'usage_dirs'
+    path = db.Column(db.String(4096), primary_key=True)
+    owner = db.Column(db.String(64), index=True)
+    parent = db.Column(db.String(4096))
+    mtime = db.Column(db.Float)
+    bytes = db.Column(db.Integer)
+    files = db.Column(db.Integer)
+
+    def __init__(self, path, owner, parent):
+        self.path = path
+        self.owner = owner
+        self.parent = parent
+
+_UNITS = (('T', 1024 ** 4), ('G', 1024 ** 3), ('M', 1024 ** 2), ('K', 1024))
+
+def format_size(size):
+    for unit, factor in _UNITS:
+        if size >= factor:
+            return "{0:.1f}{1}".format(float(size) / factor, unit)
+    return "{0}B".format(size)
+
+def parse_size(text):
+    '''Turns "500M", "2.5G" or a plain number of bytes into bytes'''
+    match = re.match(r'^\s*([\d.]+)\s*([KMGT]?)i?B?\s*$', text, re.IGNORECASE)
+    if not match:
+        raise ValueError("Not a size: {0}".format(text))
+    factor = dict(_UNITS).get(match.group(2).upper(), 1)
+    return int(float(match.group(1)) * factor)
+
+def home(kind, name):
+    return shell.join(config.SITES_ROOT if kind == SITE else config.USERS_ROOT, name)
+
+def get(kind, name):
+    db.ensure_tables(Usage, UsageDir)
+    return db.get(Usage, "{0}:{1}".format(kind, name))
+
+def _list(path):
+    '''Bytes on disk and number of files directly in path, and its subdirectories'''
+    size = files = 0
+    subdirs = []
+    for entry in shell.entries(path):
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+        else:
+            files += 1
+            size += entry.stat(follow_symlinks=False).st_blocks * 512
+    return size, files, subdirs
+
+def scan(kind, name, full=False):
+    '''Updates the recorded usage of a site or user home, listing only
+    directories that changed since the last scan. Returns its Usage.'''
+    db.ensure_tables(Usage, UsageDir)
+    session = db.Session()
+    owner = "{0}:{1}".format(kind, name)
+    known = dict((d.path, d) for d in session.query(UsageDir).filter_by(owner=owner))
+    children = {}
+    for d in known.values():
+        children.setdefault(d.parent, []).append(d.path)
+
+    seen = set()
+    total_bytes = total_files = listed = 0
+    pending = [(home(kind, name), None)]
+    while pending:
+        path, parent = pending.pop()
+        try:
+            mtime = os.lstat(path).st_mtime
+        except OSError:
+            continue # deleted mid-scan; its rows go below
+        record = known.get(path)
+        if record is not None and record.mtime == mtime and not full:
+            subdirs = children.get(path, [])
+        else:
+            try:
+                size, files, subdirs = _list(path)
+            except OSError as e:
+                logger.warning("Couldn't scan {0}: {1}".format(path, e))
+                continue
+            listed += 1
+            if record is None:
+                record = UsageDir(path, owner, parent)
+                session.add(record)
+            record.mtime, record.bytes, record.files, record.parent = mtime, size, files, parent
+        seen.add(path)
+        total_bytes += record.bytes
+        total_files += record.files
+        pending.extend((subdir, path) for subdir in subdirs)
+
+    for path in set(known) - seen:
+        session.delete(known[path])
+    usage = session.query(Usage).get(owner)
+    if usage is None:
+        usage = Usage(kind, name)
+        session.add(usage)
+    usage.bytes, usage.files, usage.dirs = total_bytes, total_files, len(seen)
+    usage.scanned_at = datetime.datetime.now()
+    session.commit()
+    logger.debug("Scanned {0}: {1}, listed {2} of {3} directories".format(owner, format_size(total_bytes), listed, len(seen)))
+    if usage.over_threshold():
+        logger.warning("{0} {1} is over its threshold: {2}".format(kind, name, usage.describe()))
+    return usage
+
+def set_threshold(kind, name, threshold):
+    '''Sets (or with None, clears) the size a home shouldn't grow past'''
+    db.ensure_tables(Usage, UsageDir)
+    session = db.Session()
+    usage = get(kind, name)
+    if usage is None:
+        usage = Usage(kind, name)
+        session.add(usage)
+    usage.threshold = threshold
+    session.commit()
+    return usage
+
+def top(limit=None, kind=None):
+    '''Recorded usage, largest first'''
+    db.ensure_tables(Usage, UsageDir)
+    q = db.Session().query(Usage).filter(Usage.bytes != None)
+    if kind:
+        q = q.filter_by(kind=kind)
+    q = q.order_by(Usage.bytes.desc())
+    if limit:
+        q = q.limit(limit)
+    return q.all()
@@ -1,8 +1,7 @@
-import re, os, logging, pwd, time, stat, smtplib
-from email.mime.text import MIMEText
+import re, os, logging, pwd, time, stat
 import piccolo.log
 from piccolo import db, config, shell
-from piccolo.shell import do, wait
+from piccolo.shell import do
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +23,8 @@ class User(db.Base):
     class ShellActionFailed(Exception):
         pass
     
+    QUERY_CHUNK = 500 # names per IN (...) lookup, under SQLite's variable limit
+    
     def __init__(self, username, full_name, email):
         self.username = username
         self.full_name = full_name
@@ -44,35 +45,55 @@ class User(db.Base):
         }
     
     def send_email(self, subject, message):
-        msg = MIMEText(message)
-        msg['Subject'] = subject
-        msg['From'] = "{0} <{1}>".format(config.EMAIL['friendly_name'], config.EMAIL['username'])
-        msg['To'] = "{0} <{1}>".format(self.full_name, self.email)
-        
-        s = smtplib.SMTP(config.EMAIL['smtp_server'], config.EMAIL['smtp_port'])
-        s.starttls()
-        s.login(config.EMAIL['username'], config.EMAIL['password'])
-        s.sendmail(config.EMAIL['username'], [self.email], msg.as_string())
-        s.quit()
+        '''Queues an email to this user; it goes out when the outbox is flushed'''
+        from piccolo import mail
+        return mail.queue(self.email, self.full_name, subject, message)
     
-    def _shell_create(self):
+    def _useradd(self):
         do("useradd -U -b {0} -m -s /bin/bash {1}".format(
             config.USERS_ROOT,
             self.username
         ))
         self._format_append("user_bash_profile.sh", shell.join(self._get_home(), ".profile"))
-        tmppass = shell.join(self._get_home(), '.tmppass')
-        with open(tmppass, 'w') as t:
-            os.chmod(tmppass, stat.S_IRWXU)
-            t.write("{0}\n{0}\n".format(self._temp_password))
-            t.close()
-        do("passwd {0} < {1}".format(self.username, tmppass), shell=True)
-        do("passwd -e {0}".format(self.username))
-        do("rm {0}".format(tmppass))
+    
+    # Reads usernames on stdin and prints back the ones it couldn't expire
+    EXPIRE_LOOP = 'while read name; do chage -d 0 "$name" </dev/null >/dev/null 2>&1 || echo "$name"; done'
+    
+    @staticmethod
+    def _set_initial_passwords(users):
+        '''Sets each user's _temp_password with one chpasswd, then expires them
+        all from one shell loop so they have to be changed at first login.
+        Returns the users whose passwords couldn't be expired. The passwords
+        only ever travel over stdin.'''
+        do("chpasswd", input=''.join("{0}:{1}\n".format(u.username, u._temp_password) for u in users))
+        output = do(User.EXPIRE_LOOP, shell=True, input=''.join(u.username + "\n" for u in users))
+        unexpired = set((output or '').split())
+        return [u for u in users if u.username in unexpired]
+    
+    @staticmethod
+    def _remove_accounts(users):
+        '''Deletes the accounts and rows of users whose creation failed partway,
+        so none are left without a password'''
+        session = db.Session()
+        for u in users:
+            do("userdel -r {0}".format(u.username), ignore_errors=True)
+            session.delete(u)
+        session.commit()
+    
+    def _shell_create(self):
+        self._useradd()
+        if User._set_initial_passwords([self]):
+            raise User.ShellActionFailed("Couldn't expire the initial password of {0}".format(self.username))
+    
+    def _queue_welcome(self):
+        user_vars = self._vars()
+        user_vars.update({"$INITIAL_PASSWORD": self._temp_password,})
+        email_message = shell.render_template(shell.join(config.TEMPLATE_ROOT, 'user_email.txt'), user_vars)
+        email_subject = "New Peninsula Account {0}".format(self.username)
+        self.send_email(email_subject, email_message)
     
     def _shell_delete(self):
-        do("pkill -u {0}".format(self.username), ignore_errors=True)
-        wait("Waiting for user's processes to exit")
+        shell.reap(self.username)
         do("userdel -r {0}".format(self.username))
     
     def _format_copy(self, src, dest):
@@ -85,12 +106,7 @@ class User(db.Base):
     
     @staticmethod
     def get(username):
-        session = db.Session()
-        userq = session.query(User).filter(User.username == username)
-        if (userq.count() == 1):
-            return userq.first()
-        else:
-            return None
+        return db.get(User, username)
     
     @staticmethod
     def create(username, full_name, email, suppress_welcome=False, fake_create=False):
@@ -121,22 +137,101 @@ class User(db.Base):
         try:
             if not fake_create:
                 new_user._shell_create()
-        except User.ShellActionFailed:
-            session.delete(new_user)
-            session.commit()
+        except (User.ShellActionFailed, shell.ShellActionFailed):
+            User._remove_accounts([new_user])
             raise
         else:
             logger.info('Created user "{0}" [{1}] with contact email <{2}>'.format(full_name, username, email))
             if not suppress_welcome:
-                user_vars = new_user._vars()
-                user_vars.update({"$INITIAL_PASSWORD": new_user._temp_password,})
-                email_message = shell.format(open(shell.join(config.TEMPLATE_ROOT, 'user_email.txt')).read(), user_vars)
-                email_subject = "New Peninsula Account {0}".format(new_user.username)
-                new_user.send_email(email_subject, email_message)
-                logger.info("Sent welcome email to {0}".format(new_user.email))
+                new_user._queue_welcome()
+                session.commit()
+                logger.info("Queued welcome email to {0}".format(new_user.email))
             elif not fake_create:
                 logger.info("User's initial password: {0}".format(new_user._temp_password))
     
+    @staticmethod
+    def create_many(rows, suppress_welcome=False):
+        '''Creates users from (username, full_name, email) rows. Every row is
+        checked before anything changes; then the DB rows go in with one commit
+        and the accounts get their initial passwords in one batch. Returns the
+        usernames whose accounts couldn't be created.'''
+        session = db.Session()
+        rows = list(rows)
+        usernames = [row[0] for row in rows]
+        problems = []
+        seen = set()
+        for username, full_name, email in rows:
+            if username in seen:
+                problems.append("{0} is listed more than once".format(username))
+            seen.add(username)
+            if not config.NAME_REGEX.match(username) or len(username) > config.NAME_LIMIT:
+                problems.append("{0} is not a valid username".format(username))
+            if not full_name:
+                problems.append("{0} has no full name".format(username))
+            if not email or '@' not in email:
+                problems.append("{0} has no valid email address".format(username))
+        in_piccolo = set()
+        for i in range(0, len(usernames), User.QUERY_CHUNK):
+            chunk = usernames[i:i + User.QUERY_CHUNK]
+            in_piccolo.update(row[0] for row in session.query(User.username).filter(User.username.in_(chunk)))
+        in_passwd = set(entry.pw_name for entry in pwd.getpwall())
+        for username in usernames:
+            if username in in_piccolo:
+                problems.append("There is already a user named {0} in piccolo".format(username))
+            elif username in in_passwd:
+                problems.append("There is already a user named {0} in /etc/passwd".format(username))
+            elif shell.exists(shell.join(config.USERS_ROOT, username)):
+                problems.append("Folder {0} already exists".format(shell.join(config.USERS_ROOT, username)))
+        if problems:
+            raise User.BadName("Nothing was imported:\n" + "\n".join(problems))
+        
+        if shell.is_pretend():
+            for username, full_name, email in rows:
+                logger.info('Creating user "{0}" [{1}] with contact email <{2}>'.format(full_name, username, email))
+            return []
+        
+        new_users = [User(username, full_name, email) for username, full_name, email in rows]
+        session.add_all(new_users)
+        session.commit()
+        created, failed = [], []
+        for new_user in new_users:
+            new_user._temp_password = shell.generate_password(length=12)
+            try:
+                new_user._useradd()
+            except shell.ShellActionFailed:
+                failed.append(new_user)
+            else:
+                created.append(new_user)
+        if failed:
+            for new_user in failed:
+                session.delete(new_user)
+            session.commit()
+        if created:
+            try:
+                unexpired = User._set_initial_passwords(created)
+            except shell.ShellActionFailed:
+                logger.error("Couldn't set initial passwords; removing the {0} accounts just created".format(len(created)))
+                User._remove_accounts(created)
+                failed.extend(created)
+                created = []
+            else:
+                if unexpired:
+                    logger.error("Couldn't expire the initial passwords of {0}; removing those accounts".format(", ".join(u.username for u in unexpired)))
+                    User._remove_accounts(unexpired)
+                    failed.extend(unexpired)
+                    created = [u for u in created if u not in unexpired]
+        if created:
+            logger.info("Created {0} users".format(len(created)))
+            if not suppress_welcome:
+                for new_user in created:
+                    new_user._queue_welcome()
+                session.commit()
+                logger.info("Queued {0} welcome emails".format(len(created)))
+            else:
+                for new_user in created:
+                    logger.info("Initial password for {0}: {1}".format(new_user.username, new_user._temp_password))
+        return [u.username for u in failed]
+    
     @staticmethod
     def delete(username):
         session = db.Session()
@@ -153,16 +248,18 @@ class User(db.Base):
             session.commit()
             logger.info("Deleted {0} from the DB".format(username))
     
-    def archive(destination=None):
-        archive_name = '{0}.tar.gz'.format(theuser.username)
+    def archive(self, destination=None):
+        '''Saves a tarball of the user's home folder (by default in
+        DATA_DIR/deleted_users) and returns its path'''
         if not destination:
-            destination = shell.join(DATA_DIR, 'deleted_users', archive_name)
-        else:
-            destination = shell.join(destination, archive_name)
-        try:
-            subprocess.check_output(
-                ["/bin/tar", "cvzf",],
-                stderr=subprocess.STDOUT
-            )
-        except subprocess.CalledProcessError, err:
-            raise User.ShellActionFailed(err)
\ No newline at end of file
+            destination = shell.join(config.DATA_DIR, 'deleted_users')
+        if not shell.exists(destination):
+            shell.mkdir(destination)
+            shell.chmod(destination, "u=rwx,g=,o=")
+        archive_path = shell.join(destination, '{0}.tar.gz'.format(self.username))
+        do("tar czf {0} -C {1} {2}".format(archive_path, config.USERS_ROOT, self.username))
+        return archive_path
+
+# User.sites (and the site_users rows deleting a user removes) is mapped by
+# piccolo.sites, so any command that uses users has it
+import piccolo.sites
@@ -0,0 +1,66 @@
+import os, re, shutil, unittest
+
+"""
+How many statements piccolo's SQLite DB sees for a whole Site.create, with the
+host faked (benchmarks.fakes) and config pointed at a scratch root.
+
+    python -m unittest discover tests
+"""
+
+from benchmarks import run
+ROOT, CONFIG_PATH = run._make_root()
+os.environ['PICCOLO_CONFIG'] = CONFIG_PATH # before piccolo.config is first imported
+
+import logging
+import piccolo.log
+from sqlalchemy import event
+from piccolo import core, config, db
+from piccolo.sites import Site, Domain
+from benchmarks import fakes
+
+LOOKUPS = 2 # the site, then the default domain, each found missing once
+SELECTS = 4 # those, plus the journal reading back the steps it has
+
+def setUpModule():
+    piccolo.log.ch.setLevel(logging.CRITICAL)
+    core.initialize()
+    fakes.install()
+
+def tearDownModule():
+    shutil.rmtree(ROOT, ignore_errors=True)
+
+class SiteCreateQueries(unittest.TestCase):
+    def setUp(self):
+        db.Session.remove() # a new command
+        self.statements = []
+        event.listen(db.sqlite_db, 'before_cursor_execute', self._count)
+
+    def tearDown(self):
+        event.remove(db.sqlite_db, 'before_cursor_execute', self._count)
+        db.Session.remove()
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def _selects(self, *tables):
+        selects = [s for s in self.statements if s.lstrip().upper().startswith('SELECT')]
+        if tables:
+            selects = [s for s in selects if any(re.search(r'\bFROM {0}\b'.format(table), s) for table in tables)]
+        return selects
+
+    def test_create(self):
+        Site.create('querycount', 'Query count')
+        self.assertLessEqual(len(self._selects(Site.__tablename__, Domain.__tablename__)), LOOKUPS)
+        self.assertLessEqual(len(self._selects()), SELECTS)
+
+    def test_repeated_lookups(self):
+        Site.create('querylookup', 'Query lookup')
+        del self.statements[:]
+        site = Site.get('querylookup')
+        self.assertIs(Site.get('querylookup'), site) # from the identity map while it's held
+        self.assertIsNone(Site.get('querymissing'))
+        self.assertIsNone(Site.get('querymissing')) # remembered as missing
+        self.assertEqual(len(self._selects()), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import os, shutil, unittest
+
+"""
+Strict template rendering: unknown variables raise rather than render as text.
+
+    python -m unittest discover tests
+"""
+
+from benchmarks import run
+ROOT, CONFIG_PATH = run._make_root()
+os.environ.setdefault('PICCOLO_CONFIG', CONFIG_PATH) # before piccolo.config is first imported
+
+from piccolo import shell
+
+VARS = {'$SHORTNAME': 'site', '$DB_USERNAME': 'site_db', '$DB_USERNAME_MYSQL': 'site_my'}
+
+def tearDownModule():
+    shutil.rmtree(ROOT, ignore_errors=True)
+
+class StrictRendering(unittest.TestCase):
+    def render(self, text, strict=True):
+        return shell.Template(text, 'test').render(VARS, strict)
+
+    def test_known(self):
+        self.assertEqual(self.render('$SHORTNAME $DB_USERNAME_MYSQL'), 'site site_my')
+
+    def test_runs_into_literal(self):
+        self.assertEqual(self.render('$SHORTNAME_domains'), 'site_domains')
+
+    def test_misspelled(self):
+        for text in ('$SHORTNAMES', '$DB_USERNAME_MYSQLX', '$SHORTNAME_X'):
+            self.assertRaises(shell.UnknownTemplateVariable, self.render, text)
+
+    def test_not_strict(self):
+        self.assertEqual(self.render('$SHORTNAMES', strict=False), '$SHORTNAMES')
+
+if __name__ == '__main__':
+    unittest.main()